@@ -31,9 +31,22 @@ def makeService(options):
     from vigilo.connector_metro.confdb import MetroConfDB
     from vigilo.connector_metro.threshold import ThresholdChecker
     from vigilo.connector_metro.bustorrdtool import BusToRRDtool
+    from vigilo.connector_metro.supervisor import MetroSupervisor, get_shard
 
     root_service = service.MultiService()
 
+    # Mode multi-processus : le processus principal ne fait que lancer et
+    # surveiller les processus fils, qui se partagent les hôtes.
+    try:
+        workers = settings["connector-metro"].as_int("workers")
+    except KeyError:
+        workers = 1
+    shard = get_shard()
+    if workers > 1 and shard is None:
+        supervisor = MetroSupervisor(workers)
+        supervisor.setServiceParent(root_service)
+        return root_service
+
     # Client du bus
     client_in = client_factory(settings)
     client_in.setName("vigilo_client_in")
@@ -52,7 +65,7 @@ def makeService(options):
         LOGGER.error(_("Please set the path to the configuration "
             "database generated by VigiConf in the settings.ini."))
         sys.exit(1)
-    confdb = MetroConfDB(conffile)
+    confdb = MetroConfDB(conffile, shard=shard)
     confdb.setServiceParent(root_service)
 
     try:
@@ -69,14 +82,110 @@ def makeService(options):
         pool_size = settings["connector-metro"].as_int("rrd_processes")
     except KeyError:
         pool_size = None
-    rrdtool_pool = RRDToolPoolManager(rrd_base_dir, rrd_path_mode, rrd_bin,
-                             check_thresholds=must_check_th,
-                             rrdcached=rrdcached, pool_size=pool_size)
-    rrdtool = RRDToolManager(rrdtool_pool, confdb)
+    try:
+        pipeline_size = settings["connector-metro"].as_int("rrd_pipeline")
+    except KeyError:
+        pipeline_size = 1
+    try:
+        min_pool_size = settings["connector-metro"].as_int("rrd_processes_min")
+    except KeyError:
+        min_pool_size = None
+    try:
+        max_latency = settings["connector-metro"].as_float("rrd_max_latency")
+    except KeyError:
+        max_latency = 0.1
+    try:
+        idle_timeout = settings["connector-metro"].as_int("rrd_idle_timeout")
+    except KeyError:
+        idle_timeout = 60
+    try:
+        affinity = settings["connector-metro"].as_bool("rrd_affinity")
+    except KeyError:
+        affinity = False
+    try:
+        precreate = settings["connector-metro"].as_bool("precreate_rrd")
+    except KeyError:
+        precreate = False
+    try:
+        precreate_concurrency = settings["connector-metro"].as_int(
+                                    "precreate_concurrency")
+    except KeyError:
+        precreate_concurrency = 1
+    rrd_backend = settings["connector-metro"].get("rrd_backend", "process")
+    if rrd_backend == "library":
+        from vigilo.connector_metro.librrd import RRDToolLibraryManager
+        ignored = [option for option in ("rrd_pipeline", "rrd_affinity",
+                                         "rrd_processes_min",
+                                         "rrd_max_latency",
+                                         "rrd_idle_timeout")
+                   if option in settings["connector-metro"]]
+        if ignored:
+            LOGGER.warning(_("These options do not apply to the library "
+                             "backend and are ignored: %s"),
+                           ", ".join(ignored))
+        rrdtool_pool = RRDToolLibraryManager(rrd_base_dir, rrd_path_mode,
+                                 check_thresholds=must_check_th,
+                                 rrdcached=rrdcached, pool_size=pool_size)
+    elif rrd_backend == "process":
+        rrdtool_pool = RRDToolPoolManager(rrd_base_dir, rrd_path_mode,
+                                 rrd_bin, check_thresholds=must_check_th,
+                                 rrdcached=rrdcached, pool_size=pool_size,
+                                 pipeline_size=pipeline_size,
+                                 background_pool_size=(precreate and
+                                                       precreate_concurrency),
+                                 affinity=affinity,
+                                 min_pool_size=min_pool_size,
+                                 max_latency=max_latency,
+                                 idle_timeout=idle_timeout)
+    else:
+        LOGGER.error(_("Invalid value for the rrd_backend option: %s"),
+                     rrd_backend)
+        sys.exit(1)
+    try:
+        batch_delay = settings["connector-metro"].as_float("update_batch_delay")
+    except KeyError:
+        batch_delay = 0
+    try:
+        batch_size = settings["connector-metro"].as_int("update_batch_size")
+    except KeyError:
+        batch_size = 20
+    try:
+        rrdcached_protocol = settings["connector-metro"].as_bool(
+                                "rrdcached_protocol")
+    except KeyError:
+        rrdcached_protocol = False
+    if rrdcached and rrdcached_protocol:
+        from vigilo.connector_metro.rrdcached import RRDCachedClient
+        try:
+            rrdcached_size = settings["connector-metro"].as_int(
+                                "rrdcached_connections")
+        except KeyError:
+            rrdcached_size = 2
+        rrdcached_client = RRDCachedClient(rrdcached, size=rrdcached_size)
+    else:
+        rrdcached_client = None
+    try:
+        last_values_size = settings["connector-metro"].as_int(
+                                "last_values_cache_size")
+    except KeyError:
+        last_values_size = 10000
+    rrdtool = RRDToolManager(rrdtool_pool, confdb, batch_delay=batch_delay,
+                             batch_size=batch_size, rrdcached=rrdcached_client,
+                             last_values_size=last_values_size)
+    if precreate:
+        confdb.registerIndexCallback(
+                lambda diff: rrdtool.createMissing(precreate_concurrency,
+                                                   diff.added))
 
     # Gestion des seuils
     if must_check_th:
-        threshold_checker = ThresholdChecker(rrdtool, confdb)
+        try:
+            use_message_values = settings['connector-metro'].as_bool(
+                                    'threshold_from_message')
+        except KeyError:
+            use_message_values = False
+        threshold_checker = ThresholdChecker(rrdtool, confdb,
+                                use_message_values=use_message_values)
         bus_publisher = buspublisher_factory(settings, client_out)
         bus_publisher.registerProducer(threshold_checker, streaming=True)
         providers.append(bus_publisher)
@@ -84,10 +193,55 @@ def makeService(options):
         threshold_checker = None
 
     # Gestionnaire principal des messages
-    bustorrdtool = BusToRRDtool(confdb, rrdtool, threshold_checker)
+    try:
+        message_batch_size = settings["connector-metro"].as_int(
+                                "message_batch_size")
+    except KeyError:
+        message_batch_size = 1
+    spool_dir = settings["connector-metro"].get("spool_dir", None)
+    if spool_dir:
+        from vigilo.connector_metro.spool import MessageSpool
+        if shard is not None:
+            spool_dir = "%s-%d" % (spool_dir, shard[0])
+        try:
+            spool_segment_size = settings["connector-metro"].as_int(
+                                    "spool_segment_size")
+        except KeyError:
+            spool_segment_size = 16 * 1024 * 1024
+        try:
+            spool_sync_delay = settings["connector-metro"].as_float(
+                                    "spool_sync_delay")
+        except KeyError:
+            spool_sync_delay = 1
+        spool = MessageSpool(spool_dir, segment_size=spool_segment_size,
+                             sync_delay=spool_sync_delay)
+    else:
+        spool = None
+    try:
+        spool_latency = settings["connector-metro"].as_float("spool_latency")
+    except KeyError:
+        spool_latency = 1.0
+    try:
+        high_watermark = settings["connector-metro"].as_int(
+                                "rrd_queue_high_watermark")
+    except KeyError:
+        high_watermark = None
+    try:
+        low_watermark = settings["connector-metro"].as_int(
+                                "rrd_queue_low_watermark")
+    except KeyError:
+        low_watermark = None
+    bustorrdtool = BusToRRDtool(confdb, rrdtool, threshold_checker,
+                                batch_size=message_batch_size, spool=spool,
+                                spool_latency=spool_latency,
+                                high_watermark=high_watermark or None,
+                                low_watermark=low_watermark)
     bustorrdtool.setClient(client_in)
     subs = parseSubscriptions(settings)
     queue = settings["bus"]["queue"]
+    if shard is not None:
+        # Chaque processus fils reçoit tous les messages dans sa propre file
+        queue = "%s-%d" % (queue, shard[0])
     queue_messages_ttl = int(settings['bus'].get('queue_messages_ttl', 0))
     prefetch_count = int(settings['bus'].get('prefetch_count', QueueSubscriber.prefetch_count))
     bustorrdtool.subscribe(queue, queue_messages_ttl, subs, prefetch_count=prefetch_count)
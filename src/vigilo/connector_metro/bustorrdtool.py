@@ -9,9 +9,11 @@ depuis un bus pour les stocker dans une base de données RRDtool.
 
 from __future__ import absolute_import
 
+import logging
 import time
 
-from twisted.internet import defer
+from twisted.internet import reactor, defer, task
+from twisted.python.failure import Failure
 
 from vigilo.common.logging import get_logger
 LOGGER = get_logger(__name__)
@@ -22,6 +24,7 @@ _ = translate(__name__)
 from vigilo.connector.handlers import MessageHandler
 
 from vigilo.connector_metro.rrdtool import RRDToolError
+from vigilo.connector_metro.histogram import Timings
 from vigilo.connector_metro.exceptions import InvalidMessage
 from vigilo.connector_metro.exceptions import WrongMessageType
 from vigilo.connector_metro.exceptions import CreationError
@@ -29,6 +32,16 @@ from vigilo.connector_metro.exceptions import NotInConfiguration
 
 
 
+REQUIRED_KEYS = ('timestamp', 'value', 'host', 'datasource')
+
+# Motifs de rejet des messages (noms des compteurs dans les statistiques)
+REJECT_NOT_IN_CONF = "not_in_conf"
+REJECT_WRONG_TYPE = "wrong_type"
+REJECT_INVALID = "invalid_messages"
+REJECT_REASONS = (REJECT_NOT_IN_CONF, REJECT_WRONG_TYPE, REJECT_INVALID)
+
+
+
 class BusToRRDtool(MessageHandler):
     """
     Reçoit des données de métrologie (performances) depuis le bus
@@ -37,7 +50,19 @@ class BusToRRDtool(MessageHandler):
     get_current_time = time.time
 
 
-    def __init__(self, confdb, rrdtool, threshold_checker):
+    # Intervalle entre deux vérifications de l'état de RRDTool pour le rejeu
+    # des messages mis en attente sur disque (en secondes)
+    spool_check_interval = 1
+    # Nombre de messages rejoués ensemble
+    spool_replay_size = 1000
+    # Intervalle entre deux vérifications de la file d'attente de RRDTool
+    # tant que la réception est suspendue (en secondes)
+    queue_check_interval = 0.1
+
+
+    def __init__(self, confdb, rrdtool, threshold_checker, batch_size=1,
+                 spool=None, spool_latency=1.0, high_watermark=None,
+                 low_watermark=None, clock=None):
         """
         Instancie un connecteur du bus vers RRDtool pour le stockage des
         données de performance dans les fichiers RRD.
@@ -45,12 +70,52 @@ class BusToRRDtool(MessageHandler):
         @param confdb: instance de la base de configuration en provenance de
             VigiConf
         @type  confdb: C{vigilo.connector_metro.confdb.MetroConfDB}
+        @param batch_size: nombre maximum de messages traités ensemble
+            (voir L{processBatch}), 1 pour traiter chaque message séparément
+        @type  batch_size: C{int}
+        @param spool: file d'attente sur disque, utilisée lorsque RRDTool ne
+            suit plus
+        @type  spool: L{vigilo.connector_metro.spool.MessageSpool}
+        @param spool_latency: latence de RRDTool (en secondes) au-delà de
+            laquelle les messages sont mis en attente sur disque
+        @type  spool_latency: C{float}
+        @param high_watermark: nombre de commandes RRDTool en attente à
+            partir duquel la réception des messages est suspendue
+            (C{None} : jamais)
+        @type  high_watermark: C{int}
+        @param low_watermark: nombre de commandes en attente en-dessous
+            duquel la réception reprend (par défaut, la moitié de
+            C{high_watermark})
+        @type  low_watermark: C{int}
         """
         super(BusToRRDtool, self).__init__()
         self.confdb = confdb
         self.rrdtool = rrdtool
         self.threshold_checker = threshold_checker
+        self.batch_size = batch_size
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self._batch = []
+        self._batch_call = None
+        self.spool = spool
+        self.spool_latency = spool_latency
+        self._spool_check = None
+        if high_watermark is not None and low_watermark is None:
+            low_watermark = high_watermark // 2
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # Réception suspendue faute de place dans la file de RRDTool
+        self._throttled = False
+        self._throttle_count = 0
+        self._queue_check = None
+        self._max_queued = 0
         self._illegal_updates = 0
+        # Messages rejetés, par motif
+        self._rejected = dict.fromkeys(REJECT_REASONS, 0)
+        # Durées de validation des messages et de création des RRD ; les
+        # étapes suivantes sont mesurées par RRDtool et par les seuils
+        self.timings = Timings(self.clock.seconds, ("parse", "create"))
 
 
     def connectionInitialized(self):
@@ -59,8 +124,9 @@ class BusToRRDtool(MessageHandler):
         c'est-à-dire lorsque la connexion a réussi et que les échanges
         initiaux (handshakes) sont terminés.
         """
-        # On réinitialise le compteur à chaque connexion établie avec succès.
+        # On réinitialise les compteurs à chaque connexion établie avec succès.
         self._illegal_updates = 0
+        self._rejected = dict.fromkeys(REJECT_REASONS, 0)
 
 
     def processMessage(self, msg):
@@ -75,57 +141,367 @@ class BusToRRDtool(MessageHandler):
         @param msg: Message à transmettre
         @type msg: C{dict}
         """
-        d = self._parse_message(msg)
-        d.addCallback(self.rrdtool.createIfNeeded)
+        if self._spooling():
+            return self._spoolMessage(msg)
+        if self.batch_size > 1:
+            # Regroupement avec les messages reçus en même temps
+            d = defer.Deferred()
+            self._batch.append((msg, d))
+            if len(self._batch) >= self.batch_size:
+                self._flushBatch()
+            elif self._batch_call is None:
+                self._batch_call = self.clock.callLater(0, self._flushBatch)
+            d.addBoth(self._checkQueue)
+            return d
+        started = self.clock.seconds()
+        reason = self._check(msg)
+        if reason is None:
+            isinconf = self.confdb.known_host(msg["host"])
+            if isinconf is False:
+                reason = REJECT_NOT_IN_CONF
+        self.timings.record("parse", started)
+        if reason is not None:
+            self._reject(reason, msg)
+            return defer.succeed(None)
+        if isinconf is None:
+            # Configuration pas encore chargée en mémoire
+            d = self._check_host(msg)
+        else:
+            d = defer.succeed(msg)
+        d.addCallback(self._createIfNeeded)
         d.addCallback(self._check_has_thresholds)
         d.addCallback(self.rrdtool.processMessage)
         d.addCallback(self._check_thresholds)
         d.addErrback(self._eb)
+        self._checkQueue()
+        d.addBoth(self._checkQueue)
+        return d
+
+
+    def _checkQueue(self, result=None):
+        """
+        Suspend la réception des messages lorsque la file d'attente de
+        RRDTool dépasse C{high_watermark}, et la reprend lorsqu'elle
+        redescend sous C{low_watermark}. Appelé à la réception et à la fin
+        du traitement de chaque message, et périodiquement tant que la
+        réception est suspendue : la file peut se vider sans qu'aucun
+        message ne soit en cours (vérifications de seuils, par exemple).
+        """
+        queued = self.rrdtool.queued
+        if queued > self._max_queued:
+            self._max_queued = queued
+        if self.high_watermark is None:
+            return result
+        # QueueSubscriber, enregistré par subscribe()
+        producer = getattr(self, "producer", None)
+        if producer is None:
+            return result
+        if not self._throttled and queued >= self.high_watermark:
+            self._throttled = True
+            self._throttle_count += 1
+            LOGGER.info(_("%d RRDtool commands waiting, pausing message "
+                          "consumption"), queued)
+            producer.pauseProducing()
+            self._queue_check = task.LoopingCall(self._checkQueue)
+            self._queue_check.clock = self.clock
+            self._queue_check.start(self.queue_check_interval, now=False)
+        elif self._throttled and queued <= self.low_watermark:
+            self._throttled = False
+            self._stopQueueCheck()
+            LOGGER.info(_("%d RRDtool commands waiting, resuming message "
+                          "consumption"), queued)
+            producer.resumeProducing()
+        return result
+
+
+    def _stopQueueCheck(self):
+        if self._queue_check is not None:
+            if self._queue_check.running:
+                self._queue_check.stop()
+            self._queue_check = None
+
+
+    def _spooling(self):
+        """
+        Vrai si les messages doivent être mis en attente sur disque : RRDTool
+        ne suit plus, ou des messages sont déjà en attente (l'ordre de
+        réception doit être conservé).
+        """
+        if self.spool is None:
+            return False
+        if self.spool.pending or self.spool.replaying:
+            return True
+        if self.rrdtool.latency > self.spool_latency:
+            LOGGER.warning(_("RRDtool is too slow (%.1fs), spooling "
+                             "messages to disk"), self.rrdtool.latency)
+            return True
+        return False
+
+
+    def _spoolMessage(self, msg):
+        """
+        Met un message en attente sur disque : il est acquitté tout de
+        suite, et sera traité au rejeu (voir L{_checkSpool}).
+        """
+        reason = self._check(msg)
+        if reason is None and self.confdb.known_host(msg["host"]) is False:
+            reason = REJECT_NOT_IN_CONF
+        if reason is not None:
+            self._reject(reason, msg)
+            return defer.succeed(None)
+        self.spool.append(msg)
+        return defer.succeed(None)
+
+
+    def _checkSpool(self):
+        """
+        Rejoue les messages en attente sur disque si RRDTool suit de
+        nouveau. Le rejeu est suspendu si la latence remonte.
+        """
+        if (not self.spool.pending or self.spool.replaying
+                or self.rrdtool.latency > self.spool_latency):
+            return
+        LOGGER.info(_("Replaying %d spooled messages"), self.spool.pending)
+        def proceed():
+            # Interrompu à l'arrêt du connecteur ou si la latence remonte
+            return (self._spool_check is not None and
+                    self.rrdtool.latency <= self.spool_latency)
+        d = self.spool.replay(self.processBatch, self.spool_replay_size,
+                              proceed=proceed)
+        def done(complete):
+            if complete:
+                LOGGER.info(_("All spooled messages have been replayed"))
+        def eb(f):
+            LOGGER.error(_("Error while replaying spooled messages: %s"),
+                         f.getErrorMessage())
+        d.addCallbacks(done, eb)
         return d
 
 
-    def _parse_message(self, msg):
+    def _check(self, msg):
+        """
+        Vérifie le format d'un message en une seule passe, sans construire
+        de message d'erreur. La valeur numérique est conservée dans
+        C{msg["float_value"]} pour les traitements suivants.
+
+        @return: le motif de rejet du message, ou C{None} s'il est valide
+        @rtype: C{str}
+        """
         if msg["type"] != 'perf':
+            return REJECT_WRONG_TYPE
+        try:
+            value = msg["value"]
+            timestamp = msg["timestamp"]
+            msg["host"], msg["datasource"]
+        except KeyError:
+            return REJECT_INVALID
+        try:
+            float(timestamp)
+        except (TypeError, ValueError):
+            return REJECT_INVALID
+        if value == u"U" or value == "":
+            msg["value"] = u"U"
+            msg["float_value"] = None
+        else:
+            try:
+                msg["float_value"] = float(value)
+            except ValueError:
+                return REJECT_INVALID
+        return None
+
+
+    def _error(self, reason, msg):
+        """Construit l'exception correspondant au motif de rejet"""
+        if reason == REJECT_WRONG_TYPE:
             errormsg = _("'%(msgtype)s' is not a valid message type for "
                          "metrology")
-            return defer.fail(WrongMessageType((
+            return WrongMessageType((
                     errormsg % {'msgtype' : msg["type"]}
-                ).encode('utf-8')))
-
-        for i in 'timestamp', 'value', 'host', 'datasource':
+                ).encode('utf-8'))
+        if reason == REJECT_NOT_IN_CONF:
+            return NotInConfiguration((
+                    _("Skipping perf update for host %s") % msg["host"]
+                ).encode('utf-8'))
+        for i in REQUIRED_KEYS:
             if i not in msg:
                 errormsg = _(u"Not a valid performance message (missing "
                               "'%(tag)s' tag)")
-                return defer.fail(InvalidMessage((
+                return InvalidMessage((
                         errormsg % {"tag": i}
-                    ).encode('utf-8')))
-
-        if msg["value"] == "":
-            msg["value"] = u"U"
-        if msg["value"] != u"U":
-            try:
-                float(msg["value"])
-            except ValueError:
-                return defer.fail(InvalidMessage((
-                        _("Invalid metrology value for datasource %(ds)s "
-                          "on host %(host)s: %(value)s") % {
-                            'value': msg["value"],
-                            'ds': msg['datasource'],
-                            'host': msg['host'],
-                          }
-                    ).encode('utf-8')))
-
+                    ).encode('utf-8'))
+        try:
+            float(msg["timestamp"])
+        except (TypeError, ValueError):
+            return InvalidMessage((
+                    _("Invalid timestamp for datasource %(ds)s on host "
+                      "%(host)s: %(timestamp)s") % {
+                        'timestamp': msg["timestamp"],
+                        'ds': msg['datasource'],
+                        'host': msg['host'],
+                      }
+                ).encode('utf-8'))
+        return InvalidMessage((
+                _("Invalid metrology value for datasource %(ds)s "
+                  "on host %(host)s: %(value)s") % {
+                    'value': msg["value"],
+                    'ds': msg['datasource'],
+                    'host': msg['host'],
+                  }
+            ).encode('utf-8'))
+
+
+    def _reject(self, reason, msg):
+        """
+        Rejette un message : le compteur du motif est incrémenté, et le
+        message de journalisation n'est construit que s'il sera affiché.
+        """
+        self._rejected[reason] += 1
+        if reason == REJECT_INVALID:
+            if LOGGER.isEnabledFor(logging.ERROR):
+                LOGGER.error(str(self._error(reason, msg)))
+            return
+        # Messages qui ne nous sont pas destinés : non comptés
+        self._messages_received -= 1
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(str(self._error(reason, msg)))
+
+
+    def _check_host(self, msg):
         d = self.confdb.has_host(msg["host"])
         def cb(isinconf, msg):
             if not isinconf:
-                return defer.fail(NotInConfiguration((
-                        _("Skipping perf update for host %s") % msg["host"]
-                    ).encode('utf-8')))
+                return defer.fail(self._error(REJECT_NOT_IN_CONF, msg))
             return msg
         d.addCallback(cb, msg)
         return d
 
 
+    def _flushBatch(self):
+        if self._batch_call is not None:
+            if self._batch_call.active():
+                self._batch_call.cancel()
+            self._batch_call = None
+        batch = self._batch
+        self._batch = []
+        d = self.processBatch([msg for msg, dummy_d in batch])
+        self._checkQueue()
+        def ack(result):
+            # Les erreurs connues ont déjà été traitées : sauf erreur
+            # inattendue, tous les messages du lot sont acquittés.
+            for dummy_msg, msg_d in batch:
+                if isinstance(result, Failure):
+                    msg_d.errback(result)
+                else:
+                    msg_d.callback(None)
+        d.addBoth(ack)
+        return d
+
+
+    def processBatch(self, messages):
+        """
+        Transmet à RRDtool un lot de messages reçus du bus.
+
+        Les messages sont validés en une passe, puis regroupés par
+        indicateur : le fichier RRD est créé au besoin une seule fois, les
+        valeurs sont écrites en une seule commande, et les seuils sont
+        vérifiés sur la dernière valeur seulement.
+
+        @param messages: Messages à transmettre
+        @type  messages: C{list}
+        @return: Deferred déclenché une fois tout le lot traité
+        @rtype: C{Deferred}
+        """
+        valid = []
+        started = self.clock.seconds()
+        for msg in messages:
+            reason = self._check(msg)
+            if reason is None:
+                valid.append(msg)
+            else:
+                self._reject(reason, msg)
+            started = self.timings.record("parse", started)
+        known = self.confdb.known_hosts()
+        if known is not None:
+            d = defer.succeed(known)
+        else:
+            hosts = list(set([msg["host"] for msg in valid]))
+            d = defer.gatherResults([self.confdb.has_host(h) for h in hosts])
+            d.addCallback(lambda results: frozenset(
+                    [h for h, isinconf in zip(hosts, results) if isinconf]))
+        def group(known):
+            groups = {}
+            for msg in valid:
+                if msg["host"] not in known:
+                    self._reject(REJECT_NOT_IN_CONF, msg)
+                    continue
+                key = (msg["host"], msg["datasource"])
+                groups.setdefault(key, []).append(msg)
+            # Les erreurs sont traitées par indicateur (voir _groupFailed)
+            return defer.DeferredList([self._processGroup(msgs)
+                                       for msgs in groups.itervalues()])
+        d.addCallback(group)
+        d.addCallback(lambda _x: None)
+        return d
+
+
+    def _processGroup(self, msgs):
+        """Traite les messages d'un même indicateur"""
+        # tri stable : à horodatage égal, l'ordre d'arrivée est conservé
+        msgs.sort(key=lambda msg: float(msg["timestamp"]))
+        d = self._createIfNeeded(msgs[0])
+        d.addCallback(self._check_has_thresholds)
+        def propagate(perf):
+            for msg in msgs[1:]:
+                msg["has_thresholds"] = perf["has_thresholds"]
+            return msgs
+        d.addCallback(propagate)
+        d.addCallback(self.rrdtool.processMessages)
+        def check(results):
+            written = []
+            for success, result in results:
+                if success:
+                    written.append(result)
+                else:
+                    self._eb(result)
+            if not written or written[-1] is None:
+                return None
+            # Seule la dernière valeur écrite importe pour l'état ; les
+            # précédentes servent au calcul des taux entre échantillons
+            # consécutifs.
+            if (self.threshold_checker is not None
+                    and written[-1]["has_thresholds"]):
+                for perf in written[:-1]:
+                    if perf is not None:
+                        self.threshold_checker.rememberSample(perf)
+            return self._check_thresholds(written[-1])
+        def fail(f):
+            # Même traitement que si les messages avaient été reçus un par un
+            for dummy_msg in msgs:
+                self._eb(f)
+        d.addCallbacks(check, fail)
+        d.addErrback(self._groupFailed, msgs)
+        return d
+
+
+    def _groupFailed(self, f, msgs):
+        """
+        Erreur inattendue lors du traitement des messages d'un indicateur :
+        seuls ces messages sont rejetés, le reste du lot n'est pas affecté.
+        """
+        self._rejected[REJECT_INVALID] += len(msgs)
+        LOGGER.error(_("Could not process %(count)d messages for datasource "
+                       "%(ds)s on host %(host)s: %(msg)s"), {
+                        'count': len(msgs),
+                        'ds': msgs[0]['datasource'],
+                        'host': msgs[0]['host'],
+                        'msg': f.getErrorMessage(),
+                     })
+
+
+    def _createIfNeeded(self, msg):
+        return self.timings.call("create", self.rrdtool.createIfNeeded, msg)
+
+
     def _check_has_thresholds(self, perf):
         """Ajoute au message l'information de la présence d'un seuil"""
         if perf is None:
@@ -149,11 +525,16 @@ class BusToRRDtool(MessageHandler):
                            NotInConfiguration, CreationError, RRDToolError)
         error_msg = f.getErrorMessage()
         if err_class == InvalidMessage:
+            self._rejected[REJECT_INVALID] += 1
             LOGGER.error(error_msg)
         elif (err_class == NotInConfiguration or
               err_class == WrongMessageType):
+            if err_class == NotInConfiguration:
+                self._rejected[REJECT_NOT_IN_CONF] += 1
+            else:
+                self._rejected[REJECT_WRONG_TYPE] += 1
             self._messages_received -= 1
-            #LOGGER.debug(str(f.value))
+            LOGGER.debug(error_msg)
         elif err_class == RRDToolError:
             # Le message de rrdtool ne dépend pas de la locale,
             # donc on peut faire ce test sans crainte.
@@ -175,11 +556,45 @@ class BusToRRDtool(MessageHandler):
         ds_count = yield self.confdb.count_datasources()
         stats["pds_count"] = ds_count
         stats["illegal_updates"] = self._illegal_updates
+        stats.update(self._rejected)
+        # Profondeur de la file d'attente de RRDTool : actuelle, et maximum
+        # depuis le relevé précédent
+        stats["rrd_queued"] = self.rrdtool.queued
+        stats["rrd_queued_max"] = max(self._max_queued, stats["rrd_queued"])
+        self._max_queued = 0
+        if self.high_watermark is not None:
+            stats["throttled"] = int(self._throttled)
+            stats["throttle_count"] = self._throttle_count
+        if self.spool is not None:
+            stats["spool_pending"] = self.spool.pending
+            stats["spool_replayed"] = self.spool.replayed
+            stats["spool_dropped"] = self.spool.dropped
+        # Durées de chaque étape du traitement, et des commandes RRDTool
+        stats.update(self.timings.getStats())
+        stats.update(self.rrdtool.getStats())
+        if self.threshold_checker is not None:
+            stats.update(self.threshold_checker.getStats())
         defer.returnValue(stats)
 
 
     def startService(self):
+        if self.spool is not None:
+            self.spool.open()
+            self._spool_check = task.LoopingCall(self._checkSpool)
+            self._spool_check.clock = self.clock
+            self._spool_check.start(self.spool_check_interval, now=False)
         return self.rrdtool.start()
 
     def stopService(self):
-        return self.rrdtool.stop()
+        self._stopQueueCheck()
+        if self._spool_check is not None:
+            self._spool_check.stop()
+            self._spool_check = None
+        if self.spool is not None:
+            d = defer.maybeDeferred(self.spool.close)
+        else:
+            d = defer.succeed(None)
+        if self._batch:
+            d.addCallback(lambda _x: self._flushBatch())
+        d.addCallback(lambda _x: self.rrdtool.stop())
+        return d
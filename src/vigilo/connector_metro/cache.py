@@ -0,0 +1,53 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache en mémoire de taille bornée.
+"""
+
+from collections import OrderedDict
+
+
+
+class LRUCache(object):
+    """
+    Dictionnaire de taille bornée : lorsque la taille maximale est atteinte,
+    l'entrée utilisée le moins récemment est supprimée.
+    """
+
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+
+    def clear(self):
+        self._data.clear()
@@ -11,71 +11,216 @@ from __future__ import absolute_import
 
 from twisted.internet import defer
 
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__, silent_load=True)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
 from vigilo.connector.conffile import ConfDB
 
+from vigilo.connector_metro.supervisor import host_shard
+from vigilo.connector_metro.threshold import parse_threshold
+
+
+DS_PROPERTIES = ["id", "type", "PDP_step", "heartbeat",
+                 "min", "max",
+                 "factor",
+                 "warning_threshold", "critical_threshold",
+                 "nagiosname", "ventilation"]
+RRA_PROPERTIES = ["type", "xff", "RRA_step", "rows"]
+# Propriétés comparées lors d'un rechargement
+DS_COMPARED = DS_PROPERTIES[1:] + ["create_template"]
+
 
 
 class MetroConfDB(ConfDB):
     """
     Accès à la configuration du connector-metro fournie par VigiConf (dans une
     base SQLite)
+
+    À chaque rechargement, l'ensemble de la configuration est chargé en
+    mémoire : les indicateurs sont indexés par (hôte, nom) avec leurs RRA.
+    Tant que l'index n'est pas disponible, les requêtes sont faites
+    directement dans la base. Lors d'un rechargement, l'ancien index reste
+    utilisé jusqu'à ce que le nouveau soit prêt, et les indicateurs inchangés
+    sont conservés tels quels.
+
+    En mode multi-processus, seuls les hôtes de la partition du processus
+    sont visibles (voir L{vigilo.connector_metro.supervisor}).
     """
 
 
-    def __init__(self, path):
+    def __init__(self, path, shard=None):
+        """
+        @param shard: partition du processus : couple (numéro, nombre de
+            partitions), ou C{None} pour traiter tous les hôtes
+        @type  shard: C{tuple}
+        """
         super(MetroConfDB, self).__init__(path)
-        self._cache = {"hosts": None, "has_threshold": None, "ds": {}}
+        self.shard = shard
+        self._index = None
+        self._index_callbacks = []
+
+
+    def registerIndexCallback(self, callback):
+        """
+        Enregistre une fonction appelée à chaque fois que la configuration a
+        été chargée en mémoire, avec en argument les changements par rapport
+        à la configuration précédente (L{ConfigurationDiff}).
+        """
+        self._index_callbacks.append(callback)
 
 
     def _rebuild_cache(self):
-        self._cache["hosts"] = None
-        self._cache["has_threshold"] = None
-        self._cache["ds"] = {}
-        self.get_hosts()
-        self.list_thresholds()
+        if self._db is None:
+            self._index = None
+            return defer.succeed(None)
+        # L'ancien index continue de répondre pendant le chargement
+        result = self._db.runInteraction(self._load_index, self._index)
+        def set_index(result):
+            index, diff = result
+            self._index = index
+            LOGGER.info(_("Configuration loaded: %(added)d datasources "
+                          "added, %(removed)d removed, %(changed)d changed"),
+                        {"added": len(diff.added),
+                         "removed": len(diff.removed),
+                         "changed": len(diff.changed)})
+            for callback in self._index_callbacks:
+                try:
+                    callback(diff)
+                except Exception as e:
+                    LOGGER.exception(_("Error in configuration reload "
+                                       "callback: %s"), e)
+            return index
+        def failed(f):
+            # On garde volontairement l'index précédent (éventuellement
+            # aucun) : mieux vaut une configuration périmée que pas de
+            # configuration du tout
+            LOGGER.error(_("Could not load the configuration, keeping the "
+                           "previous one: %s"), f.getErrorMessage())
+            return self._index
+        result.addCallbacks(set_index, failed)
+        return result
+
+
+    def _load_index(self, txn, previous=None):
+        """
+        Charge toute la configuration en deux requêtes (exécuté dans un
+        thread par adbapi), et la compare à l'index précédent.
+
+        @param previous: l'index précédent, dont les indicateurs inchangés
+            sont réutilisés
+        @type  previous: C{dict}
+        @return: le nouvel index et les changements
+        @rtype: C{tuple}
+        """
+        index = {"ds": {}, "hosts": {}, "rras": {}, "hostnames": frozenset()}
+        # Arguments de création des RRD partagés par tous les indicateurs
+        # ayant le même profil (pas, RRA, type, heartbeat, bornes)
+        profiles = {}
+        # Chaînes et RRA identiques partagés entre les indicateurs
+        strings = {}
+        ranges = {}
+        rra_rows = {}
+        # Pas de conversion en UTF-8 : les noms reçus du bus sont en unicode.
+        txn.execute("SELECT idperfdatasource, name, hostname, %s "
+                    "FROM perfdatasource" % ", ".join(DS_PROPERTIES[1:]))
+        for row in txn.fetchall():
+            if not self.owns(row[2]):
+                continue
+            ds = format_datasource(row[:1] + row[3:], row[1], row[2],
+                                   strings, ranges)
+            index["ds"][(ds["hostname"], ds["name"])] = ds
+            index["hosts"].setdefault(ds["hostname"], []).append(ds["name"])
+            index["rras"][ds["id"]] = []
+        txn.execute("SELECT pdsrra.idperfdatasource, %s FROM rra "
+                    "LEFT JOIN pdsrra ON pdsrra.idrra = rra.idrra "
+                    'ORDER BY "order" ASC, rra.idrra ASC'
+                    % ", ".join(RRA_PROPERTIES))
+        for row in txn.fetchall():
+            rras = index["rras"].get(unicode(row[0]))
+            if rras is None:
+                continue
+            rra = rra_rows.get(row[1:])
+            if rra is None:
+                rra = rra_rows[row[1:]] = format_rra(row[1:])
+            rras.append(rra)
+        for ds in index["ds"].itervalues():
+            template = create_template(ds, index["rras"][ds["id"]])
+            ds["create_template"] = profiles.setdefault(template, template)
+        index["hostnames"] = frozenset(index["hosts"])
+        if previous is None:
+            return (index, ConfigurationDiff(added=set(index["ds"])))
+        return (index, diff_index(previous, index))
+
+
+    def owns(self, hostname):
+        """Vrai si l'hôte appartient à la partition de ce processus"""
+        if self.shard is None:
+            return True
+        return host_shard(hostname, self.shard[1]) == self.shard[0]
 
 
     def get_hosts(self):
         if self._db is None:
             return defer.succeed([])
+        if self._index is not None:
+            return defer.succeed(self._index["hosts"].keys())
         result = self._db.runQuery("SELECT DISTINCT hostname FROM "
                                    "perfdatasource")
         # Pas de conversion en UTF-8 : has_host() attend de l'unicode.
-        result.addCallback(lambda results: [r[0] for r in results])
-        def cache_hosts(hosts):
-            self._cache["hosts"] = hosts
-            return hosts
-        result.addCallback(cache_hosts)
-        return result
-
-
-    def list_thresholds(self):
-        if self._db is None:
-            return defer.succeed(None)
-        result = self._db.runQuery("SELECT hostname, name, type FROM perfdatasource "
-                                   "WHERE warning_threshold IS NOT NULL "
-                                   "AND critical_threshold IS NOT NULL")
-        # Pas de conversion en UTF-8 : has_threshold() attend de l'unicode.
-        def cache_thresholds(results):
-            self._cache["has_threshold"] = dict( ((r[0], r[1]), r[2]) for r in results )
-        result.addCallback(cache_thresholds)
+        result.addCallback(lambda results: [r[0] for r in results
+                                            if self.owns(r[0])])
         return result
 
 
     def has_host(self, hostname):
-        if self._db is None:
+        if self._db is None or not self.owns(hostname):
             return defer.succeed(False)
-        if self._cache["hosts"] is not None:
-            return defer.succeed(hostname in self._cache["hosts"])
+        if self._index is not None:
+            return defer.succeed(hostname in self._index["hosts"])
         result = self._db.runQuery("SELECT COUNT(*) FROM perfdatasource "
                                    "WHERE hostname = ?", (hostname,) )
         result.addCallback(lambda results: bool(results[0][0]))
         return result
 
 
-    def get_host_datasources(self, hostname):
+    def known_hosts(self):
+        """
+        Retourne l'ensemble des hôtes de la configuration, sans passer par
+        un Deferred.
+
+        @return: l'ensemble des hôtes, ou C{None} si la configuration n'est
+            pas encore chargée en mémoire (utiliser alors L{has_host})
+        @rtype: C{frozenset}
+        """
         if self._db is None:
+            return frozenset()
+        if self._index is None:
+            return None
+        return self._index["hostnames"]
+
+
+    def known_host(self, hostname):
+        """
+        Version synchrone de L{has_host}.
+
+        @return: C{True} ou C{False}, ou C{None} si la configuration n'est
+            pas encore chargée en mémoire (utiliser alors L{has_host})
+        @rtype: C{bool}
+        """
+        hosts = self.known_hosts()
+        if hosts is None:
+            return None
+        return hostname in hosts
+
+
+    def get_host_datasources(self, hostname):
+        if self._db is None or not self.owns(hostname):
             return defer.succeed([])
+        if self._index is not None:
+            return defer.succeed(list(self._index["hosts"].get(hostname, [])))
         result = self._db.runQuery("SELECT name FROM perfdatasource WHERE "
                                    "hostname = ?", (hostname,))
         result.addCallback(lambda results: [unicode(r[0]) for r in results])
@@ -85,9 +230,11 @@ class MetroConfDB(ConfDB):
     def has_threshold(self, hostname, dsname):
         if self._db is None:
             return defer.succeed(False)
-        if self._cache["has_threshold"] is not None:
-            return defer.succeed(self._cache["has_threshold"].get(
-                                    (hostname, dsname), False))
+        if self._index is not None:
+            ds = self._index["ds"].get((hostname, dsname))
+            if ds is None or not ds["has_threshold"]:
+                return defer.succeed(False)
+            return defer.succeed(ds["type"])
         result = self._db.runQuery("SELECT type FROM perfdatasource "
                                    "WHERE hostname = ? AND name = ? "
                                    "AND (warning_threshold IS NOT NULL "
@@ -99,62 +246,308 @@ class MetroConfDB(ConfDB):
 
 
     def get_datasource(self, hostname, dsname, cache=False):
-        properties = ["id", "type", "PDP_step", "heartbeat",
-                      "min", "max",
-                      "factor",
-                      "warning_threshold", "critical_threshold",
-                      "nagiosname", "ventilation"]
+        """
+        Retourne la description d'un indicateur (L{DataSource}).
+
+        @param cache: conservé pour compatibilité, la configuration étant
+            désormais toujours chargée en mémoire.
+        """
         if self._db is None:
-            return defer.succeed(dict([(p, None) for p in properties]))
-        if cache and (hostname, dsname) in self._cache["ds"]:
-            return defer.succeed(self._cache["ds"][(hostname, dsname)])
+            return defer.succeed(DataSource())
+        if self._index is not None:
+            try:
+                return defer.succeed(self._index["ds"][(hostname, dsname)])
+            except KeyError:
+                return defer.fail(KeyError("No such datasource %s on host %s"
+                                           % (dsname, hostname)))
         result = self._db.runQuery(
                 "SELECT idperfdatasource, %s FROM perfdatasource WHERE "
-                "name = ? AND hostname = ?" % ", ".join(properties[1:]),
+                "name = ? AND hostname = ?" % ", ".join(DS_PROPERTIES[1:]),
                 (dsname, hostname) )
-        def format_result(result, properties):
+        def format_result(result):
             if not result:
                 raise KeyError("No such datasource %s on host %s"
                                % (dsname, hostname))
-            d = {}
-            for propindex, propname in enumerate(properties):
-                d[propname] = unicode(result[0][propindex])
-                if (propname == "min" or propname == "max") \
-                        and d[propname] == 'None': # hum hum...
-                    d[propname] = "U"
-            d["name"] = dsname
-            d["hostname"] = hostname
-            if cache:
-                self._cache["ds"][(d["hostname"], d["name"])] = d
-            return d
-        result.addCallback(format_result, properties)
+            return format_datasource(result[0], dsname, hostname)
+        result.addCallback(format_result)
         return result
 
 
     def get_rras(self, dsid):
         if self._db is None:
             return defer.succeed([])
-        properties = ["type", "xff", "RRA_step", "rows"]
+        if self._index is not None:
+            return defer.succeed(self._index["rras"].get(unicode(dsid), []))
         result = self._db.runQuery("SELECT %s FROM rra "
                     "LEFT JOIN pdsrra ON pdsrra.idrra = rra.idrra "
                     "WHERE pdsrra.idperfdatasource = ? "
                     'ORDER BY "order" ASC'
-                    % ", ".join(properties), (dsid,) )
-        def format_result(rows, properties):
-            rras = []
-            for row in rows:
-                rra = {}
-                for propindex, propname in enumerate(properties):
-                    rra[propname] = unicode(row[propindex])
-                rras.append(rra)
+                    % ", ".join(RRA_PROPERTIES), (dsid,) )
+        result.addCallback(lambda rows: [format_rra(row) for row in rows])
+        return result
+
+
+    def get_create_template(self, hostname, dsname):
+        """
+        Retourne les arguments de la commande C{create} de RRDTool pour cet
+        indicateur, à l'exception de la date de début (C{--start}).
+
+        @return: Deferred contenant un tuple d'arguments, ou un échec
+            C{KeyError} si l'indicateur n'existe pas
+        @rtype: C{Deferred}
+        """
+        if self._db is None:
+            return defer.fail(KeyError("No such datasource %s on host %s"
+                                       % (dsname, hostname)))
+        if self._index is not None:
+            try:
+                ds = self._index["ds"][(hostname, dsname)]
+            except KeyError:
+                return defer.fail(KeyError("No such datasource %s on host %s"
+                                           % (dsname, hostname)))
+            return defer.succeed(ds["create_template"])
+        result = self.get_datasource(hostname, dsname)
+        def add_rras(ds):
+            rras = self.get_rras(ds["id"])
+            rras.addCallback(lambda rras: create_template(ds, rras))
             return rras
-        result.addCallback(format_result, properties)
+        result.addCallback(add_rras)
+        return result
+
+
+    def list_datasources(self):
+        """
+        Retourne la liste de tous les indicateurs de la configuration.
+
+        @return: Deferred contenant une liste de couples (hôte, indicateur)
+        @rtype: C{Deferred}
+        """
+        if self._db is None:
+            return defer.succeed([])
+        if self._index is not None:
+            return defer.succeed(self._index["ds"].keys())
+        result = self._db.runQuery("SELECT hostname, name FROM perfdatasource")
+        result.addCallback(lambda rows: [(r[0], r[1]) for r in rows
+                                         if self.owns(r[0])])
         return result
 
 
     def count_datasources(self):
         if self._db is None:
             return defer.succeed(0)
+        if self._index is not None:
+            return defer.succeed(len(self._index["ds"]))
+        if self.shard is not None:
+            result = self.list_datasources()
+            result.addCallback(len)
+            return result
         result = self._db.runQuery("SELECT COUNT(*) FROM perfdatasource")
         result.addCallback(lambda r: r[0][0])
         return result
+
+
+
+class DataSource(object):
+    """
+    Description d'un indicateur.
+
+    La configuration peut compter des centaines de milliers d'indicateurs :
+    chacun est un objet à attributs fixes (C{__slots__}) plutôt qu'un
+    dictionnaire, avec des types natifs pour le pas, le heartbeat et le
+    facteur, et les seuils déjà analysés (C{warning_range} et
+    C{critical_range}, voir L{vigilo.connector_metro.threshold.Threshold}).
+    Les attributs restent accessibles comme les clés d'un dictionnaire
+    (C{ds["type"]}).
+    """
+
+    __slots__ = tuple(DS_PROPERTIES) + ("name", "hostname", "has_threshold",
+                                        "warning_range", "critical_range",
+                                        "create_template")
+
+
+    def __init__(self, **props):
+        for propname in self.__slots__:
+            setattr(self, propname, props.pop(propname, None))
+        if props:
+            raise TypeError("Unknown datasource properties: %s"
+                            % ", ".join(props))
+
+
+    def __getitem__(self, propname):
+        try:
+            return getattr(self, propname)
+        except (AttributeError, TypeError):
+            raise KeyError(propname)
+
+    def __setitem__(self, propname, value):
+        if propname not in self.__slots__:
+            raise KeyError(propname)
+        setattr(self, propname, value)
+
+    def __contains__(self, propname):
+        return propname in self.__slots__
+
+    def get(self, propname, default=None):
+        try:
+            return self[propname]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.__slots__)
+
+
+    def _values(self):
+        return tuple(getattr(self, p) for p in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, DataSource):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        if not isinstance(other, DataSource):
+            return NotImplemented
+        return self._values() != other._values()
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return "<DataSource %s on %s>" % (self.name, self.hostname)
+
+
+
+class ConfigurationDiff(object):
+    """
+    Changements entre deux chargements de la configuration. Chaque attribut
+    est un ensemble de couples (hôte, indicateur) :
+     - C{added} : indicateurs ajoutés (fichiers RRD à créer) ;
+     - C{removed} : indicateurs supprimés ;
+     - C{changed} : indicateurs modifiés (seuils compris).
+    """
+
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or set()
+        self.removed = removed or set()
+        self.changed = changed or set()
+
+
+def diff_index(previous, index):
+    """
+    Compare deux index de la configuration. Les indicateurs inchangés du
+    nouvel index sont remplacés par ceux de l'ancien, déjà en mémoire.
+
+    @rtype: L{ConfigurationDiff}
+    """
+    diff = ConfigurationDiff()
+    old_ds = previous["ds"]
+    new_ds = index["ds"]
+    diff.removed = set(old_ds) - set(new_ds)
+    for key, ds in new_ds.iteritems():
+        old = old_ds.get(key)
+        if old is None:
+            diff.added.add(key)
+        elif old == ds:
+            new_ds[key] = old
+        else:
+            # L'identifiant peut changer sans que l'indicateur change
+            if [old[p] for p in DS_COMPARED] != [ds[p] for p in DS_COMPARED]:
+                diff.changed.add(key)
+    return diff
+
+
+def format_datasource(row, dsname, hostname, strings=None, ranges=None):
+    """
+    Construit l'objet L{DataSource} décrivant un indicateur à partir d'une
+    ligne de la table perfdatasource (colonnes de L{DS_PROPERTIES}).
+
+    Les seuils sont analysés ici : un seuil invalide est signalé une fois
+    pour toutes, et l'indicateur est alors traité comme s'il n'avait pas
+    de seuils.
+
+    @param strings: chaînes déjà rencontrées, pour partager une seule copie
+        de chaque valeur (type, seuils, noms...) entre les indicateurs
+    @type  strings: C{dict}
+    @param ranges: seuils déjà analysés, indexés par leur description
+    @type  ranges: C{dict}
+    """
+    if strings is None:
+        strings = {}
+    if ranges is None:
+        ranges = {}
+    def share(value):
+        if value is None:
+            return None
+        value = unicode(value)
+        return strings.setdefault(value, value)
+    def compile_range(threshold):
+        result = ranges.get(threshold)
+        if result is None:
+            result = ranges[threshold] = parse_threshold(threshold)
+        return result
+    (dsid, ds_type, step, heartbeat, ds_min, ds_max, factor,
+     warning, critical, nagiosname, ventilation) = row
+    ds = DataSource(
+        id=unicode(dsid),
+        type=share(ds_type),
+        PDP_step=int(step),
+        heartbeat=int(heartbeat),
+        # min et max peuvent être vides : valeur inconnue pour RRDTool
+        min=(u"U" if ds_min is None else share(ds_min)),
+        max=(u"U" if ds_max is None else share(ds_max)),
+        factor=(1.0 if factor is None else float(factor)),
+        warning_threshold=share(warning),
+        critical_threshold=share(critical),
+        nagiosname=share(nagiosname),
+        ventilation=share(ventilation),
+        name=share(dsname),
+        hostname=share(hostname),
+        has_threshold=(warning is not None and critical is not None),
+        )
+    if ds.has_threshold:
+        try:
+            ds.warning_range = compile_range(ds.warning_threshold)
+            ds.critical_range = compile_range(ds.critical_threshold)
+        except ValueError as e:
+            LOGGER.warning(_("Invalid thresholds for datasource %(ds)s on "
+                             "host %(host)s (warning: %(warning)s, critical: "
+                             "%(critical)s): %(error)s. The thresholds will "
+                             "not be checked."),
+                           {"ds": dsname, "host": hostname,
+                            "warning": warning, "critical": critical,
+                            "error": e})
+            ds.warning_range = ds.critical_range = None
+            ds.has_threshold = False
+    return ds
+
+
+def create_template(ds, rras):
+    """
+    Construit les arguments de la commande C{create} de RRDTool, sauf la
+    date de début, pour un indicateur et ses RRA.
+
+    @rtype: C{tuple}
+    """
+    rrd_cmd = ["--step", str(ds["PDP_step"])]
+    for rra in rras:
+        rrd_cmd.append("RRA:%s:%s:%s:%s" %
+                       (rra["type"], rra["xff"],
+                        rra["RRA_step"], rra["rows"]))
+    ds_type = ds["type"]
+    if ds_type.startswith('DIFF-'):
+        ds_type = ds_type[5:]
+    rrd_cmd.append("DS:DS:%s:%s:%s:%s" %
+                   (ds_type, ds["heartbeat"], ds["min"], ds["max"]))
+    return tuple(rrd_cmd)
+
+
+def format_rra(row):
+    """
+    Construit le dictionnaire décrivant un RRA à partir d'une ligne de la
+    table rra (colonnes de L{RRA_PROPERTIES}).
+    """
+    rra = {}
+    for propindex, propname in enumerate(RRA_PROPERTIES):
+        rra[propname] = unicode(row[propindex])
+    return rra
@@ -0,0 +1,198 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mesure des durées de traitement.
+
+Les durées sont réparties dans des histogrammes à la manière de
+HdrHistogram : la précision relative est constante quelle que soit la durée
+(de la microseconde à plusieurs minutes), pour un coût d'enregistrement
+constant et une mémoire proportionnelle au nombre d'intervalles réellement
+utilisés.
+"""
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+
+
+
+class LatencyHistogram(object):
+    """
+    Histogramme de durées, en microsecondes.
+
+    Les valeurs inférieures à 2^C{sub_bits} sont comptées une à une ; au-delà,
+    chaque puissance de deux est découpée en 2^(C{sub_bits}-1) intervalles,
+    soit une erreur relative inférieure à 2^(1-C{sub_bits}) (3% par défaut).
+    """
+
+
+    def __init__(self, sub_bits=6):
+        self.sub_bits = sub_bits
+        self._sub_count = 1 << sub_bits
+        self._counts = {}
+        self.count = 0
+        self.max = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def record(self, seconds):
+        """
+        Enregistre une durée.
+
+        @param seconds: la durée, en secondes
+        @type  seconds: C{float}
+        """
+        value = int(seconds * 1000000)
+        if value < self._sub_count:
+            if value < 0:
+                value = 0
+            index = value
+        else:
+            shift = value.bit_length() - self.sub_bits
+            index = (shift << (self.sub_bits - 1)) + (value >> shift)
+        counts = self._counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+
+    def _highest(self, index):
+        """Plus grande valeur (en microsecondes) comptée dans l'intervalle"""
+        if index < self._sub_count:
+            return index
+        shift = (index >> (self.sub_bits - 1)) - 1
+        mantissa = index - (shift << (self.sub_bits - 1))
+        return ((mantissa + 1) << shift) - 1
+
+
+    def percentile(self, percent):
+        """
+        @param percent: le centile souhaité (entre 0 et 100)
+        @type  percent: C{float}
+        @return: la durée (en secondes) en-dessous de laquelle se trouvent
+            C{percent}% des valeurs enregistrées, 0 si l'histogramme est vide
+        @rtype: C{float}
+        """
+        if not self.count:
+            return 0.0
+        target = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= target:
+                return min(self._highest(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+
+    def reset(self):
+        self._counts.clear()
+        self.count = 0
+        self.max = 0
+
+
+
+class Timings(object):
+    """
+    Ensemble d'histogrammes de durées, un par étape de traitement, et
+    nombre d'opérations par seconde depuis le relevé précédent.
+    """
+
+    # Centiles publiés dans les statistiques
+    percentiles = (50, 99)
+
+
+    def __init__(self, clock, names=()):
+        """
+        @param clock: fonction retournant l'heure courante, en secondes
+        @type  clock: C{callable}
+        @param names: étapes publiées même en l'absence de mesure (les
+            autres apparaissent à leur première mesure)
+        @type  names: C{iterable}
+        """
+        self.clock = clock
+        self._histograms = {}
+        for name in names:
+            self._histograms[name] = LatencyHistogram()
+        # Heure du relevé précédent
+        self.since = clock()
+
+
+    def __getitem__(self, name):
+        try:
+            return self._histograms[name]
+        except KeyError:
+            histogram = self._histograms[name] = LatencyHistogram()
+            return histogram
+
+
+    def record(self, name, started):
+        """
+        Enregistre la durée d'une étape.
+
+        @param started: heure de début de l'étape (voir L{clock})
+        @type  started: C{float}
+        @return: l'heure de fin, qui peut servir de début à l'étape suivante
+        @rtype: C{float}
+        """
+        now = self.clock()
+        self[name].record(now - started)
+        return now
+
+
+    def timed(self, name, d, started):
+        """
+        Enregistre la durée d'une étape asynchrone, au déclenchement du
+        Deferred C{d} (succès ou erreur).
+        """
+        def done(result):
+            self.record(name, started)
+            return result
+        d.addBoth(done)
+        return d
+
+
+    def call(self, name, func, *args):
+        """
+        Appelle C{func} en mesurant la durée de l'appel, ou du traitement
+        s'il retourne un Deferred.
+        """
+        started = self.clock()
+        result = func(*args)
+        if isinstance(result, defer.Deferred):
+            return self.timed(name, result, started)
+        self.record(name, started)
+        return result
+
+
+    def getStats(self, prefix=""):
+        """
+        Relève les mesures depuis le relevé précédent, et remet les
+        histogrammes à zéro. Pour chaque étape : nombre d'opérations et
+        nombre par seconde, centiles et maximum des durées (en
+        millisecondes).
+
+        @rtype: C{dict}
+        """
+        now = self.clock()
+        elapsed = now - self.since
+        self.since = now
+        stats = {}
+        for name, histogram in self._histograms.iteritems():
+            key = prefix + name
+            stats[key + "_count"] = histogram.count
+            if elapsed > 0:
+                stats[key + "_rate"] = round(histogram.count / elapsed, 3)
+            else:
+                stats[key + "_rate"] = 0
+            for percent in self.percentiles:
+                stats["%s_p%d" % (key, percent)] = round(
+                        histogram.percentile(percent) * 1000, 3)
+            stats[key + "_max"] = round(histogram.max / 1000.0, 3)
+            histogram.reset()
+        return stats
@@ -0,0 +1,210 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Accès direct à la bibliothèque librrd (via le module Python C{rrdtool}),
+sans passer par des sous-processus C{rrdtool -}.
+
+Les appels à la bibliothèque étant bloquants, ils sont exécutés dans un
+I{pool} de threads dédié. Les réponses sont mises en forme comme celles de
+C{rrdtool -}, pour que le reste du connecteur ne fasse pas la différence.
+"""
+
+from __future__ import absolute_import
+
+import os
+from collections import OrderedDict
+from itertools import count
+
+try:
+    import rrdtool
+except ImportError:
+    rrdtool = None
+
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__, silent_load=True)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+from vigilo.connector_metro.rrdtool import RRDToolPool, RRDToolPoolManager
+from vigilo.connector_metro.rrdtool import RRDToolError
+
+
+# Commandes pouvant être transmises au démon RRDcached
+RRDCACHED_COMMANDS = ("update", "fetch", "lastupdate", "flush")
+
+
+
+class RRDToolLibraryManager(RRDToolPoolManager):
+    """
+    Gère l'interaction avec RRDTool au travers de la bibliothèque librrd.
+    Offre la même interface que L{RRDToolPoolManager}.
+
+    La latence et le nombre de commandes en attente sont mesurés sur les
+    commandes confiées au pool de threads, comme pour les processus. Le pool
+    grandit à la demande jusqu'à C{pool_size} threads : les options propres
+    aux processus (pipeline, affinité, ajustement de la taille) ne
+    s'appliquent pas.
+    """
+
+
+    def __init__(self, rrd_base_dir, rrd_path_mode, check_thresholds=True,
+                 rrdcached=None, pool_size=None, readonly=False):
+        self.rrdcached = rrdcached
+        self.threadpool = None
+        # Commandes confiées au pool, dans l'ordre : numéro -> heure d'envoi
+        self._inflight = OrderedDict()
+        self._job_ids = count()
+        # Durée moyenne des commandes (moyenne mobile exponentielle)
+        self._latency = 0.0
+        super(RRDToolLibraryManager, self).__init__(rrd_base_dir,
+                rrd_path_mode, None, check_thresholds=check_thresholds,
+                rrdcached=rrdcached, pool_size=pool_size, readonly=readonly)
+
+
+    def createPools(self, check_thresholds, rrdcached, pool_size):
+        if pool_size is None:
+            pool_size = int(os.sysconf('SC_NPROCESSORS_ONLN'))
+        # Pas besoin de pool sans RRDcached : il suffit de ne pas passer
+        # l'option --daemon à la bibliothèque.
+        self.threadpool = ThreadPool(1, pool_size, name="librrd")
+
+
+    def checkBinary(self):
+        if rrdtool is None:
+            raise OSError(_('The "rrdtool" Python module could not be '
+                            'imported. Make sure the RRDtool Python '
+                            'bindings are installed.'))
+
+
+    def start(self):
+        if self.started:
+            return defer.succeed(None)
+        try:
+            self.ensureDirectory(self.rrd_base_dir)
+            self.checkBinary()
+        except OSError as e:
+            return defer.fail(e)
+        self.threadpool.start()
+        LOGGER.info(_("Started the librrd thread pool (%(size)d threads)"),
+                    {'size': self.threadpool.max})
+        self.started = True
+        return defer.succeed(None)
+
+
+    def stop(self):
+        if self.started:
+            self.threadpool.stop()
+            self.started = False
+        return defer.succeed(None)
+
+
+    @property
+    def latency(self):
+        """
+        Latence actuelle des commandes (en secondes) : la moyenne mobile, ou
+        l'ancienneté de la plus ancienne commande en cours si elle est plus
+        longue (threads bloqués). Nulle si le pool n'a rien à faire.
+        """
+        if not self._inflight:
+            return 0.0
+        oldest = next(self._inflight.itervalues())
+        return max(self._latency, reactor.seconds() - oldest)
+
+    @property
+    def queued(self):
+        """Nombre de commandes en attente d'un thread"""
+        return max(0, len(self._inflight) - self.threadpool.max)
+
+
+    def run(self, command, filename, args, no_rrdcached=False,
+            background=False):
+        """
+        Lance une commande par la bibliothèque librrd
+
+        @param command: le type de commande envoyée à RRDtool (C{fetch},
+            C{create}, C{update}...)
+        @type  command: C{str}
+        @param filename: le nom du fichier RRD
+        @type  filename: C{str}
+        @param args: les arguments pour la commande envoyée à RRDtool
+        @type  args: C{str} ou C{list}
+        @param background: ignoré, toutes les commandes partagent le même
+            pool de threads
+        @type  background: C{bool}
+        @return: le Deferred contenant le résultat ou l'erreur
+        @rtype: C{Deferred}
+        """
+        self.job_count += 1
+        if not isinstance(args, list):
+            args = args.split()
+        # attention, unicode interdit
+        args = [a.encode("utf8") if isinstance(a, unicode) else a
+                for a in args]
+        if (self.rrdcached and not no_rrdcached
+                and command in RRDCACHED_COMMANDS):
+            args = ["--daemon", self.rrdcached] + args
+        job_id = next(self._job_ids)
+        self._inflight[job_id] = reactor.seconds()
+        d = self.start() # enchaîne tout de suite si on est déjà démarré
+        d.addCallback(lambda _x: deferToThreadPool(reactor, self.threadpool,
+                                    self._execute, command, filename, args))
+        d.addBoth(self._jobDone, job_id)
+        return d
+
+
+    def _jobDone(self, result, job_id):
+        elapsed = reactor.seconds() - self._inflight.pop(job_id)
+        self._latency += RRDToolPool.latency_weight * (elapsed - self._latency)
+        return result
+
+
+    def _execute(self, command, filename, args):
+        """
+        Appelle la bibliothèque (dans un thread du pool) et met en forme
+        le résultat comme le ferait C{rrdtool -}.
+        """
+        if command == "lastupdate":
+            # Toutes les versions du module ne proposent pas lastupdate.
+            command = "info"
+        try:
+            result = getattr(rrdtool, command)(filename, *args)
+        except Exception as e:
+            raise RRDToolError(filename, str(e))
+        if command == "fetch":
+            return format_fetch(result)
+        if command == "info":
+            return format_lastupdate(result)
+        return ""
+
+
+
+def format_fetch(result):
+    """
+    Met en forme le résultat de C{rrdtool.fetch} comme C{rrdtool fetch}.
+    """
+    (start, dummy_end, step), names, rows = result
+    lines = [" %s" % " ".join(names), ""]
+    timestamp = start
+    for row in rows:
+        timestamp += step
+        values = ["nan" if v is None else repr(float(v)) for v in row]
+        lines.append("%d: %s" % (timestamp, " ".join(values)))
+    return "\n".join(lines)
+
+
+def format_lastupdate(info):
+    """
+    Met en forme le résultat de C{rrdtool.info} comme C{rrdtool lastupdate}.
+    """
+    names = sorted(k[3:-9] for k in info
+                   if k.startswith("ds[") and k.endswith("].last_ds"))
+    values = [str(info["ds[%s].last_ds" % n]) for n in names]
+    return "\n".join([" %s" % " ".join(names), "",
+                      "%d: %s" % (info["last_update"], " ".join(values))])
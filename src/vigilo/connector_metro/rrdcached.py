@@ -0,0 +1,338 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Client pour le protocole du démon RRDcached.
+
+Les mises à jour sont envoyées directement au démon par lots (commande
+C{BATCH}), sans passer par un processus C{rrdtool}.
+
+@note: U{http://oss.oetiker.ch/rrdtool/doc/rrdcached.en.html}
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+
+from twisted.internet import reactor, defer, protocol
+from twisted.protocols.basic import LineOnlyReceiver
+
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__, silent_load=True)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+from vigilo.connector_metro.rrdtool import RRDToolError
+
+
+DEFAULT_PORT = 42217
+
+
+
+class RRDCachedError(Exception):
+    """Réponse négative du démon RRDcached"""
+    pass
+
+
+
+class RRDCachedProtocol(LineOnlyReceiver):
+    """
+    Dialogue avec le démon RRDcached. Les commandes peuvent être envoyées
+    sans attendre la réponse aux précédentes : les réponses sont associées
+    dans l'ordre aux commandes en attente.
+    """
+
+    delimiter = "\n"
+
+
+    def __init__(self):
+        # Réponses attendues : deferreds dans l'ordre d'envoi
+        self._pending = deque()
+        # Réponse en cours de réception : [statut, message]
+        self._current = None
+        self._lines = []
+
+
+    def connectionMade(self):
+        self.factory.protocolConnected(self)
+
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.factory.protocolDisconnected(self)
+        while self._pending:
+            self._pending.popleft().errback(reason)
+
+
+    def command(self, line):
+        """
+        Envoie une commande au démon.
+
+        @return: Deferred déclenché avec le message et les éventuelles lignes
+            supplémentaires de la réponse, ou une erreur L{RRDCachedError}
+        @rtype: C{Deferred}
+        """
+        d = defer.Deferred()
+        self._pending.append(d)
+        self.sendLine(line)
+        return d
+
+
+    def batch(self, commands):
+        """
+        Envoie une série de commandes en mode C{BATCH}.
+
+        @return: Deferred déclenché avec un dictionnaire associant le numéro
+            (à partir de 0) de chaque commande en échec au message d'erreur
+        @rtype: C{Deferred}
+        """
+        # Réponse "0 Go ahead." à la commande BATCH, puis compte-rendu final
+        # de la forme "N errors" suivi de N lignes "<numéro> <message>".
+        go_ahead = defer.Deferred()
+        d = defer.Deferred()
+        self._pending.append(go_ahead)
+        self._pending.append(d)
+        go_ahead.addErrback(lambda _f: None) # l'erreur est remontée par d
+        self.transport.writeSequence(["BATCH\n"] +
+                                     [c + "\n" for c in commands] + [".\n"])
+        def parse_errors(result):
+            message, lines = result
+            errors = {}
+            for line in lines:
+                number, error = line.split(" ", 1)
+                errors[int(number) - 1] = error
+            return errors
+        d.addCallback(parse_errors)
+        return d
+
+
+    def flush(self, filename):
+        """
+        Demande au démon d'écrire dans le fichier les mises à jour qu'il
+        a reçues pour celui-ci (commande C{FLUSH}).
+
+        @rtype: C{Deferred}
+        """
+        return self.command("FLUSH %s" % filename)
+
+
+    def lineReceived(self, line):
+        if self._current is None:
+            status, message = (line.split(" ", 1) + [""])[:2]
+            try:
+                status = int(status)
+            except ValueError:
+                LOGGER.warning(_("Unexpected response from RRDcached: %s"),
+                               line)
+                return
+            self._current = [status, message]
+            self._lines = []
+            remaining = status
+        else:
+            self._lines.append(line)
+            remaining = self._current[0] - len(self._lines)
+        if remaining > 0:
+            return
+        status, message = self._current
+        lines = self._lines
+        self._current = None
+        self._lines = []
+        if not self._pending:
+            LOGGER.warning(_("Unexpected response from RRDcached: %s"),
+                           message)
+            return
+        d = self._pending.popleft()
+        if status < 0:
+            d.errback(RRDCachedError(message))
+        else:
+            d.callback((message, lines))
+
+
+
+class RRDCachedFactory(protocol.ReconnectingClientFactory):
+    """Maintient une connexion au démon RRDcached"""
+
+    protocol = RRDCachedProtocol
+    maxDelay = 30
+
+
+    def __init__(self, address=None):
+        self.address = address
+        self.connection = None
+
+
+    def protocolConnected(self, connection):
+        self.resetDelay()
+        self.connection = connection
+        LOGGER.info(_("Connected to RRDcached at %s"), self.address)
+
+
+    def protocolDisconnected(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+
+
+class RRDCachedClient(object):
+    """
+    Pool de connexions au démon RRDcached. Les mises à jour reçues pendant
+    une même itération du réacteur sont regroupées en une commande C{BATCH}.
+    """
+
+
+    def __init__(self, address, size=2, max_batch=1000, clock=None):
+        """
+        @param address: adresse du démon (C{unix:/chemin}, C{/chemin},
+            C{hôte} ou C{hôte:port})
+        @type  address: C{str}
+        @param size: nombre de connexions
+        @type  size: C{int}
+        @param max_batch: nombre maximum de commandes par lot
+        @type  max_batch: C{int}
+        """
+        self.address = address
+        self.size = size
+        self.max_batch = max_batch
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.factories = []
+        self.started = False
+        self._queue = []
+        self._send_call = None
+        self._next = 0
+
+
+    def _connect(self, factory):
+        address = self.address
+        if address.startswith("unix:"):
+            address = address[5:]
+        if address.startswith("/"):
+            return reactor.connectUNIX(address, factory)
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+            port = int(port)
+        else:
+            host, port = address, DEFAULT_PORT
+        return reactor.connectTCP(host, port, factory)
+
+
+    def start(self):
+        if self.started:
+            return defer.succeed(None)
+        self.started = True
+        # On n'attend pas la connexion : en attendant, les mises à jour
+        # passent par les processus rrdtool.
+        for dummy_i in range(self.size):
+            factory = RRDCachedFactory(self.address)
+            self.factories.append(factory)
+            self._connect(factory)
+        return defer.succeed(None)
+
+
+    def stop(self):
+        d = self.sendBatch()
+        def disconnect(r):
+            for factory in self.factories:
+                factory.stopTrying()
+                if factory.connection is not None:
+                    factory.connection.transport.loseConnection()
+            self.factories = []
+            self.started = False
+            return r
+        d.addBoth(disconnect)
+        return d
+
+
+    @property
+    def connected(self):
+        """Vrai si au moins une connexion au démon est établie"""
+        for factory in self.factories:
+            if factory.connection is not None:
+                return True
+        return False
+
+
+    def _getConnection(self):
+        for dummy_i in range(len(self.factories)):
+            factory = self.factories[self._next % len(self.factories)]
+            self._next += 1
+            if factory.connection is not None:
+                return factory.connection
+        return None
+
+
+    def update(self, filename, values):
+        """
+        Ajoute une mise à jour au prochain lot envoyé au démon.
+
+        @param filename: le nom du fichier RRD
+        @type  filename: C{str}
+        @param values: les valeurs, au format C{timestamp:valeur}
+        @type  values: C{list}
+        @return: Deferred déclenché une fois le lot traité par le démon
+        @rtype: C{Deferred}
+        """
+        d = defer.Deferred()
+        self._queue.append(("UPDATE %s %s" % (filename, " ".join(values)),
+                            filename, d))
+        if len(self._queue) >= self.max_batch:
+            self.sendBatch()
+        elif self._send_call is None:
+            self._send_call = self.clock.callLater(0, self.sendBatch)
+        return d
+
+
+    def flush(self, filename):
+        """
+        Fait écrire par le démon les mises à jour d'un fichier RRD qu'il a
+        déjà acceptées, avant une lecture directe du fichier.
+
+        @param filename: le nom du fichier RRD
+        @type  filename: C{str}
+        @rtype: C{Deferred}
+        """
+        connection = self._getConnection()
+        if connection is None:
+            return defer.fail(RRDToolError(filename,
+                              "not connected to RRDcached"))
+        if isinstance(filename, unicode):
+            filename = filename.encode("utf8")
+        d = connection.flush(filename)
+        d.addErrback(lambda f: defer.fail(RRDToolError(filename,
+                                          f.getErrorMessage())))
+        return d
+
+
+    def sendBatch(self):
+        """Envoie au démon les mises à jour en attente"""
+        if self._send_call is not None:
+            if self._send_call.active():
+                self._send_call.cancel()
+            self._send_call = None
+        queue = self._queue
+        self._queue = []
+        if not queue:
+            return defer.succeed(None)
+        connection = self._getConnection()
+        if connection is None:
+            for dummy_cmd, filename, d in queue:
+                d.errback(RRDToolError(filename,
+                          "not connected to RRDcached"))
+            return defer.succeed(None)
+        # attention, unicode interdit
+        commands = [cmd.encode("utf8") if isinstance(cmd, unicode) else cmd
+                    for cmd, dummy_filename, dummy_d in queue]
+        result = connection.batch(commands)
+        def dispatch(errors):
+            for index, (dummy_cmd, filename, d) in enumerate(queue):
+                if index in errors:
+                    d.errback(RRDToolError(filename, errors[index]))
+                else:
+                    d.callback("")
+        def fail(f):
+            for dummy_cmd, filename, d in queue:
+                d.errback(RRDToolError(filename, f.getErrorMessage()))
+        result.addCallbacks(dispatch, fail)
+        return result
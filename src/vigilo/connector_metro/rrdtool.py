@@ -10,12 +10,23 @@ Gestion d'un process RRDTool pour écrire ou lire des RRDs.
 """
 
 import os
+import re
 import stat
+import time
 import urllib
+from array import array
+from collections import deque, OrderedDict
+from itertools import count
 from signal import SIGINT, SIGTERM
 
-from twisted.internet import reactor, protocol, defer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from twisted.internet import reactor, protocol, defer, task
 from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
 
 from vigilo.common import get_rrd_path
 
@@ -26,17 +37,18 @@ from vigilo.common.gettext import translate
 _ = translate(__name__)
 
 
+from vigilo.connector_metro.cache import LRUCache
+from vigilo.connector_metro.histogram import Timings
 from vigilo.connector_metro.exceptions import CreationError
 from vigilo.connector_metro.exceptions import NotInConfiguration
 from vigilo.connector_metro.exceptions import MissingConfigurationData
 
 
-class NoAvailableProcess(Exception):
-    """
-    Il n'y a plus de process rrdtool disponible, et pourtant le sémaphore a
-    autorisé l'accès
-    """
-    pass
+# Ligne de statut terminant une commande en mode "rrdtool -" : succès avec
+# les temps utilisateur, système et réel (par exemple
+# "OK u:0.01 s:0.00 r:0.02"), ou erreur ("ERROR: <message>")
+STATUS_LINE = re.compile(r"^(?:OK u:\S+ s:\S+ r:\S+|ERROR: (.*))$", re.M)
+
 
 
 class RRDToolError(Exception):
@@ -47,6 +59,161 @@ class RRDToolError(Exception):
 
 
 
+def message_value(msgdata):
+    """
+    Retourne la valeur d'un message sous forme numérique (C{None} pour une
+    valeur inconnue), en réutilisant celle calculée lors de la validation
+    du message si elle est disponible.
+    """
+    try:
+        return msgdata["float_value"]
+    except KeyError:
+        if msgdata["value"] == u"U":
+            return None
+        return float(msgdata["value"])
+
+
+# Ligne de données de C{rrdtool fetch} : "<timestamp>: <valeur> [<valeur>...]",
+# pour les réponses dont les lignes n'ont pas toutes le même nombre de valeurs
+FETCH_ROW = re.compile(r"^[ \t]*(\d+):[ \t]+([^\n]*?)[ \t]*$", re.M)
+
+
+
+class FetchResult(object):
+    """
+    Résultat d'une commande C{fetch} : les dates et les valeurs de chaque
+    source de données, sous forme de tableaux numériques (tableaux NumPy si
+    le module est disponible, C{array} sinon). Les valeurs inconnues valent
+    C{NaN}.
+    """
+
+    __slots__ = ("names", "timestamps", "columns")
+
+
+    def __init__(self, names, timestamps, columns):
+        """
+        @param names: les noms des sources de données
+        @type  names: C{list}
+        @param timestamps: les dates des lignes
+        @type  timestamps: tableau d'entiers
+        @param columns: un tableau de valeurs par source de données
+        @type  columns: C{list}
+        """
+        self.names = names
+        self.timestamps = timestamps
+        self.columns = columns
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return "<FetchResult: %d rows (%s)>" % (len(self),
+                                                ", ".join(self.names))
+
+
+    @property
+    def values(self):
+        """Valeurs de la première source de données"""
+        if not self.columns:
+            return _float_array([])
+        return self.columns[0]
+
+
+    def last(self, column=0):
+        """
+        Retourne la dernière valeur connue d'une source de données.
+
+        @return: la date et la valeur, ou C{None} s'il n'y a que des NaN
+        @rtype: C{tuple}
+        """
+        if column >= len(self.columns):
+            return None
+        values = self.columns[column]
+        if numpy is not None:
+            known = numpy.flatnonzero(~numpy.isnan(values))
+            if not len(known):
+                return None
+            index = known[-1]
+            return (int(self.timestamps[index]), float(values[index]))
+        for index in xrange(len(values) - 1, -1, -1):
+            value = values[index]
+            if value == value: # NaN est différent de lui-même
+                return (self.timestamps[index], value)
+        return None
+
+
+
+def _int_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.int64)
+    return array("l", map(int, values))
+
+
+def _float_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.float64)
+    return array("d", map(float, values))
+
+
+def _to_float(value):
+    try:
+        # python convertit tout seul la notation exposant
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+
+def parse_fetch(response):
+    """
+    Analyse la réponse de C{rrdtool fetch}. La réponse est découpée d'un
+    coup en mots : les dates et chaque colonne de valeurs en sont extraites
+    par tranches, puis converties en tableaux numériques. Les valeurs non
+    numériques sont considérées comme inconnues (NaN).
+
+    @param response: La réponse de RRDTool.
+    @type  response: C{str}
+    @rtype: L{FetchResult}
+    """
+    tokens = response.split()
+    # Les noms des sources de données précèdent la première date
+    for start, token in enumerate(tokens):
+        if token.endswith(":") and token[:-1].isdigit():
+            break
+    else:
+        return FetchResult(tokens, _int_array([]), [])
+    names = tokens[:start]
+    data = tokens[start:]
+    width = 1
+    while width < len(data) and not data[width].endswith(":"):
+        width += 1
+    if len(data) % width or response.count(":") != len(data) // width:
+        # Lignes de longueurs différentes : analyse ligne par ligne
+        return _parse_fetch_lines(names, response)
+    timestamps = "".join(data[::width]).split(":")[:-1]
+    columns = [data[column::width] for column in range(1, width)]
+    return _fetch_result(names, timestamps, columns)
+
+
+def _parse_fetch_lines(names, response):
+    rows = FETCH_ROW.findall(response)
+    if not rows:
+        return FetchResult(names, _int_array([]), [])
+    width = min([len(row[1].split()) for row in rows])
+    columns = zip(*[row[1].split()[:width] for row in rows])
+    return _fetch_result(names, [row[0] for row in rows], columns)
+
+
+def _fetch_result(names, timestamps, columns):
+    result = []
+    for column in columns:
+        try:
+            result.append(_float_array(column))
+        except ValueError:
+            result.append(_float_array([_to_float(v) for v in column]))
+    return FetchResult(names, _int_array(timestamps), result)
+
+
 def parse_rrdtool_response(response, filename):
     """
     Analyse la réponse de RRDTool
@@ -56,41 +223,196 @@ def parse_rrdtool_response(response, filename):
     @return: la dernière valeur renvoyée par RRDTool.
     @rtype: C{float} or C{None}
     """
-    value = None
-    for line in response.split("\n"):
-        if not line.count(": ") == 1:
-            continue
-        timestamp, current_value = line.strip().split(": ")
-        try:
-            # python convertit tout seul la notation exposant
-            current_value = float(current_value)
-        except ValueError:
-            continue
-        # test pour les float NaN (Not a Number)
-        if current_value != current_value:
-            continue
-        value = current_value
-    if value is None:
+    last = parse_fetch(response).last()
+    if last is None:
         LOGGER.warning(_("Error in rrdtool output (%(filename)s): %(output)s"),
             {"filename": filename,
              "output": response})
-    return value
+        return None
+    return last[1]
+
+
+
+class UpdateCoalescer(object):
+    """
+    Regroupe les mises à jour destinées à un même fichier RRD pour les
+    transmettre à RRDTool en une seule commande C{update}.
+
+    Les valeurs sont conservées au plus C{delay} secondes, ou jusqu'à ce que
+    C{max_size} valeurs soient en attente pour le fichier, puis envoyées
+    triées par ordre chronologique.
+    """
+
+
+    def __init__(self, rrdtool, delay, max_size, clock=None):
+        """
+        @param rrdtool: le gestionnaire de pool RRDTool
+        @type  rrdtool: L{RRDToolPoolManager}
+        @param delay: délai maximum de rétention des valeurs (en secondes)
+        @type  delay: C{float}
+        @param max_size: nombre maximum de valeurs par commande
+        @type  max_size: C{int}
+        """
+        self.rrdtool = rrdtool
+        self.delay = delay
+        self.max_size = max_size
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        # filename -> [appel différé, no_rrdcached, [(timestamp, valeur, d)]]
+        self._batches = {}
+
+
+    def update(self, filename, timestamp, value, no_rrdcached=False):
+        """
+        Ajoute une valeur à la prochaine mise à jour du fichier.
+
+        @return: un Deferred déclenché une fois la commande exécutée
+        @rtype: C{Deferred}
+        """
+        try:
+            sort_key = float(timestamp)
+        except (TypeError, ValueError):
+            return defer.fail(RRDToolError(filename,
+                    _("Invalid timestamp: %s") % timestamp))
+        batch = self._batches.get(filename)
+        if batch is None:
+            call = self.clock.callLater(self.delay, self.flush, filename)
+            batch = self._batches[filename] = [call, no_rrdcached, []]
+        d = defer.Deferred()
+        batch[2].append((sort_key, timestamp, value, d))
+        if len(batch[2]) >= self.max_size:
+            self.flush(filename)
+        return d
+
+
+    def flush(self, filename):
+        """Envoie la mise à jour en attente pour ce fichier"""
+        batch = self._batches.pop(filename, None)
+        if batch is None:
+            return defer.succeed(None)
+        call, no_rrdcached, values = batch
+        if call.active():
+            call.cancel()
+        # tri stable : à horodatage égal, l'ordre d'arrivée est conservé
+        values.sort(key=lambda v: v[0])
+        args = []
+        deferreds = []
+        previous = None
+        for sort_key, timestamp, value, d in values:
+            if previous is not None and sort_key == previous[0]:
+                # Même comportement que RRDTool si les valeurs avaient été
+                # envoyées séparément.
+                d.errback(RRDToolError(filename,
+                          "illegal attempt to update using time %s when "
+                          "last update time is %s (minimum one second step)"
+                          % (timestamp, previous[1])))
+                continue
+            previous = (sort_key, timestamp)
+            args.append("%s:%s" % (timestamp, value))
+            deferreds.append(d)
+        result = self.rrdtool.run("update", filename, args,
+                                  no_rrdcached=no_rrdcached)
+        def fire(r):
+            for d in deferreds:
+                d.callback(r)
+        def fail(f):
+            if (len(args) > 1 and f.check(RRDToolError) and
+                    f.getErrorMessage().endswith("(minimum one second step)")):
+                # Une seule valeur trop ancienne fait rejeter toute la
+                # commande : nouvel essai valeur par valeur, pour que seules
+                # les valeurs fautives soient rejetées.
+                return self._updateEach(filename, args, deferreds,
+                                        no_rrdcached)
+            for d in deferreds:
+                d.errback(f)
+        result.addCallbacks(fire, fail)
+        return result
+
+
+    def _updateEach(self, filename, args, deferreds, no_rrdcached):
+        """Envoie les valeurs une par une, dans l'ordre chronologique"""
+        result = defer.succeed(None)
+        for arg, d in zip(args, deferreds):
+            result.addCallback(lambda _x, arg=arg: self.rrdtool.run(
+                    "update", filename, arg, no_rrdcached=no_rrdcached))
+            result.addCallbacks(d.callback, d.errback)
+        return result
+
+
+    def flushAll(self):
+        """Envoie toutes les mises à jour en attente"""
+        results = [self.flush(filename) for filename in self._batches.keys()]
+        return defer.DeferredList(results, consumeErrors=True)
 
 
 
 class RRDToolManager(object):
 
+    get_current_time = time.time
+    # Avance de la date de début des RRD créés en tâche de fond (en secondes)
+    precreate_start_delay = 3600
 
-    def __init__(self, rrdtool, confdb):
+
+    def __init__(self, rrdtool, confdb, batch_delay=0, batch_size=1,
+                 rrdcached=None, last_values_size=10000):
         self.rrdtool = rrdtool
         self.confdb = confdb
+        # Fichiers RRD dont l'existence a été constatée :
+        # (hôte, indicateur) -> filename
+        self._known_files = {}
+        confdb.registerIndexCallback(self._configurationChanged)
+        # Créations en cours : filename -> deferreds en attente
+        self._creating = {}
+        # Parcours de pré-création en cours
+        self._precreating = None
+        self._precreate_again = None
+        self._cooperator = task.Cooperator()
+        # Dernières valeurs écrites pour les indicateurs DIFF-GAUGE,
+        # par (hôte, indicateur)
+        self._last_values = LRUCache(last_values_size)
+        # Client natif RRDcached (optionnel)
+        self.rrdcached = rrdcached
+        if batch_delay > 0 and batch_size > 1:
+            self.coalescer = UpdateCoalescer(rrdtool, batch_delay, batch_size)
+        else:
+            self.coalescer = None
+        # Durées de lecture de la dernière valeur et de mise à jour des RRD,
+        # attente d'un processus comprise
+        self.timings = Timings(self.get_current_time,
+                               ("lastupdate", "update"))
 
 
+    def _configurationChanged(self, diff):
+        """
+        Oublie ce qui concerne les indicateurs supprimés ou modifiés de la
+        configuration.
+        """
+        for key in diff.removed | diff.changed:
+            self._known_files.pop(key, None)
+            self._last_values.pop(key)
+
     def getFilename(self, msgdata):
+        filename = self._known_files.get(
+                        (msgdata["host"], msgdata["datasource"]))
+        if filename is not None:
+            return filename
         filename = get_rrd_path(msgdata["host"], msgdata["datasource"],
                         self.rrdtool.rrd_base_dir, self.rrdtool.rrd_path_mode)
         return filename
 
+    def _fileExists(self, msgdata, filename):
+        self._known_files[(msgdata["host"], msgdata["datasource"])] = filename
+
+    def _checkMissingFile(self, failure, msgdata):
+        # Le fichier a disparu (suppression manuelle, ménage...) : il sera
+        # recréé au prochain message.
+        if failure.check(RRDToolError) and \
+                "No such file" in failure.getErrorMessage():
+            self._known_files.pop((msgdata["host"], msgdata["datasource"]),
+                                  None)
+        return failure
+
     def getOldFilename(self, msgdata):
         old_filename = os.path.join(
             self.rrdtool.rrd_base_dir,
@@ -104,11 +426,34 @@ class RRDToolManager(object):
         return msgdata
 
     def _updateValue(self, msgdata, filename, has_threshold):
-        cmd = '%(timestamp)s:%(value)s' % msgdata
-        d = self.rrdtool.run("update", filename, cmd, no_rrdcached=has_threshold)
+        started = self.get_current_time()
+        if has_threshold == "DIFF-GAUGE":
+            key = (msgdata["host"], msgdata["datasource"])
+            self._last_values[key] = message_value(msgdata)
+        if self.rrdcached is not None and self.rrdcached.connected:
+            # RRDcached regroupe déjà les mises à jour ; les fichiers sont
+            # écrits avant la vérification des seuils (voir getLastValue)
+            cmd = '%(timestamp)s:%(value)s' % msgdata
+            d = self.rrdcached.update(filename, [cmd])
+        elif self.coalescer is not None:
+            d = self.coalescer.update(filename, msgdata["timestamp"],
+                                      msgdata["value"],
+                                      no_rrdcached=has_threshold)
+        else:
+            cmd = '%(timestamp)s:%(value)s' % msgdata
+            d = self.rrdtool.run("update", filename, cmd,
+                                 no_rrdcached=has_threshold)
+        self.timings.timed("update", d, started)
+        if has_threshold == "DIFF-GAUGE":
+            d.addErrback(self._forgetLastValue, key)
         d.addCallback(lambda dummy_: msgdata)
         return d
 
+    def _forgetLastValue(self, failure, key):
+        # La valeur n'a pas été écrite : on relira le fichier RRD.
+        self._last_values.pop(key)
+        return failure
+
     def processMessage(self, msgdata):
         """
         Traite le message et retourne msgdata pour traitements ultérieurs
@@ -122,36 +467,168 @@ class RRDToolManager(object):
         # Pour le moment on ne supporte que ça.
         # Le test d'égalité évite aussi de devoir gérer th == False.
         if th == "DIFF-GAUGE":
-            d = self.rrdtool.run("lastupdate", filename, [])
-            d.addCallback(parse_rrdtool_response, filename)
+            key = (msgdata["host"], msgdata["datasource"])
+            if key in self._last_values:
+                # None est une valeur valide (U)
+                d = defer.succeed(self._last_values.get(key))
+            else:
+                d = self.timings.call("lastupdate", self.rrdtool.run,
+                                      "lastupdate", filename, [])
+                d.addCallback(parse_rrdtool_response, filename)
             d.addCallback(self._rememberPreviousValue, msgdata)
         else:
             d = defer.succeed(msgdata)
 
         d.addCallback(self._updateValue, filename, th)
+        d.addErrback(self._checkMissingFile, msgdata)
+        return d
+
+    def processMessages(self, msgdatas):
+        """
+        Traite plusieurs messages concernant le même indicateur, triés par
+        ordre chronologique, en une seule mise à jour du fichier RRD.
+
+        Si RRDTool refuse la mise à jour groupée (valeur plus ancienne que
+        la dernière écrite), les messages sont traités un par un pour que
+        seuls les messages fautifs soient rejetés.
+
+        @return: Deferred contenant une liste de couples (succès, résultat)
+            comme C{DeferredList}, un par message
+        @rtype: C{Deferred}
+        """
+        th = msgdatas[0]["has_thresholds"]
+        if len(msgdatas) == 1 or th == "DIFF-GAUGE":
+            # Chaque valeur dépend de la précédente : traitement séquentiel
+            return self._processEach(msgdatas)
+        filename = self.getFilename(msgdatas[0])
+        if self.coalescer is not None:
+            return defer.DeferredList([self._updateValue(m, filename, th)
+                                       for m in msgdatas], consumeErrors=True)
+        values = ['%(timestamp)s:%(value)s' % m for m in msgdatas]
+        started = self.get_current_time()
+        if self.rrdcached is not None and self.rrdcached.connected:
+            d = self.rrdcached.update(filename, values)
+        else:
+            d = self.rrdtool.run("update", filename, values,
+                                 no_rrdcached=th)
+        self.timings.timed("update", d, started)
+        d.addCallback(lambda _x: [(True, m) for m in msgdatas])
+        def retry(failure):
+            if (failure.check(RRDToolError) and failure.getErrorMessage()
+                    .endswith("(minimum one second step)")):
+                return self._processEach(msgdatas)
+            return failure
+        d.addErrback(retry)
+        d.addErrback(self._checkMissingFile, msgdatas[0])
+        return d
+
+    def _processEach(self, msgdatas):
+        results = []
+        d = defer.succeed(None)
+        for msgdata in msgdatas:
+            d.addCallback(lambda _x, m=msgdata: self.processMessage(m))
+            d.addCallbacks(lambda r: results.append((True, r)),
+                           lambda f: results.append((False, f)))
+        d.addCallback(lambda _x: results)
         return d
 
-    def createIfNeeded(self, msgdata):
+    def createIfNeeded(self, msgdata, background=False):
         """
         Créé le RRD si besoin, et retourne msgdata pour traitements ultérieurs
         """
+        key = (msgdata["host"], msgdata["datasource"])
+        if key in self._known_files:
+            return defer.succeed(msgdata)
         filename = self.getFilename(msgdata)
+        if filename in self._creating:
+            # Création déjà en cours (tâche de fond ou autre message)
+            d = defer.Deferred()
+            self._creating[filename].append(d)
+            d.addCallback(lambda _x: msgdata)
+            return d
         if os.path.exists(filename):
+            self._fileExists(msgdata, filename)
             return defer.succeed(msgdata)
         # compatibilité
         old_filename = self.getOldFilename(msgdata)
         if os.path.isfile(old_filename):
             os.rename(old_filename, filename)
+            self._fileExists(msgdata, filename)
             return defer.succeed(msgdata)
         else:
             # création
-            d = self._create(filename, msgdata)
+            self._creating[filename] = []
+            d = self._create(filename, msgdata, background)
+            def notify_waiters(r):
+                for waiter in self._creating.pop(filename):
+                    if isinstance(r, Failure):
+                        waiter.errback(r)
+                    else:
+                        waiter.callback(r)
+                return r
+            d.addBoth(notify_waiters)
+            d.addCallback(lambda _x: self._fileExists(msgdata, filename))
             d.addCallback(lambda _x: msgdata)
             return d
 
 
+    def createMissing(self, concurrency=1, datasources=None):
+        """
+        Crée en tâche de fond les fichiers RRD manquants pour tous les
+        indicateurs de la configuration (ou seulement pour C{datasources},
+        liste de couples (hôte, indicateur)), avec au plus C{concurrency}
+        créations simultanées.
+
+        Les fichiers sont créés avec une date de début antérieure de
+        L{precreate_start_delay} secondes à la date courante, pour accepter
+        les messages restés en attente sur le bus.
+        """
+        if self._precreating is not None:
+            # Parcours déjà en cours : on le relancera à la fin pour
+            # prendre en compte la nouvelle configuration.
+            if self._precreate_again is not None:
+                pending = self._precreate_again[1]
+                if pending is None or datasources is None:
+                    datasources = None
+                else:
+                    datasources = set(pending) | set(datasources)
+            self._precreate_again = (concurrency, datasources)
+            return self._precreating
+        d = self._precreating = defer.Deferred()
+        def create_all(datasources):
+            LOGGER.debug("Checking %d RRD files", len(datasources))
+            timestamp = int(self.get_current_time()) \
+                        - self.precreate_start_delay
+            def jobs():
+                for host, ds_name in datasources:
+                    msgdata = {"host": host, "datasource": ds_name,
+                               "timestamp": timestamp}
+                    job = self.createIfNeeded(msgdata, background=True)
+                    job.addErrback(lambda _f: None) # déjà journalisé
+                    yield job
+            work = jobs()
+            return defer.DeferredList([self._cooperator.coiterate(work)
+                                       for dummy_i in range(concurrency)])
+        d.addCallback(create_all)
+        def done(result):
+            self._precreating = None
+            if self._precreate_again:
+                concurrency, datasources = self._precreate_again
+                self._precreate_again = None
+                self.createMissing(concurrency, datasources)
+            return result
+        d.addBoth(done)
+        # Déclenché une fois _precreating affecté : si tout est synchrone,
+        # done() doit trouver le parcours en cours pour l'effacer
+        if datasources is None:
+            self.confdb.list_datasources().chainDeferred(d)
+        else:
+            d.callback(list(datasources))
+        return d
+
+
     @defer.inlineCallbacks
-    def _create(self, filename, msgdata):
+    def _create(self, filename, msgdata, background=False):
         """
         Crée un nouveau fichier RRD avec la configuration adéquate.
 
@@ -172,31 +649,22 @@ class RRDToolManager(object):
         self.rrdtool.makedirs(basedir)
         host = msgdata["host"]
         ds_name = msgdata["datasource"]
-        ds_list = yield self.confdb.get_host_datasources(host)
-        if ds_name not in ds_list:
+        try:
+            template = yield self.confdb.get_create_template(host, ds_name)
+        except KeyError:
             LOGGER.warning(_("Host '%(host)s' with datasource '%(ds)s' not found "
                              "in the configuration"), {
                                 'host': host,
                                 'ds': ds_name,
                         })
             raise NotInConfiguration()
-
-        ds = yield self.confdb.get_datasource(host, ds_name)
-        rrd_cmd = ["--step", str(ds["PDP_step"]), "--start", str(timestamp)]
-        rras = yield self.confdb.get_rras(ds["id"])
-        for rra in rras:
-            rrd_cmd.append("RRA:%s:%s:%s:%s" %
-                           (rra["type"], rra["xff"],
-                            rra["RRA_step"], rra["rows"]))
-
-        ds_type = ds["type"]
-        if ds_type.startswith('DIFF-'):
-            ds_type = ds_type[5:]
-        rrd_cmd.append("DS:DS:%s:%s:%s:%s" %
-                       (ds_type, ds["heartbeat"], ds["min"], ds["max"]))
+        # --step <pas> --start <timestamp> RRA:... DS:...
+        rrd_cmd = list(template)
+        rrd_cmd[2:2] = ["--start", str(timestamp)]
 
         try:
-            yield self.rrdtool.run("create", filename, rrd_cmd)
+            yield self.rrdtool.run("create", filename, rrd_cmd,
+                                   background=background)
         except Exception as e:
             LOGGER.error(_("RRDtool could not create the file: "
                            "%(filename)s. Message: %(msg)s"),
@@ -235,25 +703,100 @@ class RRDToolManager(object):
         for attr in attrs:
             if ds[attr] is None:
                 return defer.fail(MissingConfigurationData(attr))
-        # récupération de la dernière valeur enregistrée
-        filename = self.getFilename(msg)
-        d = self.rrdtool.run("fetch", filename,
-                    'AVERAGE --start -%d' % (int(ds["PDP_step"]) * 2),
-                    no_rrdcached=True)
-        d.addCallback(parse_rrdtool_response, filename)
+        # récupération de la dernière valeur enregistrée, une fois écrites
+        # dans le fichier les mises à jour confiées à RRDcached
+        if self.rrdcached is not None and self.rrdcached.connected:
+            filename = self.getFilename(msg)
+            d = self.rrdcached.flush(filename)
+            def flush_failed(f):
+                LOGGER.warning(_("RRDcached could not flush the file "
+                                 "%(filename)s: %(msg)s"),
+                               {"filename": filename,
+                                "msg": f.getErrorMessage()})
+            d.addErrback(flush_failed)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(lambda _x: self.fetch(msg,
+                start=-(int(ds["PDP_step"]) * 2), no_rrdcached=True))
+        def get_last(result):
+            last = result.last()
+            if last is None:
+                LOGGER.warning(_("Error in rrdtool output (%(filename)s): "
+                                 "%(output)s"),
+                               {"filename": self.getFilename(msg),
+                                "output": result})
+                return None
+            return last[1]
+        d.addCallback(get_last)
+        return d
+
+
+    def fetch(self, msg, cf="AVERAGE", start=None, end=None,
+              resolution=None, no_rrdcached=False):
+        """
+        Lit les valeurs enregistrées dans un fichier RRD.
+
+        @param msg: Un message contenant le nom du fichier RRD.
+        @type  msg: C{dict}
+        @param cf: La fonction de consolidation (C{AVERAGE}, C{MAX}...).
+        @type  cf: C{str}
+        @param start: Le début de la période (date absolue, ou relative à
+            la fin si négative), par défaut celui de RRDTool.
+        @type  start: C{int}
+        @param end: La fin de la période, par défaut maintenant.
+        @type  end: C{int}
+        @param resolution: La résolution souhaitée, en secondes.
+        @type  resolution: C{int}
+        @param no_rrdcached: Lire directement le fichier, sans passer par
+            RRDcached.
+        @type  no_rrdcached: C{bool}
+        @return: Deferred contenant les valeurs lues.
+        @rtype: L{FetchResult}
+        """
+        args = [cf]
+        for option, value in (("--start", start), ("--end", end),
+                              ("--resolution", resolution)):
+            if value is not None:
+                args.extend([option, str(value)])
+        d = self.rrdtool.run("fetch", self.getFilename(msg), " ".join(args),
+                             no_rrdcached=no_rrdcached)
+        d.addCallback(parse_fetch)
         return d
 
     # Proxies
 
     def start(self):
-        return self.rrdtool.start()
+        d = self.rrdtool.start()
+        if self.rrdcached is not None:
+            d.addCallback(lambda _x: self.rrdcached.start())
+        return d
 
     def stop(self):
-        return self.rrdtool.stop()
+        if self.coalescer is None:
+            d = defer.succeed(None)
+        else:
+            d = self.coalescer.flushAll()
+        if self.rrdcached is not None:
+            d.addCallback(lambda _x: self.rrdcached.stop())
+        d.addCallback(lambda _x: self.rrdtool.stop())
+        return d
 
     def isStarted(self):
         return self.rrdtool.started
 
+    @property
+    def latency(self):
+        return self.rrdtool.latency
+
+    @property
+    def queued(self):
+        return self.rrdtool.queued
+
+    def getStats(self):
+        stats = self.timings.getStats()
+        stats.update(self.rrdtool.getStats())
+        return stats
+
 
 
 class RRDToolPoolManager(object):
@@ -265,15 +808,25 @@ class RRDToolPoolManager(object):
 
     def __init__(self, rrd_base_dir, rrd_path_mode, rrd_bin,
                  check_thresholds=True, rrdcached=None, pool_size=None,
-                 readonly=False):
+                 readonly=False, pipeline_size=1, background_pool_size=0,
+                 affinity=False, min_pool_size=None, max_latency=0.1,
+                 idle_timeout=60):
         self.rrd_base_dir = rrd_base_dir
         self.rrd_path_mode = rrd_path_mode
         self.rrd_bin = rrd_bin
         self.readonly = readonly
+        self.pipeline_size = pipeline_size
+        self.affinity = affinity
+        self.min_pool_size = min_pool_size
+        self.max_latency = max_latency
+        self.idle_timeout = idle_timeout
+        self.background_pool_size = background_pool_size
         self.job_count = 0
         self.started = False
+        self._start_waiters = None
         self.pool = None
         self.pool_direct = None
+        self.pool_background = None
         self.createPools(check_thresholds, rrdcached, pool_size)
 
 
@@ -281,13 +834,20 @@ class RRDToolPoolManager(object):
         if pool_size is None:
             # POSIX seulement: http://www.boduch.ca/2009/06/python-cpus.html
             pool_size = int(os.sysconf('SC_NPROCESSORS_ONLN'))
-            if pool_size > 4:
-                # on limite, sinon on passe trop de temps à choisir
-                pool_size = 4
-        self.pool = RRDToolPool(pool_size, self.rrd_bin, rrdcached=rrdcached)
+        self.pool = RRDToolPool(pool_size, self.rrd_bin, rrdcached=rrdcached,
+                                pipeline=self.pipeline_size,
+                                affinity=self.affinity,
+                                min_size=self.min_pool_size,
+                                max_latency=self.max_latency,
+                                idle_timeout=self.idle_timeout)
         if rrdcached and check_thresholds:
             # On créé un petit pool sans RRDcached
-            self.pool_direct = RRDToolPool(1, self.rrd_bin)
+            self.pool_direct = RRDToolPool(1, self.rrd_bin,
+                                           pipeline=self.pipeline_size)
+        if self.background_pool_size:
+            # Pool dédié aux tâches de fond (création des RRD manquants)
+            self.pool_background = RRDToolPool(self.background_pool_size,
+                                    self.rrd_bin, rrdcached=rrdcached)
 
 
     def makedirs(self, directory):
@@ -324,18 +884,36 @@ class RRDToolPoolManager(object):
         """
         if self.started:
             return defer.succeed(None)
+        if self._start_waiters is not None:
+            # Démarrage déjà en cours
+            d = defer.Deferred()
+            self._start_waiters.append(d)
+            return d
         try:
             self.ensureDirectory(self.rrd_base_dir)
             self.checkBinary()
         except OSError as e:
             return defer.fail(e)
 
+        self._start_waiters = []
         d = self.pool.start()
         if self.pool_direct is not None:
             d.addCallback(lambda x: self.pool_direct.start())
+        if self.pool_background is not None:
+            d.addCallback(lambda x: self.pool_background.start())
         def flag_started(r):
             self.started = True
+        def notify_waiters(r):
+            waiters = self._start_waiters
+            self._start_waiters = None
+            for waiter in waiters:
+                if isinstance(r, Failure):
+                    waiter.errback(r)
+                else:
+                    waiter.callback(r)
+            return r
         d.addCallback(flag_started)
+        d.addBoth(notify_waiters)
         return d
 
 
@@ -343,12 +921,41 @@ class RRDToolPoolManager(object):
         d = self.pool.stop()
         if self.pool_direct is not None:
             d.addCallback(lambda x: self.pool_direct.stop())
+        if self.pool_background is not None:
+            d.addCallback(lambda x: self.pool_background.stop())
         def flag_stopped(r):
             self.started = False
         d.addCallback(flag_stopped)
         return d
 
 
+    @property
+    def latency(self):
+        """Latence actuelle des commandes du pool principal (en secondes)"""
+        if self.pool is None:
+            return 0.0
+        return self.pool.currentLatency()
+
+    @property
+    def queued(self):
+        """Nombre de commandes en attente d'un processus"""
+        queued = 0
+        for pool in (self.pool, self.pool_direct):
+            if pool is not None:
+                queued += pool.queued
+        return queued
+
+    def getStats(self):
+        """Mesures de fonctionnement de chaque pool de processus"""
+        stats = {}
+        for pool, prefix in ((self.pool, "rrd_"),
+                             (self.pool_direct, "rrd_direct_"),
+                             (self.pool_background, "rrd_background_")):
+            if pool is not None:
+                stats.update(pool.getStats(prefix))
+        return stats
+
+
     def checkBinary(self):
         if not os.path.isfile(self.rrd_bin):
             raise OSError(_('Unable to start "%(rrdtool)s". Make sure the '
@@ -376,7 +983,8 @@ class RRDToolPoolManager(object):
                     {'dir': directory}).encode('utf-8'))
 
 
-    def run(self, command, filename, args, no_rrdcached=False):
+    def run(self, command, filename, args, no_rrdcached=False,
+            background=False):
         """
         Lance une commande par RRDTool
 
@@ -387,12 +995,16 @@ class RRDToolPoolManager(object):
         @type  filename: C{str}
         @param args: les arguments pour la commande envoyée à RRDtool
         @type  args: C{str} ou C{list}
+        @param background: tâche de fond, à exécuter sur le pool dédié
+        @type  background: C{bool}
         @return: le Deferred contenant le résultat ou l'erreur
         @rtype: C{Deferred}
         """
         self.job_count += 1
         d = self.start() # enchaîne tout de suite si on est déjà démarré
-        if no_rrdcached and self.pool_direct is not None:
+        if background and self.pool_background is not None:
+            pool = self.pool_background
+        elif no_rrdcached and self.pool_direct is not None:
             pool = self.pool_direct
         else:
             pool = self.pool
@@ -402,26 +1014,64 @@ class RRDToolPoolManager(object):
 
 
 class RRDToolProcessProtocol(protocol.ProcessProtocol):
+    """
+    Dialogue avec un processus C{rrdtool -}.
+
+    Le processus peut recevoir plusieurs commandes à l'avance (mode
+    I{pipeline}) : elles sont écrites sur son entrée standard au fur et à
+    mesure, et les réponses (C{OK} ou C{ERROR:}) sont associées dans l'ordre
+    aux commandes en attente.
+    """
 
 
-    def __init__(self, rrd_bin, env=None):
+    def __init__(self, rrd_bin, env=None, pipeline=1):
         self.rrd_bin = rrd_bin
-        self.deferred = None
+        self.pipeline = pipeline
         self.deferred_start = None
         self.deferred_stop = None
-        self._current_data = []
+        # File des commandes envoyées en attente de réponse :
+        # tuples (deferred, filename)
+        self._pending = deque()
+        # Ligne en cours de réception
+        self._buffer = bytearray()
+        self._output = []
         self._keep_alive = True
-        self._filename = None
-        self.working = False
+        # Appelé avec le processus lorsqu'il peut recevoir des commandes
+        # (démarrage ou redémarrage)
+        self.ready_callback = None
         if env is None:
             self.env = {}
         else:
             self.env = env
 
 
+    @property
+    def running(self):
+        """Vrai si le processus est lancé"""
+        return self.transport is not None
+
+    @property
+    def working(self):
+        """Vrai si le processus ne peut pas accepter de commande"""
+        return self.transport is None or len(self._pending) >= self.pipeline
+
+    @property
+    def load(self):
+        """Nombre de commandes en attente de réponse"""
+        return len(self._pending)
+
+
     def start(self):
         if self.transport is not None:
             return defer.succeed(self.transport.pid)
+        if self.deferred_start is not None and not self.deferred_start.called:
+            # Démarrage déjà en cours
+            d = defer.Deferred()
+            def started(pid):
+                d.callback(pid)
+                return pid
+            self.deferred_start.addCallback(started)
+            return d
         LOGGER.debug("Starting rrdtool process in server mode")
         self.deferred_start = defer.Deferred()
         reactor.callWhenRunning(reactor.spawnProcess, self, self.rrd_bin,
@@ -434,6 +1084,8 @@ class RRDToolProcessProtocol(protocol.ProcessProtocol):
             LOGGER.info(_("Started RRDtool subprocess: pid %(pid)d"),
                           {'pid': self.transport.pid})
             self.deferred_start.callback(self.transport.pid)
+        if self.ready_callback is not None:
+            self.ready_callback(self)
 
 
     def run(self, command, filename, args):
@@ -451,18 +1103,12 @@ class RRDToolProcessProtocol(protocol.ProcessProtocol):
         @return: le Deferred contenant le résultat ou l'erreur
         @rtype: C{Deferred}
         """
-        self.working = True
-        assert self.deferred is None, \
+        if self.transport is None:
+            return defer.fail(RRDToolError(filename,
+                    _("The RRDtool process is not running")))
+        assert not self.working, \
                     _("The process has not yet completed the previous job"
                      ).encode("utf8") # unicode interdit
-        self.deferred = defer.Deferred()
-        def state_finish(r):
-            self.working = False
-            self._current_data = []
-            self.deferred = None
-            return r
-        self.deferred.addBoth(state_finish)
-        self._filename = filename
         if isinstance(args, list):
             args = " ".join(args)
         complete_cmd = "%s %s %s" % (command, filename, args)
@@ -471,37 +1117,52 @@ class RRDToolProcessProtocol(protocol.ProcessProtocol):
             # attention, unicode interdit
             self.transport.write("%s\n" % complete_cmd.encode("utf8"))
         except Exception as e:
-            self.working = False
-            return defer.fail(e)
-        return self.deferred
+            return defer.fail(RRDToolError(filename, str(e)))
+        d = defer.Deferred()
+        self._pending.append((d, filename))
+        return d
 
 
     def outReceived(self, data):
-        self._current_data.append(data)
-        if data.count("OK ") == 0 and data.count("ERROR: ") == 0:
-            return # pas encore fini
-        data = "".join(self._current_data)
-        return self._handle_result(data)
+        # Analyse incrémentale : seuls les nouveaux octets sont parcourus,
+        # le tampon ne contient que la dernière ligne incomplète. La sortie
+        # d'une commande est conservée par blocs de lignes complètes.
+        end = data.rfind("\n") + 1
+        if not end:
+            self._buffer.extend(data)
+            return
+        if self._buffer:
+            block = str(self._buffer) + data[:end]
+            del self._buffer[:]
+        else:
+            block = data[:end]
+        self._buffer.extend(data[end:])
+        start = 0
+        for status in STATUS_LINE.finditer(block):
+            self._output.append(block[start:status.start()])
+            start = status.end() + 1
+            self._job_done(status.group(1))
+        if start < len(block):
+            self._output.append(block[start:])
 
 
     def errReceived(self, data):
         return self.outReceived(data)
 
 
-    def _handle_result(self, data):
-        self._current_data = []
-        if self.deferred is None:
+    def _job_done(self, error):
+        # sans le dernier saut de ligne
+        result = "".join(self._output)[:-1]
+        self._output = []
+        if not self._pending:
             LOGGER.warning(_("No deferred available in _handle_result(), "
                              "this should not happen"))
             return
-        for line in data.split("\n"):
-            if line.startswith("OK "):
-                self.deferred.callback("\n".join(self._current_data))
-                break
-            elif line.startswith("ERROR: "):
-                self.deferred.errback(RRDToolError(self._filename, line[7:]))
-                break
-            self._current_data.append(line)
+        d, filename = self._pending.popleft()
+        if error is None:
+            d.callback(result)
+        else:
+            d.errback(RRDToolError(filename, error))
 
 
     def quit(self):
@@ -526,6 +1187,14 @@ class RRDToolProcessProtocol(protocol.ProcessProtocol):
                     '%(msg)s'),
                     {"rcode": reason.value.exitCode, # peut être None
                      "msg": reason.getErrorMessage()})
+        # Plus aucune commande ne peut être envoyée jusqu'au redémarrage
+        self.transport = None
+        # les commandes en attente n'obtiendront jamais de réponse
+        del self._buffer[:]
+        self._output = []
+        while self._pending:
+            d, filename = self._pending.popleft()
+            d.errback(RRDToolError(filename, reason.getErrorMessage()))
         if not self._keep_alive:
             if self.deferred_stop is not None:
                 self.deferred_stop.callback(None)
@@ -539,60 +1208,431 @@ class RRDToolProcessProtocol(protocol.ProcessProtocol):
 class RRDToolPool(object):
     """
     Gestionnaire de pool de processus RRDTool, interface bas-niveau
+
+    Les processus pouvant accepter une tâche sont conservés dans une file,
+    pour que le choix d'un processus se fasse en temps constant quelle que
+    soit la taille du pool.
+
+    Si C{min_size} est inférieur à C{size}, le nombre de processus varie
+    entre ces deux bornes : un processus est ajouté lorsque des tâches
+    attendent et que la latence des commandes dépasse C{max_latency}, et
+    les processus inactifs depuis plus de C{idle_timeout} secondes sont
+    arrêtés.
     """
 
     processProtocolFactory = RRDToolProcessProtocol
-
-    def __init__(self, size, rrd_bin, rrdcached=None):
+    # Intervalle entre deux ajustements de la taille du pool (en secondes)
+    scale_interval = 1
+    # Poids de la dernière mesure dans la moyenne mobile de la latence
+    latency_weight = 0.2
+
+    def __init__(self, size, rrd_bin, rrdcached=None, pipeline=1,
+                 affinity=False, min_size=None, max_latency=0.1,
+                 idle_timeout=60, clock=None):
+        """
+        @param affinity: répartir les tâches selon le nom du fichier RRD,
+            pour que les commandes concernant un même fichier soient
+            exécutées dans l'ordre par le même processus
+        @type  affinity: C{bool}
+        @param min_size: nombre minimum de processus (par défaut C{size},
+            pas d'ajustement)
+        @type  min_size: C{int}
+        @param max_latency: latence moyenne (en secondes) au-delà de
+            laquelle des processus sont ajoutés si des tâches attendent
+        @type  max_latency: C{float}
+        @param idle_timeout: délai (en secondes) d'inactivité au bout
+            duquel un processus est arrêté
+        @type  idle_timeout: C{int}
+        """
         self.size = size
+        if min_size is None or min_size > size:
+            min_size = size
+        self.min_size = max(min_size, 1)
+        self.max_latency = max_latency
+        self.idle_timeout = idle_timeout
         self.rrd_bin = rrd_bin
         self.rrdcached = rrdcached
+        self.pipeline = pipeline
+        self.affinity = affinity
+        if clock is None:
+            clock = reactor
+        self.clock = clock
         self.pool = []
-        self._lock = defer.DeferredSemaphore(self.size)
+        # Latence moyenne des commandes (moyenne mobile exponentielle)
+        self.latency = 0.0
+        # Commandes en cours d'exécution : identifiant -> début, dans
+        # l'ordre de lancement
+        self._inflight = OrderedDict()
+        self._job_ids = count()
+        # Durées d'attente d'un processus et d'exécution par type de
+        # commande
+        self.timings = Timings(self.clock.seconds, ("wait",))
+        # Temps d'occupation de chaque processus depuis le relevé précédent,
+        # et début de la période d'occupation en cours
+        self._busy = {}
+        self._busy_since = {}
+        # Processus disponibles, dans l'ordre où ils le sont devenus. Le set
+        # fait foi : la file peut contenir des processus périmés, ignorés à
+        # la lecture.
+        self._idle = deque()
+        self._idle_set = set()
+        # Dernière activité de chaque processus
+        self._last_active = {}
+        # Processus en cours de démarrage (ajustement de la taille)
+        self._spawning = set()
+        self._stopped = False
+        self._scaler = None
+        # Tâches en attente d'un processus (mode sans affinité)
+        self._waiting = deque()
+        # Mode affinité : file d'attente par processus, et processus
+        # propriétaire de chaque fichier ayant des tâches en cours
+        # (filename -> [processus, nombre de tâches])
+        self._queues = {}
+        self._owners = {}
+        # Processus dont la file d'attente n'est pas vide
+        self._backlog = set()
 
     def __len__(self):
-        return self.size
+        return len(self.pool)
     def __contains__(self, elem):
         return elem in self.pool
     def __iter__(self):
         return self.pool.__iter__()
 
-    def build(self):
+    @property
+    def autoscale(self):
+        return self.min_size < self.size
+
+    @property
+    def queued(self):
+        """Nombre de tâches en attente d'un processus"""
+        if self.affinity:
+            return sum(len(self._queues[p]) for p in self._backlog)
+        return len(self._waiting)
+
+    def currentLatency(self):
+        """
+        Latence actuelle des commandes (en secondes) : la moyenne mobile,
+        ou l'âge de la plus ancienne tâche (en attente d'un processus ou en
+        cours d'exécution) s'il est plus grand, pour détecter les processus
+        bloqués. Nulle si le pool n'a rien à faire.
+        """
+        if self.affinity:
+            oldest = [self._queues[p][0][4] for p in self._backlog]
+        elif self._waiting:
+            oldest = [self._waiting[0][4]]
+        else:
+            oldest = []
+        if self._inflight:
+            # avec plusieurs commandes par processus (pipeline), les tâches
+            # d'un processus bloqué ne sont plus en attente
+            oldest.append(next(iter(self._inflight.itervalues())))
+        if not oldest:
+            return 0.0
+        return max(self.latency, self.clock.seconds() - min(oldest))
+
+    def _createProcess(self):
         env = {}
         if self.rrdcached:
             env["RRDCACHED_ADDRESS"] = self.rrdcached
-        for i in range(self.size):
-            self.pool.append(self.processProtocolFactory(self.rrd_bin, env))
+        return self.processProtocolFactory(self.rrd_bin, env, self.pipeline)
+
+    def _addProcess(self, rrdtool):
+        self.pool.append(rrdtool)
+        self._queues[rrdtool] = deque()
+        self._last_active[rrdtool] = self.clock.seconds()
+        self._busy[rrdtool] = 0.0
+        rrdtool.ready_callback = self._processReady
+        self._feed(rrdtool)
+
+    def _processReady(self, rrdtool):
+        """Le processus a (re)démarré : il peut recevoir des tâches"""
+        if rrdtool in self._queues: # sinon retiré du pool
+            self._feed(rrdtool)
+
+    def build(self):
+        for dummy_i in range(self.min_size):
+            self._addProcess(self._createProcess())
 
     def start(self):
+        self._stopped = False
         if not self.pool:
             self.build()
         results = []
         for rrdtool in self.pool:
             results.append(rrdtool.start())
+        if self.autoscale and self._scaler is None:
+            self._scaler = task.LoopingCall(self._scale)
+            self._scaler.clock = self.clock
+            self._scaler.start(self.scale_interval, now=False)
         return defer.DeferredList(results)
 
     def stop(self):
+        """
+        Arrête les processus, y compris ceux en cours de démarrage. Les
+        tâches en attente d'un processus échouent ; celles déjà envoyées à
+        un processus se terminent avant son arrêt.
+        """
+        self._stopped = True
+        if self._scaler is not None:
+            self._scaler.stop()
+            self._scaler = None
+        self._cancelWaiting()
         results = []
         for rrdtool in self.pool:
             results.append(rrdtool.quit())
+        for rrdtool in self._spawning:
+            # arrêté une fois démarré (voir _spawn)
+            d = rrdtool.start()
+            d.addCallback(lambda _x, rrdtool=rrdtool: rrdtool.quit())
+            results.append(d)
+        self._spawning = set()
         return defer.DeferredList(results)
 
+    def _cancelWaiting(self):
+        jobs = list(self._waiting)
+        self._waiting.clear()
+        for rrdtool in self._backlog:
+            jobs.extend(self._queues[rrdtool])
+            self._queues[rrdtool].clear()
+        self._backlog.clear()
+        for d, dummy_command, filename, dummy_args, dummy_queued in jobs:
+            if self.affinity:
+                owner = self._owners[filename]
+                owner[1] -= 1
+                if not owner[1]:
+                    del self._owners[filename]
+            d.errback(RRDToolError(filename,
+                      _("The RRDtool pool has been stopped")))
+
+    def _scale(self):
+        """Ajuste le nombre de processus à la charge"""
+        now = self.clock.seconds()
+        if (self.queued and self.latency > self.max_latency
+                and len(self.pool) + len(self._spawning) < self.size):
+            self._spawn()
+            return
+        for rrdtool in list(self._idle_set):
+            if len(self.pool) <= self.min_size:
+                break
+            if (rrdtool.load == 0 and not self._queues[rrdtool]
+                    and now - self._last_active[rrdtool] > self.idle_timeout):
+                self._removeProcess(rrdtool)
+
+    def _spawn(self):
+        LOGGER.debug("Adding a process to the RRDtool pool (%d processes)",
+                     len(self.pool) + 1)
+        rrdtool = self._createProcess()
+        self._spawning.add(rrdtool)
+        d = rrdtool.start()
+        def started(_x):
+            if rrdtool not in self._spawning:
+                return # pool arrêté entre-temps
+            self._spawning.discard(rrdtool)
+            self._addProcess(rrdtool)
+        def failed(f):
+            self._spawning.discard(rrdtool)
+            LOGGER.warning(_("Could not start a new RRDtool process: %s"),
+                           f.getErrorMessage())
+        d.addCallbacks(started, failed)
+        return d
+
+    def _removeProcess(self, rrdtool):
+        LOGGER.debug("Removing an idle process from the RRDtool pool "
+                     "(%d processes)", len(self.pool) - 1)
+        self.pool.remove(rrdtool)
+        self._idle_set.discard(rrdtool)
+        del self._queues[rrdtool]
+        self._backlog.discard(rrdtool)
+        del self._last_active[rrdtool]
+        del self._busy[rrdtool]
+        self._busy_since.pop(rrdtool, None)
+        return rrdtool.quit()
+
     def run(self, command, filename, args):
         """
         Lance une commande par RRDTool.  Attention, le pool doit déjà avoir été
         démarré.
         """
-        return self._lock.run(self._dispatch, command, filename, args)
+        if self._stopped:
+            return defer.fail(RRDToolError(filename,
+                              _("The RRDtool pool has been stopped")))
+        d = defer.Deferred()
+        job = (d, command, filename, args, self.clock.seconds())
+        if self.affinity:
+            self._enqueue(job)
+        else:
+            self._waiting.append(job)
+            rrdtool = self._popIdle()
+            if rrdtool is not None:
+                self._feed(rrdtool)
+        return d
+
+    def _setIdle(self, rrdtool):
+        if rrdtool not in self._idle_set:
+            self._idle_set.add(rrdtool)
+            self._idle.append(rrdtool)
+
+    def _popIdle(self):
+        while self._idle:
+            rrdtool = self._idle.popleft()
+            if rrdtool in self._idle_set:
+                self._idle_set.discard(rrdtool)
+                if rrdtool.working:
+                    # Processus arrêté : il reviendra une fois redémarré
+                    continue
+                return rrdtool
+        return None
+
+    def _feed(self, rrdtool, job=None):
+        """
+        Donne des tâches au processus (en commençant par C{job} s'il est
+        fourni) tant qu'il peut en accepter, puis le remet dans la file des
+        processus disponibles s'il lui reste de la place.
+
+        Si une commande échoue immédiatement (processus arrêté...), les
+        tâches suivantes restent en attente : elles échoueraient toutes.
+        """
+        while not rrdtool.working:
+            if job is None:
+                job = self._nextJob(rrdtool)
+            if job is None:
+                self._setIdle(rrdtool)
+                return
+            if not self._start(rrdtool, job):
+                if not rrdtool.working:
+                    self._setIdle(rrdtool)
+                return
+            job = None
+
+    def _nextJob(self, rrdtool):
+        if not self.affinity:
+            if self._waiting:
+                return self._waiting.popleft()
+            return None
+        queue = self._queues[rrdtool]
+        if queue:
+            job = queue.popleft()
+            if not queue:
+                self._backlog.discard(rrdtool)
+            return job
+        return self._steal(rrdtool, self._backlog)
+
+    def _start(self, rrdtool, job):
+        """
+        Lance une tâche sur le processus.
 
-    def _dispatch(self, command, filename, args):
+        @return: faux si la tâche s'est terminée immédiatement
+        @rtype: C{bool}
+        """
+        d, command, filename, args, queued = job
+        self._idle_set.discard(rrdtool)
+        started = self.timings.record("wait", queued)
+        job_id = next(self._job_ids)
+        self._inflight[job_id] = started
+        if not rrdtool.load:
+            self._busy_since[rrdtool] = started
+        result = rrdtool.run(command, filename, args)
+        pending = not result.called
+        result.chainDeferred(d)
+        result.addBoth(self._jobDone, rrdtool, command, filename, job_id,
+                       pending)
+        return pending
+
+    def _jobDone(self, result, rrdtool, command, filename, job_id,
+                 feed=True):
+        started = self._inflight.pop(job_id)
+        now = self.timings.record(command, started)
+        if feed:
+            # Une tâche terminée immédiatement n'a pas été exécutée
+            # (processus arrêté) : elle fausserait la moyenne
+            self.latency += self.latency_weight * (now - started
+                                                   - self.latency)
+        self._last_active[rrdtool] = now
+        if not rrdtool.load and rrdtool in self._busy_since:
+            self._busy[rrdtool] += now - self._busy_since.pop(rrdtool)
+        if self.affinity:
+            owner = self._owners[filename]
+            owner[1] -= 1
+            if not owner[1]:
+                del self._owners[filename]
+        # Pas de récursion si la tâche s'est terminée dans _start()
+        if feed and rrdtool in self._queues: # sinon retiré du pool
+            self._feed(rrdtool)
+        return result
+
+    def getStats(self, prefix=""):
         """
-        Distribue les tâches sur les processus RRDtool disponibles
+        Relève les durées d'attente et d'exécution des commandes, ainsi que
+        le taux d'occupation des processus depuis le relevé précédent
+        (moyenne et maximum, en pourcentage).
+
+        @rtype: C{dict}
         """
-        for index, rrdtool in enumerate(self.pool):
-            if rrdtool.working:
+        since = self.timings.since
+        stats = self.timings.getStats(prefix)
+        now = self.timings.since
+        usage = []
+        for rrdtool in self.pool:
+            busy = self._busy[rrdtool]
+            self._busy[rrdtool] = 0.0
+            if rrdtool in self._busy_since:
+                busy += now - self._busy_since[rrdtool]
+                self._busy_since[rrdtool] = now
+            if now > since:
+                usage.append(min(100.0, 100.0 * busy / (now - since)))
+        stats[prefix + "processes"] = len(self.pool)
+        if usage:
+            stats[prefix + "busy_avg"] = round(sum(usage) / len(usage), 1)
+            stats[prefix + "busy_max"] = round(max(usage), 1)
+        else:
+            stats[prefix + "busy_avg"] = stats[prefix + "busy_max"] = 0
+        return stats
+
+    def _enqueue(self, job):
+        """
+        Mode affinité : place la tâche dans la file du processus associé au
+        fichier. Tant que des tâches sont en cours pour ce fichier, elles
+        restent sur le même processus ; sinon le processus est choisi par
+        hachage du nom de fichier.
+        """
+        filename = job[2]
+        owner = self._owners.get(filename)
+        if owner is None:
+            rrdtool = self.pool[hash(filename) % len(self.pool)]
+            owner = self._owners[filename] = [rrdtool, 0]
+        owner[1] += 1
+        self._queues[owner[0]].append(job)
+        self._backlog.add(owner[0])
+        if owner[0] in self._idle_set and not owner[0].working:
+            self._feed(owner[0])
+            return
+        # Processus occupé : un processus disponible peut reprendre la tâche
+        rrdtool = self._popIdle()
+        if rrdtool is None:
+            return
+        self._feed(rrdtool, self._steal(rrdtool, [owner[0]]))
+
+    def _steal(self, rrdtool, candidates):
+        """
+        Reprend pour le processus C{rrdtool} la première tâche en attente
+        d'un des processus C{candidates}, si c'est la seule tâche en cours
+        pour ce fichier (l'ordre des commandes sur un fichier est ainsi
+        préservé).
+
+        @return: la tâche reprise, ou C{None}
+        """
+        for other in candidates:
+            queue = self._queues[other]
+            if other is rrdtool or not queue:
                 continue
-            #LOGGER.debug("Running job %d on process %d",
-            #             self.job_count, index+1)
-            return rrdtool.run(command, filename, args)
-        raise NoAvailableProcess()
+            owner = self._owners[queue[0][2]]
+            if owner[1] == 1:
+                break
+        else:
+            return None
+        owner[0] = rrdtool
+        job = queue.popleft()
+        if not queue:
+            self._backlog.discard(other)
+        return job
@@ -0,0 +1,423 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+File d'attente sur disque des messages de performance.
+
+Lorsque RRDTool ne suit plus (processus en cours de redémarrage, disque
+saturé...), les messages reçus du bus sont écrits à la suite dans des
+fichiers (segments) plutôt que d'être conservés en mémoire, et peuvent
+ainsi être acquittés tout de suite. Ils sont rejoués une fois RRDTool
+rétabli.
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+from collections import deque
+
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__, silent_load=True)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+
+
+def _timestamp(msg):
+    try:
+        return float(msg["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+# Fonctions exécutées dans le thread d'écriture
+
+def _write(path, data):
+    with open(path, "ab") as segment:
+        segment.write(data)
+        segment.flush()
+        os.fsync(segment.fileno())
+
+
+def _read(path, offset, count):
+    """
+    Relit au plus C{count} lignes d'un segment, à partir de la position
+    C{offset}.
+
+    @return: les messages lus, le nombre de lignes lues (messages invalides
+        compris) et la position de la ligne suivante
+    @rtype: C{tuple}
+    """
+    messages = []
+    lines = 0
+    with open(path, "rb") as segment:
+        segment.seek(offset)
+        while lines < count:
+            line = segment.readline()
+            if not line:
+                break
+            lines += 1
+            offset += len(line)
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                # Dernière ligne incomplète (arrêt brutal)
+                pass
+    return messages, lines, offset
+
+
+def _loadOffset(path):
+    try:
+        with open(path + MessageSpool.offset_suffix, "rb") as offset_file:
+            return int(offset_file.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def _scan(paths):
+    """
+    Recense les segments laissés par une exécution précédente : nombre de
+    lignes restant à rejouer à partir de la position enregistrée.
+
+    @return: la liste des segments (voir L{MessageSpool._segments})
+    @rtype: C{list}
+    """
+    segments = []
+    for path in paths:
+        offset = _loadOffset(path)
+        with open(path, "rb") as segment:
+            segment.seek(offset)
+            count = sum(1 for dummy_line in segment)
+        segments.append([path, count, offset])
+    return segments
+
+
+def _saveOffset(path, offset):
+    # Remplacement atomique : le fichier n'est jamais lu à moitié écrit
+    with open(path + ".tmp", "wb") as offset_file:
+        offset_file.write("%d\n" % offset)
+    os.rename(path + ".tmp", path)
+
+
+def _remove(path):
+    for filename in (path, path + MessageSpool.offset_suffix):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+
+class MessageSpool(object):
+    """
+    File d'attente de messages sur disque, découpée en segments : les
+    messages sont ajoutés (une ligne JSON par message) au segment courant,
+    qui est fermé lorsqu'il atteint C{segment_size} octets. Les messages
+    sont écrits et synchronisés sur le disque (C{fsync}) au plus tard
+    C{sync_delay} secondes après leur ajout, et non à chaque message.
+
+    Les accès aux fichiers (recensement des segments au démarrage,
+    écriture, synchronisation, relecture) sont confiés à un thread dédié,
+    dans l'ordre où ils sont demandés : le thread principal se contente de
+    lister le dossier à l'ouverture de la file.
+
+    Les segments sont rejoués du plus ancien au plus récent, par lots de
+    messages relus au fur et à mesure ; les messages de chaque lot sont
+    triés par horodatage. L'ordre n'est donc garanti qu'au sein d'un lot :
+    un message plus ancien que le dernier message rejoué pour le même
+    indicateur est écarté (RRDTool le refuserait) et compté dans
+    C{dropped}.
+
+    La position atteinte dans le segment est enregistrée après chaque lot
+    (fichier C{.offset}), et le segment est supprimé une fois entièrement
+    rejoué : en cas d'arrêt brutal, seul le dernier lot peut être rejoué de
+    nouveau au démarrage suivant (les valeurs déjà écrites sont alors
+    refusées par RRDTool, sans conséquence).
+    """
+
+    suffix = ".spool"
+    offset_suffix = ".offset"
+
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 sync_delay=1, clock=None):
+        """
+        @param directory: dossier des segments
+        @type  directory: C{str}
+        @param segment_size: taille maximale d'un segment, en octets
+        @type  segment_size: C{int}
+        @param sync_delay: délai maximum avant l'écriture des messages sur
+            le disque, en secondes
+        @type  sync_delay: C{float}
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_delay = sync_delay
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        # Nombre de messages en attente
+        self.pending = 0
+        # Nombre de messages rejoués, et écartés car trop anciens
+        self.replayed = 0
+        self.dropped = 0
+        self.replaying = False
+        # Segments fermés : [chemin, lignes restantes, position du rejeu]
+        self._segments = deque()
+        self._sequence = 0
+        # Segment courant : lignes pas encore écrites sur le disque
+        self._current_path = None
+        self._buffer = []
+        self._current_count = 0
+        self._current_size = 0
+        self._sync_call = None
+        self._writer = ThreadPool(1, 1, name="spool")
+        # Recensement des segments en cours, fermeture demandée
+        self._scanning = False
+        self._closing = False
+        # Deferreds en attente de la fin du rejeu (voir close())
+        self._replay_waiters = []
+        # Horodatage du dernier message rejoué, par (hôte, indicateur)
+        self._latest = {}
+
+
+    def __len__(self):
+        return self.pending
+
+
+    def open(self):
+        """
+        Crée le dossier si besoin et démarre le thread d'écriture, qui
+        recense les segments laissés par une exécution précédente (à partir
+        de la position enregistrée). Ces segments ne sont rejoués qu'une
+        fois recensés ; les messages ajoutés entre-temps vont dans un
+        nouveau segment, rejoué après eux.
+
+        @return: Deferred déclenché une fois les segments recensés
+        @rtype: C{Deferred}
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        paths = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(self.suffix):
+                continue
+            paths.append(os.path.join(self.directory, name))
+            try:
+                self._sequence = max(self._sequence,
+                                     int(name[:-len(self.suffix)]) + 1)
+            except ValueError:
+                pass
+        if not self._writer.started:
+            self._writer.start()
+        self._closing = False
+        self._scanning = True
+        d = self._submit(_scan, paths)
+        def scanned(segments):
+            self._segments.extendleft(reversed(segments))
+            count = sum(segment[1] for segment in segments)
+            self.pending += count
+            if count:
+                LOGGER.info(_("%(count)d messages waiting in the spool "
+                              "directory %(dir)s"),
+                            {"count": count, "dir": self.directory})
+        d.addCallbacks(scanned, self._ioFailed,
+                       errbackArgs=(self.directory, ))
+        def done(result):
+            self._scanning = False
+            return result
+        d.addBoth(done)
+        return d
+
+
+    def close(self):
+        """
+        Interrompt le rejeu en cours, ferme le segment courant (il sera
+        rejoué au prochain démarrage), et arrête le thread d'écriture une
+        fois les écritures terminées.
+
+        @rtype: C{Deferred}
+        """
+        if not self._writer.started:
+            return defer.succeed(None)
+        self._closing = True
+        d = defer.Deferred()
+        if self.replaying:
+            self._replay_waiters.append(d)
+        else:
+            d.callback(None)
+        def stop(_result):
+            if self._current_path is not None:
+                self._closeSegment()
+            writing = self._submit(lambda: None)
+            writing.addBoth(lambda _x: self._writer.stop())
+            return writing
+        d.addCallback(stop)
+        return d
+
+
+    def append(self, msg):
+        """
+        Ajoute un message à la fin de la file.
+
+        @param msg: le message
+        @type  msg: C{dict}
+        """
+        if self._current_path is None:
+            self._openSegment()
+        line = json.dumps(msg) + "\n"
+        self._buffer.append(line)
+        self._current_count += 1
+        self._current_size += len(line)
+        self.pending += 1
+        if self._current_size >= self.segment_size:
+            self._closeSegment()
+        elif self._sync_call is None:
+            self._sync_call = self.clock.callLater(self.sync_delay, self.sync)
+
+
+    def sync(self):
+        """
+        Écrit à la fin du segment courant les messages ajoutés depuis la
+        synchronisation précédente, et les synchronise sur le disque.
+
+        @return: Deferred déclenché une fois les messages écrits
+        @rtype: C{Deferred}
+        """
+        if self._sync_call is not None:
+            if self._sync_call.active():
+                self._sync_call.cancel()
+            self._sync_call = None
+        if not self._buffer:
+            return defer.succeed(None)
+        data = "".join(self._buffer)
+        self._buffer = []
+        d = self._submit(_write, self._current_path, data)
+        d.addErrback(self._ioFailed, self._current_path)
+        return d
+
+
+    def _submit(self, func, *args):
+        """Exécute C{func} dans le thread d'écriture"""
+        return deferToThreadPool(reactor, self._writer, func, *args)
+
+
+    def _ioFailed(self, f, path):
+        # Les messages concernés ont déjà été acquittés : ils sont perdus
+        LOGGER.error(_("Could not access the spool file %(path)s: %(error)s"),
+                     {"path": path, "error": f.getErrorMessage()})
+
+
+    def _openSegment(self):
+        self._current_path = os.path.join(self.directory, "%020d%s"
+                                          % (self._sequence, self.suffix))
+        self._sequence += 1
+        self._current_count = 0
+        self._current_size = 0
+
+
+    def _closeSegment(self):
+        self.sync()
+        self._segments.append([self._current_path, self._current_count, 0])
+        self._current_path = None
+
+
+    def _ordered(self, messages):
+        """
+        Trie un lot de messages par horodatage, et écarte ceux qui ne sont
+        pas postérieurs au dernier message rejoué pour le même indicateur.
+        """
+        # tri stable : à horodatage égal, l'ordre d'arrivée est conservé
+        messages.sort(key=_timestamp)
+        latest = self._latest
+        ordered = []
+        for msg in messages:
+            key = (msg.get("host"), msg.get("datasource"))
+            timestamp = _timestamp(msg)
+            if key in latest and timestamp <= latest[key]:
+                self.dropped += 1
+                continue
+            latest[key] = timestamp
+            ordered.append(msg)
+        return ordered
+
+
+    def replay(self, process, chunk_size=1000, proceed=None):
+        """
+        Rejoue les messages en attente, par lots de C{chunk_size} messages.
+        Le segment courant est fermé pour être rejoué à son tour.
+
+        @param process: fonction appelée avec chaque lot de messages, et
+            retournant un Deferred
+        @type  process: C{callable}
+        @param proceed: fonction appelée avant chaque lot : si elle retourne
+            faux, le rejeu est interrompu (il reprendra au même point)
+        @type  proceed: C{callable}
+        @return: Deferred déclenché avec C{True} si tous les messages ont
+            été rejoués
+        @rtype: C{Deferred}
+        """
+        if (self.replaying or self._scanning or self._closing
+                or not self._writer.started):
+            return defer.succeed(False)
+        self.replaying = True
+        d = self._replay(process, chunk_size, proceed)
+        def done(result):
+            self.replaying = False
+            waiters = self._replay_waiters
+            self._replay_waiters = []
+            for waiter in waiters:
+                waiter.callback(None)
+            return result
+        d.addBoth(done)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _replay(self, process, chunk_size, proceed):
+        while self.pending:
+            if not self._segments:
+                if self._current_path is None:
+                    break
+                self._closeSegment()
+            segment = self._segments[0]
+            while segment[1] > 0:
+                if self._closing or (proceed is not None and not proceed()):
+                    defer.returnValue(False)
+                messages, lines, offset = yield self._submit(
+                        _read, segment[0], segment[2], chunk_size)
+                if not lines:
+                    # Fin du fichier : des écritures ont échoué
+                    break
+                if len(messages) != lines:
+                    LOGGER.warning(_("Skipping %(count)d invalid lines "
+                                     "in the spool file %(path)s"),
+                                   {"count": lines - len(messages),
+                                    "path": segment[0]})
+                messages = self._ordered(messages)
+                if messages:
+                    try:
+                        yield process(messages)
+                    except Exception as e:
+                        LOGGER.error(_("Error while replaying spooled "
+                                       "messages: %s"), e)
+                segment[1] -= lines
+                segment[2] = offset
+                self.pending -= lines
+                self.replayed += len(messages)
+                # Pas besoin d'attendre : le thread d'écriture traite
+                # les demandes dans l'ordre
+                self._submit(_saveOffset, segment[0] + self.offset_suffix,
+                             offset).addErrback(self._ioFailed, segment[0])
+            self.pending -= max(segment[1], 0)
+            self._segments.popleft()
+            yield self._submit(_remove, segment[0]).addErrback(
+                    self._ioFailed, segment[0])
+        # Tout a été rejoué : les messages suivants arriveront dans l'ordre
+        self._latest.clear()
+        defer.returnValue(True)
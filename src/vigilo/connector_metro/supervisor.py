@@ -0,0 +1,206 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mode multi-processus du connecteur.
+
+Le superviseur relance la même ligne de commande dans plusieurs processus
+fils. Chaque fils consomme sa propre file d'attente (le nom de la file
+configurée suffixé par son numéro), abonnée aux mêmes messages, et ne
+traite que les hôtes qui lui reviennent par hachage de leur nom : chaque
+fichier RRD n'est ainsi écrit que par un seul processus.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import zlib
+from getopt import getopt
+from signal import SIGTERM
+
+from twisted.application import service
+from twisted.internet import reactor, protocol, defer
+from twisted.scripts.twistd import ServerOptions
+
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__, silent_load=True)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+
+# Variable d'environnement donnant aux processus fils leur partition,
+# sous la forme "<numéro>/<nombre de processus>"
+SHARD_ENV = "VIGILO_METRO_SHARD"
+
+
+
+def get_shard(environ=None):
+    """
+    Retourne la partition du processus courant.
+
+    @return: couple (numéro, nombre de partitions), ou C{None} si le
+        processus n'est pas un fils du superviseur
+    @rtype: C{tuple}
+    """
+    if environ is None:
+        environ = os.environ
+    value = environ.get(SHARD_ENV)
+    if not value:
+        return None
+    index, count = value.split("/", 1)
+    return (int(index), int(count))
+
+
+def host_shard(hostname, count):
+    """
+    Retourne le numéro de la partition à laquelle appartient un hôte.
+    Le résultat ne dépend que du nom, il est donc identique dans tous les
+    processus.
+    """
+    if isinstance(hostname, unicode):
+        hostname = hostname.encode("utf-8")
+    return (zlib.crc32(hostname) & 0xffffffff) % count
+
+
+
+def worker_argv(argv, index):
+    """
+    Construit la ligne de commande d'un processus fils à partir de celle du
+    superviseur (interpréteur, script twistd, options de twistd, puis nom
+    du plugin et ses options). Les options de twistd sont analysées avec
+    les tables de L{ServerOptions} (options combinées, abrégées, valeurs
+    accolées), puis réécrites sous leur forme longue. Le fils reste au
+    premier plan pour être surveillé, et écrit son propre fichier PID : sans
+    cela, il refuserait de démarrer (fichier PID du superviseur déjà
+    présent) ou passerait en arrière-plan, et serait relancé sans fin. Les
+    autres options (dont le journal de twistd) sont conservées.
+
+    @param argv: ligne de commande du superviseur
+    @type  argv: C{list}
+    @param index: numéro du processus fils
+    @type  index: C{int}
+    @rtype: C{list}
+    @raise getopt.GetoptError: option inconnue de twistd (twistd l'aurait
+        déjà refusée au démarrage du superviseur)
+    """
+    # Les options ne sont pas interprétées (certaines ont des effets de
+    # bord, comme --reactor) : seules leurs tables sont utilisées.
+    config = ServerOptions()
+    opts, args = getopt(argv[2:], config.shortOpt, config.longOpt)
+    options = []
+    pidfile = ""
+    for opt, value in opts:
+        name = config.synonyms[opt.lstrip("-")]
+        if name == "pidfile":
+            pidfile = value
+        elif name == "nodaemon":
+            continue
+        elif name + "=" in config.longOpt:
+            options.append("--%s=%s" % (name, value))
+        else:
+            options.append("--%s" % name)
+    if pidfile:
+        root, ext = os.path.splitext(pidfile)
+        pidfile = "%s-%d%s" % (root, index, ext)
+    return (argv[:2] + ["--nodaemon", "--pidfile=%s" % pidfile]
+            + options + args)
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Suivi d'un processus fils, relancé s'il s'arrête"""
+
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.deferred_stop = None
+
+
+    def connectionMade(self):
+        LOGGER.info(_("Started worker %(index)d: pid %(pid)d"),
+                    {"index": self.index, "pid": self.transport.pid})
+
+
+    def processEnded(self, reason):
+        if self.deferred_stop is not None:
+            self.deferred_stop.callback(None)
+            return
+        LOGGER.warning(_("Worker %(index)d exited: %(msg)s"),
+                       {"index": self.index,
+                        "msg": reason.getErrorMessage()})
+        self.supervisor.workerEnded(self.index)
+
+
+    def stop(self):
+        self.deferred_stop = defer.Deferred()
+        try:
+            self.transport.signalProcess(SIGTERM)
+        except Exception: # déjà terminé
+            return defer.succeed(None)
+        return self.deferred_stop
+
+
+
+class MetroSupervisor(service.Service):
+    """
+    Lance et surveille les processus fils du connecteur.
+    """
+
+    # Délai avant de relancer un processus fils qui s'est arrêté
+    respawn_delay = 5
+
+
+    def __init__(self, count, argv=None, environ=None):
+        """
+        @param count: nombre de processus fils
+        @type  count: C{int}
+        @param argv: ligne de commande des fils (par défaut celle du
+            processus courant)
+        @type  argv: C{list}
+        """
+        self.count = count
+        if argv is None:
+            argv = [sys.executable] + sys.argv
+        self.argv = argv
+        if environ is None:
+            environ = os.environ
+        self.environ = environ
+        self.workers = {}
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for index in range(self.count):
+            self.spawn(index)
+
+
+    def spawn(self, index):
+        env = dict(self.environ)
+        env[SHARD_ENV] = "%d/%d" % (index, self.count)
+        worker = WorkerProtocol(self, index)
+        self.workers[index] = worker
+        reactor.spawnProcess(worker, self.argv[0],
+                             worker_argv(self.argv, index), env=env,
+                             childFDs={0: "w", 1: 1, 2: 2})
+        return worker
+
+
+    def workerEnded(self, index):
+        del self.workers[index]
+        if self.running:
+            reactor.callLater(self.respawn_delay, self._respawn, index)
+
+
+    def _respawn(self, index):
+        if self.running and index not in self.workers:
+            self.spawn(index)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        results = [worker.stop() for worker in self.workers.values()]
+        return defer.DeferredList(results)
@@ -34,6 +34,7 @@ class RRDToolPoolManagerStub(RRDToolPoolManager):
 class RRDToolProcessProtocolStub(object):
     def __init__(self, commands):
         self.working = False
+        self.load = 0
         self.commands = commands
     def start(self):
         return defer.succeed(None)
@@ -15,10 +15,13 @@ from nose.twistedtools import reactor, deferred
 
 from mock import Mock
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from vigilo.connector_metro.bustorrdtool import BusToRRDtool
-from vigilo.connector_metro.exceptions import NotInConfiguration
+from vigilo.connector_metro.bustorrdtool import REJECT_NOT_IN_CONF
+from vigilo.connector_metro.bustorrdtool import REJECT_WRONG_TYPE
+from vigilo.connector_metro.bustorrdtool import REJECT_INVALID
+from vigilo.connector_metro.histogram import Timings
 from vigilo.connector_metro.exceptions import WrongMessageType
 from vigilo.connector_metro.exceptions import InvalidMessage
 
@@ -34,8 +37,14 @@ class BusToRRDtoolTestCase(unittest.TestCase):
     @deferred(timeout=30)
     def setUp(self):
         self.btr = BusToRRDtool(Mock(), Mock(), Mock())
+        # Configuration non chargée en mémoire : passage par has_host()
+        self.btr.confdb.known_host.return_value = None
+        self.btr.confdb.known_hosts.return_value = None
         self.btr.rrdtool.start.return_value = defer.succeed(None)
         self.btr.rrdtool.stop.return_value = defer.succeed(None)
+        self.btr.rrdtool.queued = 0
+        self.btr.rrdtool.getStats.return_value = {}
+        self.btr.threshold_checker.getStats.return_value = {}
         return self.btr.startService()
 
     @deferred(timeout=30)
@@ -77,21 +86,19 @@ class BusToRRDtoolTestCase(unittest.TestCase):
                "value": "42",
                }
         self.btr.confdb.has_host.return_value = defer.succeed(False)
-        d = self.btr._parse_message(msg)
-        def check_failure(f):
+        d = self.btr.processMessage(msg)
+        def check(r):
+            self.assertTrue(self.btr.confdb.has_host.called)
             self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
             self.assertFalse(self.btr.rrdtool.processMessage.called)
-            if not isinstance(f.value, NotInConfiguration):
-                self.fail("Raised exeception is not of the right type (got %s)"
-                          % type(f.value))
-        d.addCallbacks(lambda x: self.fail("No exception raised"),
-                       check_failure)
+            self.assertEqual(self.btr._rejected[REJECT_NOT_IN_CONF], 1)
+            self.assertEqual(self.btr._messages_received, -1)
+        d.addCallback(check)
         return d
 
 
-    @deferred(timeout=30)
     def test_wrong_message_type_1(self):
-        """Réception d'un autre message que perf (_parse_message)"""
+        """Réception d'un autre message que perf (_check)"""
         msg = { "type": "event",
                 "timestamp": "1165939739",
                 "host": "host",
@@ -99,13 +106,10 @@ class BusToRRDtoolTestCase(unittest.TestCase):
                 "status": "CRITICAL",
                 "message": "message",
                 }
-        d = self.btr._parse_message(msg)
-        def cb(r):
-            self.fail("Il y aurait dû y avoir un errback")
-        def eb(f):
-            self.assertEqual(f.type, WrongMessageType)
-        d.addCallbacks(cb, eb)
-        return d
+        reason = self.btr._check(msg)
+        self.assertEqual(reason, REJECT_WRONG_TYPE)
+        self.assertTrue(isinstance(self.btr._error(reason, msg),
+                                   WrongMessageType))
 
 
     @deferred(timeout=30)
@@ -128,22 +132,18 @@ class BusToRRDtoolTestCase(unittest.TestCase):
         return d
 
 
-    @deferred(timeout=30)
     def test_invalid_message_1(self):
-        """Réception d'un message invalide (_parse_message)"""
+        """Réception d'un message invalide (_check)"""
         msg = { "type": "perf",
                 "timestamp": "1165939739",
                 "host": "server1.example.com",
                 # pas de clé datasource
                 "value": "12",
                 }
-        d = self.btr._parse_message(msg)
-        def cb(r):
-            self.fail("Il y aurait dû y avoir un errback")
-        def eb(f):
-            self.assertEqual(f.type, InvalidMessage)
-        d.addCallbacks(cb, eb)
-        return d
+        reason = self.btr._check(msg)
+        self.assertEqual(reason, REJECT_INVALID)
+        self.assertTrue(isinstance(self.btr._error(reason, msg),
+                                   InvalidMessage))
 
 
     @deferred(timeout=30)
@@ -159,27 +159,23 @@ class BusToRRDtoolTestCase(unittest.TestCase):
         def cb(r):
             self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
             self.assertFalse(self.btr.rrdtool.run.called)
+            self.assertEqual(self.btr._rejected[REJECT_INVALID], 1)
         d.addCallback(cb)
         return d
 
 
-    @deferred(timeout=30)
     def test_valid_values(self):
         """Réception d'un message avec une valeur valide"""
-        self.btr.confdb.has_host.return_value = defer.succeed(True)
         msg_tpl = { "type": "perf",
                     "timestamp": "1165939739",
                     "host": "server1.example.com",
                     "datasource": "Load",
                     }
         valid_values = ["1", "1.2", "U"]
-        dl = []
         for value in valid_values:
             msg = msg_tpl.copy()
             msg["value"] = value
-            d = self.btr._parse_message(msg)
-            dl.append(d)
-        return defer.DeferredList(dl, fireOnOneErrback=True)
+            self.assertEqual(self.btr._check(msg), None)
 
 
     @deferred(timeout=30)
@@ -191,12 +187,13 @@ class BusToRRDtoolTestCase(unittest.TestCase):
                 "datasource": "Load",
                 "value": "Invalid value",
                 }
-        d = self.btr._parse_message(msg)
+        self.assertEqual(self.btr._check(msg), REJECT_INVALID)
+        d = self.btr.processMessage(msg)
         def cb(r):
-            self.fail("Il y aurait du y avoir un errback")
-        def eb(f):
-            self.assertEqual(f.type, InvalidMessage)
-        d.addCallbacks(cb, eb)
+            self.assertFalse(self.btr.confdb.has_host.called)
+            self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
+            self.assertEqual(self.btr._rejected[REJECT_INVALID], 1)
+        d.addCallback(cb)
         return d
 
 
@@ -205,12 +202,21 @@ class BusToRRDtoolTestCase(unittest.TestCase):
         """Statistiques"""
         self.btr.confdb.count_datasources.return_value = defer.succeed(4)
         d = self.btr.getStats()
+        expected = {
+            'received': 0,
+            'pds_count': 4,
+            'illegal_updates': 0,
+            'not_in_conf': 0,
+            'wrong_type': 0,
+            'invalid_messages': 0,
+            'rrd_queued': 0,
+            'rrd_queued_max': 0,
+        }
+        for stage in ("parse", "create"):
+            for suffix in ("count", "rate", "p50", "p99", "max"):
+                expected["%s_%s" % (stage, suffix)] = 0
         def cb(r):
-            self.assertEqual(r, {
-                'received': 0,
-                'pds_count': 4,
-                'illegal_updates': 0,
-            })
+            self.assertEqual(r, expected)
         d.addCallback(cb)
         return d
 
@@ -233,3 +239,271 @@ class BusToRRDtoolTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_rejected_stats(self):
+        """Compteurs des messages rejetés, par motif"""
+        self.btr.confdb.known_host.side_effect = \
+                lambda host: host == "server1.example.com"
+        self.btr.confdb.count_datasources.return_value = defer.succeed(4)
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "42"}
+        for host in ("dummy1", "dummy2"):
+            rejected = msg.copy()
+            rejected["host"] = host
+            self.btr.processMessage(rejected)
+        rejected = msg.copy()
+        rejected["type"] = "event"
+        self.btr.processMessage(rejected)
+        rejected = msg.copy()
+        rejected["value"] = "invalid"
+        self.btr.processMessage(rejected)
+        self.assertFalse(self.btr.confdb.has_host.called)
+        self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
+        d = self.btr.getStats()
+        def check(stats):
+            self.assertEqual(stats["not_in_conf"], 2)
+            self.assertEqual(stats["wrong_type"], 1)
+            self.assertEqual(stats["invalid_messages"], 1)
+        d.addCallback(check)
+        return d
+
+
+    def test_float_value(self):
+        """La valeur numérique est conservée après validation"""
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "4.2e1"}
+        self.assertEqual(self.btr._check(msg), None)
+        self.assertEqual(msg["float_value"], 42.0)
+        msg["value"] = ""
+        self.assertEqual(self.btr._check(msg), None)
+        self.assertEqual(msg["value"], u"U")
+        self.assertEqual(msg["float_value"], None)
+
+
+    def test_known_host(self):
+        """Hôtes connus : réponse immédiate sans interroger has_host()"""
+        self.btr.confdb.known_host.side_effect = \
+                lambda host: host == "server1.example.com"
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "42"}
+        self.btr.rrdtool.createIfNeeded.side_effect = defer.succeed
+        self.btr.threshold_checker.hasThreshold.side_effect = \
+                lambda perf: dict(perf, has_thresholds=False)
+        self.btr.rrdtool.processMessage.side_effect = defer.succeed
+        msg2 = msg.copy()
+        msg2["host"] = "dummy_host"
+        results = []
+        self.btr.processMessage(msg).addCallback(results.append)
+        self.btr.processMessage(msg2).addCallback(results.append)
+        self.assertEqual(len(results), 2)
+        self.btr.rrdtool.createIfNeeded.assert_called_once_with(msg)
+        self.assertEqual(self.btr._rejected[REJECT_NOT_IN_CONF], 1)
+        self.assertFalse(self.btr.confdb.has_host.called)
+
+
+    def test_batch(self):
+        """Traitement par lots des messages reçus ensemble"""
+        clock = task.Clock()
+        self.btr.batch_size = 10
+        self.btr.clock = clock
+        self.btr.confdb.has_host.side_effect = \
+                lambda host: defer.succeed(host != "dummy_host")
+        self.btr.rrdtool.createIfNeeded.side_effect = defer.succeed
+        def has_threshold(perf):
+            perf["has_thresholds"] = (perf["datasource"] == "Load")
+            return perf
+        self.btr.threshold_checker.hasThreshold.side_effect = has_threshold
+        self.btr.rrdtool.processMessages.side_effect = \
+                lambda msgs: defer.succeed([(True, m) for m in msgs])
+        messages = [
+            {"type": "perf", "timestamp": "1165939800",
+             "host": "server1.example.com", "datasource": "Load",
+             "value": "12"},
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "server1.example.com", "datasource": "Load",
+             "value": "11"},
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "server1.example.com", "datasource": "CPU",
+             "value": "42"},
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "dummy_host", "datasource": "Load", "value": "42"},
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "server1.example.com", "datasource": "Load",
+             "value": "invalid"},
+        ]
+        results = []
+        for msg in messages:
+            self.btr.processMessage(msg).addCallback(results.append)
+        self.assertEqual(results, [])
+        self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
+        clock.advance(0)
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual(self.btr.rrdtool.createIfNeeded.call_count, 2)
+        self.assertEqual(self.btr.rrdtool.processMessages.call_count, 2)
+        calls = [c[0][0] for c in
+                 self.btr.rrdtool.processMessages.call_args_list]
+        load = [msgs for msgs in calls if msgs[0]["datasource"] == "Load"][0]
+        # Valeurs triées par ordre chronologique
+        self.assertEqual([m["value"] for m in load], ["11", "12"])
+        self.assertTrue(load[1]["has_thresholds"])
+        # Seuils vérifiés sur la dernière valeur seulement
+        self.btr.threshold_checker.checkMessage.assert_called_once_with(
+                load[1])
+        # ... la précédente sert au calcul du taux
+        self.btr.threshold_checker.rememberSample.assert_called_once_with(
+                load[0])
+
+
+    def test_batch_errors(self):
+        """Traitement par lots : une erreur ne rejette que son indicateur"""
+        clock = task.Clock()
+        self.btr.batch_size = 10
+        self.btr.clock = clock
+        self.btr.confdb.has_host.side_effect = \
+                lambda host: defer.succeed(True)
+        def create(msg):
+            if msg["datasource"] == "CPU":
+                return defer.fail(ValueError("boom"))
+            return defer.succeed(msg)
+        self.btr.rrdtool.createIfNeeded.side_effect = create
+        def has_threshold(perf):
+            perf["has_thresholds"] = False
+            return perf
+        self.btr.threshold_checker.hasThreshold.side_effect = has_threshold
+        self.btr.rrdtool.processMessages.side_effect = \
+                lambda msgs: defer.succeed([(True, m) for m in msgs])
+        messages = [
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "server1.example.com", "datasource": "Load",
+             "value": "12"},
+            {"type": "perf", "timestamp": "invalid",
+             "host": "server1.example.com", "datasource": "Load",
+             "value": "11"},
+            {"type": "perf", "timestamp": "1165939739",
+             "host": "server1.example.com", "datasource": "CPU",
+             "value": "42"},
+        ]
+        results = []
+        for msg in messages:
+            self.btr.processMessage(msg).addBoth(results.append)
+        clock.advance(0)
+        self.assertEqual(results, [None] * 3)
+        self.assertEqual(self.btr._rejected["invalid_messages"], 2)
+        calls = [c[0][0] for c in
+                 self.btr.rrdtool.processMessages.call_args_list]
+        self.assertEqual(calls, [[messages[0]]])
+
+
+
+    def test_spool(self):
+        """Mise en attente sur disque si RRDTool ne suit plus"""
+        self.btr.spool = Mock()
+        self.btr.spool.pending = 0
+        self.btr.spool.replaying = False
+        self.btr.rrdtool.latency = 5
+        self.btr.confdb.known_host.return_value = True
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "12"}
+        results = []
+        self.btr.processMessage(msg).addCallback(results.append)
+        # acquitté tout de suite
+        self.assertEqual(results, [None])
+        self.btr.spool.append.assert_called_with(msg)
+        self.assertFalse(self.btr.rrdtool.createIfNeeded.called)
+        # pas de rejeu tant que RRDTool est lent
+        self.btr.spool.pending = 1
+        self.btr._checkSpool()
+        self.assertFalse(self.btr.spool.replay.called)
+        self.btr.rrdtool.latency = 0
+        self.btr.spool.replay.return_value = defer.succeed(True)
+        self.btr._checkSpool()
+        self.assertEqual(self.btr.spool.replay.call_args[0][0],
+                         self.btr.processBatch)
+        self.btr.spool = None
+
+
+    @deferred(timeout=30)
+    def test_watermarks(self):
+        """Réception suspendue tant que la file de RRDTool est pleine"""
+        self.btr.high_watermark = 10
+        self.btr.low_watermark = 5
+        self.btr.producer = Mock()
+        self.btr.confdb.known_host.return_value = True
+        processed = defer.Deferred()
+        self.btr.rrdtool.createIfNeeded.return_value = processed
+        self.btr.rrdtool.processMessage.return_value = None
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "12"}
+        self.btr.rrdtool.queued = 12
+        self.btr.processMessage(msg)
+        self.assertEqual(self.btr.producer.pauseProducing.call_count, 1)
+        # pas de reprise tant que la file ne descend pas sous le seuil bas
+        self.btr.rrdtool.queued = 6
+        self.btr._checkQueue()
+        self.assertFalse(self.btr.producer.resumeProducing.called)
+        self.btr.rrdtool.queued = 0
+        processed.callback(None)
+        self.assertEqual(self.btr.producer.resumeProducing.call_count, 1)
+        self.btr.confdb.count_datasources.return_value = defer.succeed(4)
+        d = self.btr.getStats()
+        def check(stats):
+            self.assertEqual(stats["rrd_queued"], 0)
+            self.assertEqual(stats["rrd_queued_max"], 12)
+            self.assertEqual(stats["throttled"], 0)
+            self.assertEqual(stats["throttle_count"], 1)
+        d.addCallback(check)
+        return d
+
+
+    def test_watermarks_idle(self):
+        """Reprise de la réception même sans message en cours"""
+        clock = task.Clock()
+        self.btr.clock = clock
+        self.btr.high_watermark = 10
+        self.btr.low_watermark = 5
+        self.btr.producer = Mock()
+        self.btr.rrdtool.queued = 12
+        self.btr._checkQueue()
+        self.assertEqual(self.btr.producer.pauseProducing.call_count, 1)
+        # la file se vide sans que de nouveaux messages n'arrivent
+        self.btr.rrdtool.queued = 3
+        clock.advance(self.btr.queue_check_interval)
+        self.assertEqual(self.btr.producer.resumeProducing.call_count, 1)
+        self.assertTrue(self.btr._queue_check is None)
+
+
+    @deferred(timeout=30)
+    def test_timings(self):
+        """Durées de chaque étape dans les statistiques"""
+        clock = task.Clock()
+        self.btr.timings = Timings(clock.seconds, ("parse", "create"))
+        self.btr.clock = clock
+        self.btr.confdb.known_host.return_value = True
+        created = defer.Deferred()
+        self.btr.rrdtool.createIfNeeded.return_value = created
+        self.btr.rrdtool.processMessage.return_value = None
+        self.btr.rrdtool.getStats.return_value = {"update_count": 1}
+        self.btr.threshold_checker.getStats.return_value = {"publish_count": 0}
+        msg = {"type": "perf", "timestamp": "1165939739",
+               "host": "server1.example.com", "datasource": "Load",
+               "value": "12"}
+        self.btr.processMessage(msg)
+        clock.advance(0.25)
+        created.callback(None)
+        clock.advance(0.75)
+        self.btr.confdb.count_datasources.return_value = defer.succeed(4)
+        d = self.btr.getStats()
+        def check(stats):
+            self.assertEqual(stats["parse_count"], 1)
+            self.assertEqual(stats["create_count"], 1)
+            self.assertEqual(stats["create_rate"], 1)
+            self.assertAlmostEqual(stats["create_max"], 250, delta=1)
+            self.assertEqual(stats["update_count"], 1)
+            self.assertEqual(stats["publish_count"], 0)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+import unittest
+from vigilo.connector_metro.cache import LRUCache
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get(self):
+        """Cache LRU: lecture"""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("b", 42), 42)
+
+    def test_none_value(self):
+        """Cache LRU: None est une valeur comme une autre"""
+        cache = LRUCache(2)
+        cache["a"] = None
+        self.assertTrue("a" in cache)
+
+    def test_size(self):
+        """Cache LRU: l'entrée la moins récemment utilisée est supprimée"""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_pop(self):
+        """Cache LRU: suppression"""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertEqual(cache.pop("a"), None)
+        self.assertFalse("a" in cache)
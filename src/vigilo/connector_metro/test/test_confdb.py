@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import os
+import unittest
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+#from twisted.trial import unittest
+from nose.twistedtools import reactor, deferred
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from vigilo.connector_metro.confdb import MetroConfDB, DataSource
+from vigilo.connector_metro.confdb import format_datasource
+from vigilo.connector_metro.threshold import Threshold
+from vigilo.connector_metro.supervisor import host_shard
+
+
+
+class MetroConfDBTestCase(unittest.TestCase):
+    """
+    Test de l'accès à la base de configuration
+    """
+
+
+    @deferred(timeout=30)
+    def setUp(self):
+        self.confdb = MetroConfDB(os.path.join(os.path.dirname(__file__),
+                                               "connector-metro.db"))
+        self.confdb.reload()
+        d = self.confdb._rebuild_cache()
+        def no_more_queries(r):
+            self.confdb._db.runQuery = Mock(side_effect=AssertionError(
+                        "The configuration should be loaded in memory"))
+        d.addCallback(no_more_queries)
+        return d
+
+    def tearDown(self):
+        self.confdb._db.close()
+
+
+    @deferred(timeout=30)
+    def test_hosts(self):
+        """Liste des hôtes depuis l'index"""
+        d = self.confdb.get_hosts()
+        d.addCallback(lambda hosts: self.assertEqual(sorted(hosts),
+                      [u"A b/c.example.com", u"server1.example.com"]))
+        d.addCallback(lambda _x: self.confdb.has_host(u"server1.example.com"))
+        d.addCallback(self.assertTrue)
+        d.addCallback(lambda _x: self.confdb.has_host(u"dummy"))
+        d.addCallback(self.assertFalse)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_datasource(self):
+        """Description d'un indicateur et de ses RRA depuis l'index"""
+        d = self.confdb.get_datasource(u"server1.example.com", u"Load")
+        def check_ds(ds):
+            self.assertEqual(ds["type"], u"GAUGE")
+            self.assertEqual(ds["PDP_step"], 300)
+            self.assertEqual(ds["heartbeat"], 600)
+            self.assertEqual(ds["factor"], 1.0)
+            self.assertEqual(ds["min"], "U")
+            self.assertEqual(ds["warning_threshold"], u"0.8")
+            self.assertEqual(ds["warning_range"], Threshold(0, 0.8))
+            return self.confdb.get_rras(ds["id"])
+        def check_rras(rras):
+            self.assertEqual([r["RRA_step"] for r in rras],
+                             [u"1", u"6", u"24", u"288"])
+        d.addCallback(check_ds)
+        d.addCallback(check_rras)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_datasource_shared(self):
+        """Les valeurs identiques sont partagées entre les indicateurs"""
+        d1 = self.confdb.get_datasource(u"server1.example.com", u"Load")
+        d2 = self.confdb.get_datasource(u"A b/c.example.com", u"Load")
+        def check(results):
+            (dummy, ds1), (dummy, ds2) = results
+            self.assertTrue(isinstance(ds1, DataSource))
+            self.assertTrue(ds1["type"] is ds2["type"])
+            self.assertTrue(ds1["name"] is ds2["name"])
+            self.assertEqual(ds1.get("dummy"), None)
+            self.assertRaises(KeyError, lambda: ds1["dummy"])
+            self.assertNotEqual(ds1, ds2)
+        d = defer.DeferredList([d1, d2], fireOnOneErrback=True)
+        d.addCallback(check)
+        return d
+
+
+    def test_invalid_threshold(self):
+        """Un seuil invalide est détecté au chargement"""
+        row = (4, u"GAUGE", 300, 600, None, None, 1.0, u"4:2", u"5",
+               u"Service", u"ventilation_group")
+        ds = format_datasource(row, u"Load", u"server1.example.com")
+        self.assertFalse(ds["has_threshold"])
+        self.assertEqual(ds["warning_range"], None)
+        self.assertEqual(ds["critical_range"], None)
+
+
+    @deferred(timeout=30)
+    def test_unknown_datasource(self):
+        """Indicateur absent de la configuration"""
+        d = self.confdb.get_datasource(u"server1.example.com", u"dummy")
+        def cb(r):
+            self.fail("Il y aurait dû y avoir un errback")
+        def eb(f):
+            self.assertEqual(f.type, KeyError)
+        d.addCallbacks(cb, eb)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_thresholds(self):
+        """Présence de seuils depuis l'index"""
+        d = self.confdb.has_threshold(u"server1.example.com", u"Load")
+        d.addCallback(self.assertEqual, u"GAUGE")
+        d.addCallback(lambda _x: self.confdb.has_threshold(
+                      u"server1.example.com", u"A B/C\\D.E%F"))
+        d.addCallback(self.assertFalse)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_create_template(self):
+        """Arguments de création partagés entre indicateurs identiques"""
+        d1 = self.confdb.get_create_template(u"server1.example.com", u"Load")
+        d2 = self.confdb.get_create_template(u"A b/c.example.com", u"Load")
+        def check(results):
+            (dummy, t1), (dummy, t2) = results
+            self.assertEqual(t1, ("--step", "300",
+                 "RRA:AVERAGE:0.5:1:600", "RRA:AVERAGE:0.5:6:700",
+                 "RRA:AVERAGE:0.5:24:775", "RRA:AVERAGE:0.5:288:732",
+                 "DS:DS:GAUGE:600:U:U"))
+            self.assertTrue(t1 is t2)
+        d = defer.DeferredList([d1, d2], fireOnOneErrback=True)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_count(self):
+        """Nombre d'indicateurs"""
+        d = self.confdb.count_datasources()
+        d.addCallback(self.assertEqual, 3)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_reload_diff(self):
+        """Rechargement : seuls les changements sont signalés"""
+        previous = self.confdb._index
+        load = previous["ds"][(u"server1.example.com", u"Load")]
+        # Simule une configuration précédente différente
+        removed = dict(load, name=u"Removed")
+        previous["ds"][(u"server1.example.com", u"Removed")] = removed
+        added_key = [k for k in previous["ds"]
+                     if k[1] != u"Load" and k[1] != u"Removed"][0]
+        previous["ds"].pop(added_key)
+        previous["ds"][(u"server1.example.com", u"Load")] = dict(load,
+                warning_threshold=u"1000")
+        diffs = []
+        self.confdb.registerIndexCallback(diffs.append)
+        d = self.confdb._rebuild_cache()
+        def check(index):
+            self.assertEqual(len(diffs), 1)
+            diff = diffs[0]
+            self.assertEqual(diff.added, set([added_key]))
+            self.assertEqual(diff.removed,
+                             set([(u"server1.example.com", u"Removed")]))
+            self.assertEqual(diff.changed,
+                             set([(u"server1.example.com", u"Load")]))
+            # Les indicateurs inchangés sont conservés
+            for key, ds in index["ds"].iteritems():
+                if key != added_key and key[1] != u"Load":
+                    self.assertTrue(ds is previous["ds"][key])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_reload_error(self):
+        """Rechargement en échec : l'index précédent est conservé"""
+        previous = self.confdb._index
+        diffs = []
+        self.confdb.registerIndexCallback(diffs.append)
+        self.confdb._db.runInteraction = Mock(
+                return_value=defer.fail(Exception("database is locked")))
+        d = self.confdb._rebuild_cache()
+        def check(index):
+            self.assertTrue(index is previous)
+            self.assertTrue(self.confdb._index is previous)
+            self.assertEqual(diffs, [])
+        d.addCallback(check)
+        return d
+
+
+    def test_known_host(self):
+        """Recherche synchrone des hôtes"""
+        self.assertTrue(self.confdb.known_host(u"server1.example.com"))
+        self.assertFalse(self.confdb.known_host(u"dummy"))
+        self.confdb._index = None
+        self.assertEqual(self.confdb.known_host(u"server1.example.com"),
+                         None)
+
+
+    @deferred(timeout=30)
+    def test_shard(self):
+        """Seuls les hôtes de la partition sont chargés"""
+        hosts = [u"A b/c.example.com", u"server1.example.com"]
+        owner = host_shard(hosts[1], 2)
+        self.confdb.shard = (owner, 2)
+        d = self.confdb._rebuild_cache()
+        d.addCallback(lambda _x: self.confdb.get_hosts())
+        d.addCallback(lambda result: self.assertEqual(sorted(result),
+                      [h for h in hosts if host_shard(h, 2) == owner]))
+        d.addCallback(lambda _x: self.confdb.has_host(hosts[1]))
+        d.addCallback(self.assertTrue)
+        return d
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import unittest
+
+from twisted.internet import defer, task
+
+from vigilo.connector_metro.histogram import LatencyHistogram, Timings
+
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        """Histogramme : centiles avec une erreur relative bornée"""
+        histogram = LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        self.assertEqual(len(histogram), 1000)
+        for percent in (50, 90, 99):
+            expected = percent / 100.0
+            self.assertAlmostEqual(histogram.percentile(percent), expected,
+                                   delta=expected * 0.04)
+        self.assertEqual(histogram.percentile(100), 1)
+
+    def test_small_values(self):
+        """Histogramme : valeurs exactes en-dessous de 64 microsecondes"""
+        histogram = LatencyHistogram()
+        for value in (0.000003, 0.000042, -1):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(0), 0)
+        self.assertEqual(histogram.percentile(50), 0.000003)
+        self.assertEqual(histogram.percentile(100), 0.000042)
+
+    def test_reset(self):
+        """Histogramme : remise à zéro"""
+        histogram = LatencyHistogram()
+        histogram.record(1)
+        histogram.reset()
+        self.assertEqual(len(histogram), 0)
+        self.assertEqual(histogram.percentile(99), 0)
+
+
+
+class TimingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timings = Timings(self.clock.seconds, ("parse",))
+
+    def test_call(self):
+        """Mesures : durée d'un traitement asynchrone"""
+        d = defer.Deferred()
+        result = self.timings.call("update", lambda: d)
+        self.clock.advance(2)
+        d.callback(42)
+        self.assertTrue(result is d)
+        self.assertEqual(len(self.timings["update"]), 1)
+        self.assertEqual(self.timings["update"].max, 2000000)
+
+    def test_stats(self):
+        """Mesures : relevé et remise à zéro"""
+        started = self.timings.record("parse", 0)
+        self.clock.advance(0.5)
+        self.timings.record("parse", started)
+        self.clock.advance(0.5)
+        self.assertEqual(self.timings.getStats("bus_"), {
+            "bus_parse_count": 2,
+            "bus_parse_rate": 2,
+            "bus_parse_p50": 0,
+            "bus_parse_p99": 500,
+            "bus_parse_max": 500,
+        })
+        self.clock.advance(1)
+        self.assertEqual(self.timings.getStats()["parse_count"], 0)
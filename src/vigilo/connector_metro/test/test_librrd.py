@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import tempfile
+import os
+from shutil import rmtree
+import unittest
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+#from twisted.trial import unittest
+from nose.twistedtools import reactor, deferred
+
+from mock import Mock, patch
+
+from twisted.internet import defer
+
+from vigilo.connector_metro import librrd
+from vigilo.connector_metro.rrdtool import parse_rrdtool_response
+from vigilo.connector_metro.rrdtool import RRDToolError
+
+
+
+class RRDToolLibraryManagerTestCase(unittest.TestCase):
+    """
+    Test de l'accès direct à la bibliothèque librrd
+    """
+
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test-connector-metro-")
+        self.rrd_base_dir = os.path.join(self.tmpdir, "rrds")
+        os.mkdir(self.rrd_base_dir)
+        self.lib = Mock(name="rrdtool")
+        self.patcher = patch.object(librrd, "rrdtool", self.lib)
+        self.patcher.start()
+        self.mgr = librrd.RRDToolLibraryManager(self.rrd_base_dir, "flat",
+                        rrdcached="/dummy/rrdcached.sock", pool_size=2)
+
+    def tearDown(self):
+        self.mgr.stop()
+        self.patcher.stop()
+        rmtree(self.tmpdir)
+
+
+    def test_no_module(self):
+        """Le module Python rrdtool n'est pas disponible"""
+        with patch.object(librrd, "rrdtool", None):
+            self.assertRaises(OSError, self.mgr.checkBinary)
+
+
+    @deferred(timeout=30)
+    def test_update(self):
+        """Mise à jour au travers de RRDcached"""
+        self.lib.update.return_value = None
+        d = self.mgr.run("update", "dummy.rrd", [u"1165939739:42"])
+        def check(r):
+            self.assertEqual(r, "")
+            self.lib.update.assert_called_with("dummy.rrd", "--daemon",
+                    "/dummy/rrdcached.sock", "1165939739:42")
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_fetch_no_rrdcached(self):
+        """Lecture sans passer par RRDcached"""
+        self.lib.fetch.return_value = ((1165939500, 1165940100, 300),
+                                       ("DS",), [(41.0,), (None,)])
+        d = self.mgr.run("fetch", "dummy.rrd", "AVERAGE --start -600",
+                         no_rrdcached=True)
+        def check(r):
+            self.lib.fetch.assert_called_with("dummy.rrd", "AVERAGE",
+                                              "--start", "-600")
+            self.assertEqual(r, " DS\n\n1165939800: 41.0\n1165940100: nan")
+            self.assertEqual(parse_rrdtool_response(r, "dummy.rrd"), 41)
+        d.addCallback(check)
+        return d
+
+
+    def test_latency(self):
+        """Latence et commandes en attente mesurées sur le pool de threads"""
+        self.assertEqual(self.mgr.latency, 0)
+        self.assertEqual(self.mgr.queued, 0)
+        with patch.object(librrd, "deferToThreadPool") as submit:
+            submit.side_effect = lambda *a: defer.Deferred()
+            jobs = [self.mgr.run("update", "dummy.rrd", ["1165939739:42"])
+                    for dummy_i in range(3)]
+            self.assertEqual(self.mgr.queued, 1)
+            self.mgr._inflight[0] -= 5
+            self.assertTrue(self.mgr.latency >= 5)
+        self.mgr._jobDone(None, 0)
+        self.assertEqual(self.mgr.queued, 0)
+        self.assertEqual(len(jobs), 3)
+
+
+    def test_lastupdate(self):
+        """La commande lastupdate utilise rrdtool.info"""
+        self.lib.info.return_value = {
+            "filename": "dummy.rrd",
+            "last_update": 1165939739,
+            "ds[DS].last_ds": "42",
+            "ds[DS].type": "GAUGE",
+        }
+        r = self.mgr._execute("lastupdate", "dummy.rrd", [])
+        self.assertEqual(r, " DS\n\n1165939739: 42")
+        self.assertEqual(parse_rrdtool_response(r, "dummy.rrd"), 42)
+
+
+    def test_error(self):
+        """Les erreurs de la bibliothèque sont converties"""
+        self.lib.update.side_effect = Exception("dummy error")
+        try:
+            self.mgr._execute("update", "dummy.rrd", ["1165939739:42"])
+        except RRDToolError as e:
+            self.assertEqual(e.filename, "dummy.rrd")
+            self.assertEqual(e.args[0], "dummy error")
+        else:
+            self.fail("Il y aurait dû y avoir une exception")
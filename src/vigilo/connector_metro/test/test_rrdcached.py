@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import unittest
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+#from twisted.trial import unittest
+from nose.twistedtools import reactor, deferred
+
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from vigilo.connector_metro.rrdcached import RRDCachedClient
+from vigilo.connector_metro.rrdcached import RRDCachedFactory
+from vigilo.connector_metro.rrdcached import RRDCachedError
+from vigilo.connector_metro.rrdtool import RRDToolError
+
+
+
+class RRDCachedTestCase(unittest.TestCase):
+    """
+    Test du client RRDcached
+    """
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = RRDCachedClient("/dummy/rrdcached.sock",
+                                      clock=self.clock)
+        factory = RRDCachedFactory()
+        self.client.factories.append(factory)
+        self.protocol = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+
+    def test_command(self):
+        """Réponse sur plusieurs lignes"""
+        results = []
+        d = self.protocol.command("STATS")
+        d.addCallback(results.append)
+        self.assertEqual(self.transport.value(), "STATS\n")
+        self.protocol.dataReceived("2 Statistics follow\nQueueLength: 0\n")
+        self.assertEqual(results, [])
+        self.protocol.dataReceived("UpdatesReceived: 42\n")
+        self.assertEqual(results, [("Statistics follow",
+                         ["QueueLength: 0", "UpdatesReceived: 42"])])
+
+
+    def test_command_error(self):
+        """Réponse négative du démon"""
+        errors = []
+        d = self.protocol.command("FLUSH dummy.rrd")
+        d.addErrback(errors.append)
+        self.protocol.dataReceived("-1 No such file: dummy.rrd\n")
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDCachedError)
+
+
+    def test_batch(self):
+        """Les mises à jour sont regroupées dans une commande BATCH"""
+        results = []
+        for i in range(3):
+            d = self.client.update("file%d.rrd" % i, ["%d:42" % i, "%d:43" % i])
+            d.addCallbacks(results.append, results.append)
+        self.assertEqual(self.transport.value(), "")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         "BATCH\nUPDATE file0.rrd 0:42 0:43\n"
+                         "UPDATE file1.rrd 1:42 1:43\n"
+                         "UPDATE file2.rrd 2:42 2:43\n.\n")
+        self.protocol.dataReceived("0 Go ahead.  End with dot '.' on its "
+                                   "own line.\n")
+        self.protocol.dataReceived("1 errors\n2 illegal attempt to update\n")
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], "")
+        self.assertEqual(results[1].type, RRDToolError)
+        self.assertEqual(results[1].value.filename, "file1.rrd")
+        self.assertEqual(results[1].value.args[0],
+                         "illegal attempt to update")
+        self.assertEqual(results[2], "")
+
+
+    def test_max_batch(self):
+        """Envoi immédiat si le lot est plein"""
+        self.client.max_batch = 2
+        self.client.update("file0.rrd", ["0:42"])
+        self.assertEqual(self.transport.value(), "")
+        self.client.update("file1.rrd", ["1:42"])
+        self.assertEqual(self.transport.value(), "BATCH\nUPDATE file0.rrd "
+                         "0:42\nUPDATE file1.rrd 1:42\n.\n")
+
+
+    def test_connection_lost(self):
+        """Les mises à jour en attente échouent si la connexion est perdue"""
+        errors = []
+        d = self.client.update("file0.rrd", ["0:42"])
+        d.addErrback(errors.append)
+        self.clock.advance(0)
+        self.protocol.connectionLost()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+        self.assertFalse(self.client.connected)
+
+
+    def test_not_connected(self):
+        """Erreur immédiate si aucune connexion n'est disponible"""
+        self.protocol.connectionLost()
+        errors = []
+        d = self.client.update("file0.rrd", ["0:42"])
+        d.addErrback(errors.append)
+        self.clock.advance(0)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+
+
+    def test_flush(self):
+        """Écriture d'un fichier par la commande FLUSH"""
+        results = []
+        errors = []
+        self.client.flush("file0.rrd").addCallback(results.append)
+        self.assertEqual(self.transport.value(), "FLUSH file0.rrd\n")
+        self.protocol.dataReceived("0 Successfully flushed file0.rrd.\n")
+        self.assertEqual(results, [("Successfully flushed file0.rrd.", [])])
+        self.client.flush("file1.rrd").addErrback(errors.append)
+        self.protocol.dataReceived("-1 No such file: file1.rrd\n")
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+        self.assertEqual(errors[0].value.filename, "file1.rrd")
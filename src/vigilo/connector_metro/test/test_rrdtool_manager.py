@@ -21,12 +21,14 @@ import unittest
 #from twisted.trial import unittest
 from nose.twistedtools import reactor, deferred
 
-from mock import Mock
+from mock import Mock, patch
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from vigilo.connector_metro.rrdtool import RRDToolManager
-from vigilo.connector_metro.confdb import MetroConfDB
+from vigilo.connector_metro.rrdtool import UpdateCoalescer
+from vigilo.connector_metro.rrdtool import RRDToolError
+from vigilo.connector_metro.confdb import MetroConfDB, ConfigurationDiff
 from vigilo.connector_metro.exceptions import NotInConfiguration
 from vigilo.connector_metro.exceptions import MissingConfigurationData
 
@@ -77,6 +79,57 @@ class RRDToolManagerTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_create_concurrent(self):
+        """Deux messages simultanés ne créent le fichier qu'une fois"""
+        msg = { "type": "perf",
+                "timestamp": "1165939739",
+                "host": "server1.example.com",
+                "datasource": "Load",
+                "value": "12",
+                }
+        created = defer.Deferred()
+        self.mgr.rrdtool.run.side_effect = lambda *a, **kw: created
+        d1 = self.mgr.createIfNeeded(msg)
+        d2 = self.mgr.createIfNeeded(msg.copy())
+        created.callback(None)
+        d = defer.DeferredList([d1, d2], fireOnOneErrback=True)
+        def check(_ignored):
+            self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 1)
+            self.assertEqual(self.mgr._creating, {})
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_create_missing(self):
+        """Création en tâche de fond de tous les fichiers manquants"""
+        self.mgr.get_current_time = lambda: 1165939739
+        d = self.mgr.confdb.count_datasources()
+        def create_missing(count):
+            self.count = count
+            return self.mgr.createMissing(concurrency=2)
+        def check(_ignored):
+            calls = self.mgr.rrdtool.run.call_args_list
+            self.assertEqual(len(calls), self.count)
+            for args, kwargs in calls:
+                self.assertEqual(args[0], "create")
+                self.assertEqual(args[2][2:4], ["--start", "1165936129"])
+                self.assertEqual(kwargs, {"background": True})
+        d.addCallback(create_missing)
+        d.addCallback(check)
+        return d
+
+
+    def test_create_missing_sync(self):
+        """Parcours terminé tout de suite : pas de parcours en cours"""
+        results = []
+        self.mgr.createMissing(concurrency=0, datasources=[]
+                               ).addCallback(results.append)
+        self.assertEqual(results, [[]])
+        self.assertTrue(self.mgr._precreating is None)
+
+
     @deferred(timeout=30)
     def test_already_created(self):
         """Pas de création si le fichier existe déjà"""
@@ -97,6 +150,63 @@ class RRDToolManagerTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_known_files(self):
+        """Le système de fichiers n'est consulté qu'une fois par fichier"""
+        msg = { "type": "perf",
+                "timestamp": "1165939739",
+                "host": "server1.example.com",
+                "datasource": "Load",
+                "value": "12",
+                }
+        d = self.mgr.createIfNeeded(msg)
+        def check_cached(_ignored):
+            key = ("server1.example.com", "Load")
+            self.assertTrue(key in self.mgr._known_files)
+            with patch("os.path.exists") as exists:
+                d2 = self.mgr.createIfNeeded(msg.copy())
+                self.assertFalse(exists.called)
+            self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 1)
+            return d2
+        def reload_conf(_ignored):
+            return self.mgr.confdb._rebuild_cache()
+        def check_reloaded(_ignored):
+            # Indicateur inchangé : toujours connu
+            key = ("server1.example.com", "Load")
+            self.assertTrue(key in self.mgr._known_files)
+            # Indicateur supprimé de la configuration : oublié
+            self.mgr._configurationChanged(ConfigurationDiff(removed=set([key])))
+            self.assertEqual(self.mgr._known_files, {})
+        d.addCallback(check_cached)
+        d.addCallback(reload_conf)
+        d.addCallback(check_reloaded)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_known_files_missing(self):
+        """Un fichier disparu est oublié par le cache"""
+        msg = { "type": "perf",
+                "timestamp": "1165939739",
+                "host": "server1.example.com",
+                "datasource": "Load",
+                "value": "12",
+                "has_thresholds": False,
+                }
+        key = ("server1.example.com", "Load")
+        self.mgr._known_files[key] = self.mgr.getFilename(msg)
+        self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.fail(
+                RRDToolError("dummy", "opening 'dummy': No such file or "
+                             "directory"))
+        d = self.mgr.processMessage(msg)
+        def check(failure):
+            self.assertEqual(failure.type, RRDToolError)
+            self.assertFalse(key in self.mgr._known_files)
+        d.addCallbacks(lambda _x: self.fail("Une erreur était attendue"),
+                       check)
+        return d
+
+
     @deferred(timeout=30)
     def test_update(self):
         msg = { "type": "perf",
@@ -119,6 +229,202 @@ class RRDToolManagerTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_process_messages(self):
+        """Plusieurs valeurs d'un indicateur en une seule mise à jour"""
+        msgs = [{"type": "perf", "timestamp": str(1165939739 + i * 60),
+                 "host": "server1.example.com", "datasource": "Load",
+                 "value": str(i), "has_thresholds": False}
+                for i in range(3)]
+        d = self.mgr.processMessages(msgs)
+        def check(results):
+            self.assertEqual(results, [(True, m) for m in msgs])
+            self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 1)
+            self.assertEqual(self.mgr.rrdtool.run.call_args[0][2],
+                    ["1165939739:0", "1165939799:1", "1165939859:2"])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_process_messages_illegal(self):
+        """Mise à jour groupée refusée : nouvel essai message par message"""
+        msgs = [{"type": "perf", "timestamp": str(1165939739 + i * 60),
+                 "host": "server1.example.com", "datasource": "Load",
+                 "value": str(i), "has_thresholds": False}
+                for i in range(2)]
+        illegal = RRDToolError("dummy", "illegal attempt to update using "
+                    "time 1165939739 when last update time is 1165939800 "
+                    "(minimum one second step)")
+        def run(command, filename, args, **kw):
+            if isinstance(args, list) or args.startswith("1165939739:"):
+                return defer.fail(illegal)
+            return defer.succeed(None)
+        self.mgr.rrdtool.run.side_effect = run
+        d = self.mgr.processMessages(msgs)
+        def check(results):
+            self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 3)
+            self.assertFalse(results[0][0])
+            self.assertEqual(results[0][1].value, illegal)
+            self.assertEqual(results[1], (True, msgs[1]))
+        d.addCallback(check)
+        return d
+
+
+    def test_update_coalesced(self):
+        """Regroupement des mises à jour d'un même fichier"""
+        clock = task.Clock()
+        self.mgr.coalescer = UpdateCoalescer(self.mgr.rrdtool, 1, 10,
+                                             clock=clock)
+        results = []
+        for timestamp, value in (("1165939739", "12"), ("1165939439", "10"),
+                                 ("1165939739", "13")):
+            msg = { "type": "perf",
+                    "timestamp": timestamp,
+                    "host": "server1.example.com",
+                    "datasource": "Load",
+                    "value": value,
+                    "has_thresholds": False,
+                    }
+            d = self.mgr.processMessage(msg)
+            d.addCallbacks(results.append, lambda f: results.append(f.value))
+        self.assertFalse(self.mgr.rrdtool.run.called)
+        clock.advance(1)
+        self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 1)
+        self.assertEqual(self.mgr.rrdtool.run.call_args_list[0][0],
+                 ('update', self.rrd_base_dir+"/server1.example.com/Load.rrd",
+                  ['1165939439:10', '1165939739:12']))
+        self.assertEqual(len(results), 3)
+        # le doublon est rejeté comme le ferait RRDTool
+        errors = [r for r in results if isinstance(r, RRDToolError)]
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].args[0].endswith(
+                        "(minimum one second step)"))
+
+
+    def test_update_coalesced_max_size(self):
+        """Envoi immédiat si le nombre maximum de valeurs est atteint"""
+        clock = task.Clock()
+        coalescer = UpdateCoalescer(self.mgr.rrdtool, 1, 2, clock=clock)
+        coalescer.update("dummy.rrd", "1165939439", "10")
+        self.assertFalse(self.mgr.rrdtool.run.called)
+        coalescer.update("dummy.rrd", "1165939739", "12")
+        self.mgr.rrdtool.run.assert_called_with("update", "dummy.rrd",
+                ['1165939439:10', '1165939739:12'], no_rrdcached=False)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_update_coalesced_illegal(self):
+        """Mise à jour groupée refusée : nouvel essai valeur par valeur"""
+        clock = task.Clock()
+        coalescer = UpdateCoalescer(self.mgr.rrdtool, 1, 10, clock=clock)
+        illegal = RRDToolError("dummy.rrd", "illegal attempt to update using "
+                    "time 1165939439 when last update time is 1165939500 "
+                    "(minimum one second step)")
+        def run(command, filename, args, **kw):
+            if isinstance(args, list) or args.startswith("1165939439:"):
+                return defer.fail(illegal)
+            return defer.succeed(None)
+        self.mgr.rrdtool.run.side_effect = run
+        results = []
+        for timestamp in ("1165939439", "1165939739"):
+            d = coalescer.update("dummy.rrd", timestamp, "10")
+            d.addCallbacks(lambda _x: results.append(True),
+                           lambda f: results.append(f.value))
+        clock.advance(1)
+        self.assertEqual(len(self.mgr.rrdtool.run.call_args_list), 3)
+        # seule la valeur trop ancienne est rejetée
+        self.assertEqual(results, [illegal, True])
+
+
+    def test_update_coalesced_invalid_timestamp(self):
+        """Horodatage invalide : échec immédiat, sans attendre l'envoi"""
+        coalescer = UpdateCoalescer(self.mgr.rrdtool, 1, 10,
+                                    clock=task.Clock())
+        errors = []
+        coalescer.update("dummy.rrd", "invalid", "10").addErrback(
+                errors.append)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+        self.assertEqual(coalescer._batches, {})
+
+
+    @deferred(timeout=30)
+    def test_diff_gauge_last_value_cache(self):
+        """La valeur précédente d'un DIFF-GAUGE est gardée en mémoire"""
+        self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.succeed(
+                "DS\n\n1165939439: 10\n")
+        msg_tpl = { "type": "perf",
+                    "host": "server1.example.com",
+                    "datasource": "Load",
+                    "has_thresholds": "DIFF-GAUGE",
+                    }
+        msg1 = msg_tpl.copy()
+        msg1.update({"timestamp": "1165939739", "value": "12"})
+        msg2 = msg_tpl.copy()
+        msg2.update({"timestamp": "1165940039", "value": "15"})
+        d = self.mgr.processMessage(msg1)
+        d.addCallback(lambda _x: self.mgr.processMessage(msg2))
+        def check(_ignored):
+            commands = [c[0][0] for c in
+                        self.mgr.rrdtool.run.call_args_list]
+            self.assertEqual(commands, ["lastupdate", "update", "update"])
+            self.assertEqual(msg1["prev_value"], 10)
+            self.assertEqual(msg2["prev_value"], 12)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_update_rrdcached(self):
+        """Mise à jour par le client RRDcached natif"""
+        self.mgr.rrdcached = Mock()
+        self.mgr.rrdcached.connected = True
+        self.mgr.rrdcached.update.side_effect = \
+                lambda *a, **kw: defer.succeed("")
+        msg = { "type": "perf",
+                "timestamp": "1165939739",
+                "host": "server1.example.com",
+                "datasource": "Load",
+                "value": "12",
+                "has_thresholds": False,
+                }
+        d = self.mgr.processMessage(msg)
+        def check(_ignored):
+            self.assertFalse(self.mgr.rrdtool.run.called)
+            self.mgr.rrdcached.update.assert_called_with(
+                    self.rrd_base_dir+"/server1.example.com/Load.rrd",
+                    ['1165939739:12'])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_last_value_rrdcached_flush(self):
+        """Le fichier est écrit par RRDcached avant la lecture"""
+        self.mgr.rrdcached = Mock()
+        self.mgr.rrdcached.connected = True
+        self.mgr.rrdcached.flush.side_effect = \
+                lambda *a: defer.succeed(("Successfully flushed", []))
+        msg = {"host": "server1.example.com", "datasource": "Load"}
+        ds = {"PDP_step": 300,
+              "warning_threshold": "42",
+              "critical_threshold": "43",
+              "nagiosname": "Load",
+              "ventilation": "ventilation_group",
+              }
+        self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.succeed(
+                " DS\n\n1165939500: 42\n")
+        d = self.mgr.getLastValue(ds, msg)
+        def check(value):
+            self.assertEqual(value, 42)
+            self.mgr.rrdcached.flush.assert_called_once_with(
+                    self.rrd_base_dir + "/server1.example.com/Load.rrd")
+            self.assertTrue(self.mgr.rrdtool.run.call_args[1]["no_rrdcached"])
+        d.addCallback(check)
+        return d
+
+
     def test_special_chars_in_pds_name(self):
         msg = { "type": "perf",
                 "timestamp": "1165939739",
@@ -211,7 +517,7 @@ class RRDToolManagerTestCase(unittest.TestCase):
               "ventilation": "ventilation_group",
               }
         self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.succeed(
-                "DS\n\ntimestamp: 42\n")
+                "DS\n\n1165939500: 42\n")
         d = self.mgr.getLastValue(ds, msg)
         def check(r):
             print(r)
@@ -220,6 +526,26 @@ class RRDToolManagerTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_fetch(self):
+        """Lecture des valeurs d'un fichier RRD sous forme de tableaux"""
+        msg = {"host": "server1.example.com", "datasource": "Load"}
+        self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.succeed(
+                "                 DS\n\n1165939500: 4.2e+01\n"
+                "1165939800: nan\n")
+        d = self.mgr.fetch(msg, "MAX", start=1165939200, resolution=300)
+        def check(result):
+            self.mgr.rrdtool.run.assert_called_with("fetch",
+                    self.mgr.getFilename(msg), "MAX --start 1165939200 --resolution 300",
+                    no_rrdcached=False)
+            self.assertEqual(result.names, ["DS"])
+            self.assertEqual(list(result.timestamps), [1165939500, 1165939800])
+            self.assertEqual(result.values[0], 42)
+            self.assertEqual(result.last(), (1165939500, 42))
+        d.addCallback(check)
+        return d
+
+
     @deferred(timeout=30)
     def test_last_value_no_rrdcached(self):
         """Ne pas utiliser RRDCached s'il y a des seuils"""
@@ -234,7 +560,7 @@ class RRDToolManagerTestCase(unittest.TestCase):
               "ventilation": "ventilation_group",
               }
         self.mgr.rrdtool.run.side_effect = lambda *a, **kw: defer.succeed(
-                "DS\n\ntimestamp: 42\n")
+                "DS\n\n1165939500: 42\n")
         d = self.mgr.getLastValue(ds, msg)
         def check_no_rrdcached(r):
             print(self.mgr.rrdtool.run.call_args_list)
@@ -6,6 +6,7 @@
 
 import unittest
 from vigilo.connector_metro.rrdtool import parse_rrdtool_response
+from vigilo.connector_metro.rrdtool import parse_fetch
 
 class RRDToolParserTestCase(unittest.TestCase):
     def test_empty(self):
@@ -46,3 +47,34 @@ class RRDToolParserTestCase(unittest.TestCase):
         """Les valeurs non convertibles en float doivent être ignorées"""
         output = "123456789: 42\n123456789: abc\n"
         self.assertEqual(parse_rrdtool_response(output, "localhost/ineth0.rrd"), 42)
+
+
+class FetchParserTestCase(unittest.TestCase):
+    def test_arrays(self):
+        """Sortie de RRDTool convertie en tableaux"""
+        output = ("                             DS\n\n"
+                  "1165939500: 4.1000000000e+01\n"
+                  "1165939800: 4.2000000000e+01\n"
+                  "1165940100: -nan\n")
+        result = parse_fetch(output)
+        self.assertEqual(result.names, ["DS"])
+        self.assertEqual(len(result), 3)
+        self.assertEqual(list(result.timestamps),
+                         [1165939500, 1165939800, 1165940100])
+        self.assertEqual(list(result.values)[:2], [41, 42])
+        self.assertTrue(result.values[2] != result.values[2])
+        self.assertEqual(result.last(), (1165939800, 42))
+
+    def test_columns(self):
+        """Plusieurs sources de données"""
+        output = " in out\n\n1165939500: 1 2\n1165939800: 3 abc\n"
+        result = parse_fetch(output)
+        self.assertEqual(result.names, ["in", "out"])
+        self.assertEqual(list(result.columns[0]), [1, 3])
+        self.assertEqual(result.last(1), (1165939500, 2))
+
+    def test_empty(self):
+        """Aucune donnée"""
+        result = parse_fetch("")
+        self.assertEqual(len(result), 0)
+        self.assertTrue(result.last() is None)
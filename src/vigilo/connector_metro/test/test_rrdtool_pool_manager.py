@@ -19,9 +19,11 @@ from nose.twistedtools import reactor, deferred
 
 from mock import Mock
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from vigilo.connector_metro.rrdtool import RRDToolPoolManager
+from vigilo.connector_metro.rrdtool import RRDToolPool
+from vigilo.connector_metro.rrdtool import RRDToolError
 
 
 class RRDToolPoolManagerTestCase(unittest.TestCase):
@@ -163,3 +165,338 @@ class RRDToolPoolManagerTestCase(unittest.TestCase):
 
 
 
+
+
+    @deferred(timeout=30)
+    def test_concurrent_start(self):
+        """Les démarrages simultanés ne lancent les processus qu'une fois"""
+        mgr = RRDToolPoolManager(self.rrd_base_dir, "flat", "/usr/bin/rrdtool",
+                    check_thresholds=False)
+        mgr.checkBinary = Mock()
+        started = defer.Deferred()
+        mgr.pool.start = Mock(return_value=started)
+        d1 = mgr.start()
+        d2 = mgr.start()
+        self.assertEqual(mgr.pool.start.call_count, 1)
+        self.assertFalse(d2.called)
+        started.callback(None)
+        d = defer.DeferredList([d1, d2], fireOnOneErrback=True)
+        def check(r):
+            self.assertTrue(mgr.started)
+            self.assertEqual(mgr.pool.start.call_count, 1)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_background_pool(self):
+        """Les tâches de fond sont envoyées sur le pool dédié"""
+        mgr = RRDToolPoolManager(self.rrd_base_dir, "flat", "/usr/bin/rrdtool",
+                    check_thresholds=False, background_pool_size=1)
+        mgr.pool.run = Mock(name="main")
+        mgr.pool_background.run = Mock(name="background")
+        # Ne rien forker
+        mgr.pool.build()
+        mgr.pool_background.build()
+        for p in mgr.pool.pool + mgr.pool_background.pool:
+            p.start = lambda: defer.succeed(None)
+        d = mgr.run("create", "dummy.rrd", ["dummy"], background=True)
+        def check(r):
+            mgr.pool_background.run.assert_called_with("create", "dummy.rrd",
+                                                       ["dummy"])
+            self.assertFalse(mgr.pool.run.called)
+        d.addCallback(check)
+        return d
+
+
+
+class ProcessStub(object):
+    """Processus rrdtool dont les tâches sont terminées à la demande"""
+    def __init__(self, *args):
+        self.jobs = []
+    @property
+    def working(self):
+        return bool(self.jobs)
+    @property
+    def load(self):
+        return len(self.jobs)
+    def start(self):
+        return defer.succeed(None)
+    def quit(self):
+        return defer.succeed(None)
+    def run(self, command, filename, args):
+        d = defer.Deferred()
+        self.jobs.append((filename, args, d))
+        return d
+    def finish(self):
+        filename, args, d = self.jobs.pop(0)
+        d.callback(args)
+
+
+
+class RRDToolPoolTestCase(unittest.TestCase):
+    """
+    Test de la répartition des tâches sur les processus RRDTool
+    """
+
+
+    def setUp(self):
+        self.pool = RRDToolPool(2, "/usr/bin/rrdtool", affinity=True)
+        self.pool.processProtocolFactory = ProcessStub
+        self.pool.build()
+
+
+    def test_queue(self):
+        """Les tâches attendent qu'un processus se libère"""
+        pool = RRDToolPool(2, "/usr/bin/rrdtool")
+        pool.processProtocolFactory = ProcessStub
+        pool.build()
+        results = []
+        for i in range(4):
+            pool.run("update", "%d.rrd" % i, i).addCallback(results.append)
+        self.assertEqual([len(p.jobs) for p in pool], [1, 1])
+        self.assertEqual(len(pool._waiting), 2)
+        pool.pool[1].finish()
+        self.assertEqual(pool.pool[1].jobs[0][1], 2)
+        pool.pool[0].finish()
+        pool.pool[0].finish()
+        pool.pool[1].finish()
+        self.assertEqual(results, [1, 0, 3, 2])
+        self.assertEqual(len(pool._waiting), 0)
+        self.assertEqual(pool._idle_set, set(pool.pool))
+
+
+    def test_sync_failure(self):
+        """Pas de récursion si les tâches échouent immédiatement"""
+        pool = RRDToolPool(1, "/usr/bin/rrdtool")
+        pool.processProtocolFactory = ProcessStub
+        pool.build()
+        errors = []
+        for i in range(3000):
+            pool.run("update", "%d.rrd" % i, i).addErrback(errors.append)
+        process = pool.pool[0]
+        process.run = lambda *args: defer.fail(RRDToolError("dummy", "dead"))
+        process.finish()
+        # une seule tâche tentée, les autres restent en attente
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(pool.queued, 2998)
+
+
+    def test_affinity_order(self):
+        """Les tâches d'un même fichier restent sur le même processus"""
+        results = []
+        for i in range(3):
+            self.pool.run("update", "a.rrd", i).addCallback(results.append)
+        busy = [p for p in self.pool if p.working]
+        self.assertEqual(len(busy), 1)
+        while busy[0].jobs:
+            busy[0].finish()
+        self.assertEqual(results, [0, 1, 2])
+        self.assertEqual(self.pool._owners, {})
+
+
+    def test_affinity_steal(self):
+        """Un processus inactif reprend la tâche en attente d'un autre"""
+        first = self.pool.pool[hash("a.rrd") % 2]
+        other = self.pool.pool[1 - hash("a.rrd") % 2]
+        self.pool.run("update", "a.rrd", "a")
+        # Trouver un autre fichier associé au même processus
+        filename = [f for f in ("%d.rrd" % i for i in range(100))
+                    if hash(f) % 2 == hash("a.rrd") % 2][0]
+        self.pool.run("update", filename, "b")
+        self.assertEqual(len(first.jobs), 1)
+        self.assertEqual(len(other.jobs), 1)
+        self.assertEqual(other.jobs[0][0], filename)
+        self.assertTrue(self.pool._owners[filename][0] is other)
+
+
+    def test_affinity_no_steal(self):
+        """Pas de vol de tâche si le fichier a déjà une tâche en cours"""
+        first = self.pool.pool[hash("a.rrd") % 2]
+        other = self.pool.pool[1 - hash("a.rrd") % 2]
+        self.pool.run("update", "a.rrd", "a1")
+        self.pool.run("update", "a.rrd", "a2")
+        self.assertEqual(len(first.jobs), 1)
+        self.assertEqual(len(other.jobs), 0)
+        first.finish()
+        self.assertEqual(first.jobs[0][1], "a2")
+
+
+    def test_autoscale_grow(self):
+        """Ajout d'un processus si des tâches attendent et que c'est lent"""
+        clock = task.Clock()
+        pool = RRDToolPool(3, "/usr/bin/rrdtool", min_size=1,
+                           max_latency=0.1, clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        self.assertEqual(len(pool), 1)
+        for i in range(4):
+            pool.run("update", "%d.rrd" % i, i)
+        pool.pool[0].finish()
+        # Pas de croissance tant que la latence est faible
+        clock.advance(5)
+        self.assertEqual(len(pool), 1)
+        pool.pool[0].finish()
+        self.assertTrue(pool.latency > 0.1)
+        clock.advance(pool.scale_interval)
+        self.assertEqual(len(pool), 2)
+        # Le nouveau processus prend les tâches en attente
+        self.assertEqual(pool.queued, 0)
+        self.assertEqual([p.load for p in pool], [1, 1])
+        pool.stop()
+
+
+    def test_current_latency(self):
+        """Latence actuelle : attente de la plus ancienne tâche"""
+        clock = task.Clock()
+        pool = RRDToolPool(1, "/usr/bin/rrdtool", clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        self.assertEqual(pool.currentLatency(), 0)
+        pool.run("update", "0.rrd", 0)
+        pool.run("update", "1.rrd", 1)
+        clock.advance(5)
+        # processus bloqué : la moyenne n'a pas encore été mise à jour
+        self.assertEqual(pool.latency, 0)
+        self.assertEqual(pool.currentLatency(), 5)
+        pool.pool[0].finish()
+        pool.pool[0].finish()
+        self.assertEqual(pool.currentLatency(), 0)
+        pool.stop()
+
+
+    def test_current_latency_pipeline(self):
+        """Latence actuelle : tâches bloquées dans un processus"""
+        clock = task.Clock()
+        pool = RRDToolPool(1, "/usr/bin/rrdtool", pipeline=3, clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        process = pool.pool[0]
+        process.__class__ = type("PipelineStub", (ProcessStub, ),
+                {"working": property(lambda p: len(p.jobs) >= 3)})
+        pool.run("update", "0.rrd", 0)
+        clock.advance(2)
+        pool.run("update", "1.rrd", 1)
+        clock.advance(3)
+        # aucune tâche en attente d'un processus
+        self.assertEqual(pool.queued, 0)
+        self.assertEqual(pool.currentLatency(), 5)
+        process.finish()
+        self.assertEqual(pool.latency, 1)
+        self.assertEqual(pool.currentLatency(), 3)
+        clock.advance(1)
+        self.assertEqual(pool.currentLatency(), 4)
+        process.finish()
+        self.assertEqual(pool.currentLatency(), 0)
+        pool.stop()
+
+
+    def test_latency_sync_failure(self):
+        """Les tâches qui échouent immédiatement ne comptent pas"""
+        clock = task.Clock()
+        pool = RRDToolPool(1, "/usr/bin/rrdtool", clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        pool.run("update", "0.rrd", 0)
+        clock.advance(1)
+        pool.pool[0].finish()
+        latency = pool.latency
+        self.assertEqual(latency, 0.2)
+        pool.pool[0].run = lambda *args: defer.fail(
+                RRDToolError("dummy", "dead"))
+        for i in range(10):
+            pool.run("update", "%d.rrd" % i, i).addErrback(lambda _f: None)
+        self.assertEqual(pool.latency, latency)
+        pool.stop()
+
+
+    def test_stats(self):
+        """Attente, durée d'exécution et occupation des processus"""
+        clock = task.Clock()
+        pool = RRDToolPool(2, "/usr/bin/rrdtool", clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        for i in range(3):
+            pool.run("update", "%d.rrd" % i, i)
+        clock.advance(1)
+        pool.pool[0].finish()
+        clock.advance(1)
+        pool.pool[0].finish()
+        pool.pool[1].finish()
+        clock.advance(2)
+        stats = pool.getStats("rrd_")
+        self.assertEqual(stats["rrd_wait_count"], 3)
+        self.assertEqual(stats["rrd_wait_max"], 1000)
+        self.assertEqual(stats["rrd_update_count"], 3)
+        self.assertEqual(stats["rrd_update_max"], 2000)
+        self.assertEqual(stats["rrd_update_rate"], 0.75)
+        self.assertEqual(stats["rrd_processes"], 2)
+        # occupés 2 secondes sur 4
+        self.assertEqual(stats["rrd_busy_avg"], 50)
+        self.assertEqual(stats["rrd_busy_max"], 50)
+        # remise à zéro à chaque relevé
+        clock.advance(1)
+        stats = pool.getStats("rrd_")
+        self.assertEqual(stats["rrd_update_count"], 0)
+        self.assertEqual(stats["rrd_busy_max"], 0)
+        pool.stop()
+
+
+    def test_stop(self):
+        """L'arrêt fait échouer les tâches en attente et arrête tout"""
+        pool = RRDToolPool(2, "/usr/bin/rrdtool", affinity=True)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        starting = defer.Deferred()
+        spawned = ProcessStub()
+        spawned.start = lambda: starting
+        spawned.quit = Mock(return_value=defer.succeed(None))
+        pool._createProcess = lambda: spawned
+        pool._spawn()
+        results = []
+        errors = []
+        for i in range(3):
+            pool.run("update", "a.rrd", i).addCallbacks(
+                    results.append, errors.append)
+        d = pool.stop()
+        # la tâche en cours se termine, les autres échouent
+        self.assertEqual(len(errors), 2)
+        for f in errors:
+            self.assertTrue(f.check(RRDToolError))
+        self.assertEqual(pool.queued, 0)
+        busy = [p for p in pool if p.working][0]
+        self.assertEqual(pool._owners, {"a.rrd": [busy, 1]})
+        busy.finish()
+        self.assertEqual(results, [0])
+        self.assertEqual(pool._owners, {})
+        # le processus en cours de démarrage est arrêté, pas ajouté
+        self.assertFalse(d.called)
+        starting.callback(None)
+        self.assertTrue(d.called)
+        self.assertTrue(spawned.quit.called)
+        self.assertEqual(len(pool), 2)
+        # plus de nouvelle tâche
+        pool.run("update", "b.rrd", 0).addErrback(errors.append)
+        self.assertEqual(len(errors), 3)
+
+
+    def test_autoscale_shrink(self):
+        """Arrêt des processus inactifs au-delà du minimum"""
+        clock = task.Clock()
+        pool = RRDToolPool(3, "/usr/bin/rrdtool", min_size=1,
+                           idle_timeout=60, clock=clock)
+        pool.processProtocolFactory = ProcessStub
+        pool.start()
+        pool._spawn()
+        pool._spawn()
+        self.assertEqual(len(pool), 3)
+        pool.run("update", "0.rrd", 0)
+        busy = [p for p in pool if p.working][0]
+        clock.advance(30)
+        busy.finish()
+        clock.advance(31)
+        self.assertEqual(pool.pool, [busy])
+        clock.advance(60)
+        self.assertEqual(pool.pool, [busy])
+        pool.stop()
+
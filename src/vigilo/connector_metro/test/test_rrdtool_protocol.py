@@ -77,9 +77,9 @@ class RRDToolProcessProtocolTest(unittest.TestCase):
                          % (command, filename, " ".join(args)))
         def cb(r):
             self.assertEqual(self.process.working, False)
-            self.assertEqual(self.process.deferred, None)
+            self.assertEqual(self.process.load, 0)
         d.addCallback(cb)
-        self.process.outReceived("OK dummy\n")
+        self.process.outReceived("OK u:0.00 s:0.00 r:0.00\n")
         return d
 
 
@@ -96,7 +96,8 @@ class RRDToolProcessProtocolTest(unittest.TestCase):
     @deferred(timeout=30)
     def test_run_output(self):
         """Récupération de la sortie d'une commande"""
-        fake_output = ["dummy 1", "dummy 2", "dummy 3", "OK done"]
+        fake_output = ["dummy 1", "dummy 2", "dummy 3",
+                       "OK u:0.00 s:0.00 r:0.00"]
         d = self.process.run("", "", "")
         def cb(r):
             self.assertEqual(r, "\n".join(fake_output[:-1]))
@@ -106,6 +107,37 @@ class RRDToolProcessProtocolTest(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_run_output_status(self):
+        """Seule une vraie ligne de statut termine la commande"""
+        d = self.process.run("", "", "")
+        results = []
+        d.addCallback(results.append)
+        self.process.outReceived("OK not a status\nOK u:0.00 s:0.00\n")
+        self.assertEqual(results, [])
+        self.process.outReceived("OK u:0.00 s:0.00 r:0.00\n")
+        self.assertEqual(results, ["OK not a status\nOK u:0.00 s:0.00"])
+        return d
+
+
+    @deferred(timeout=30)
+    def test_run_large_output(self):
+        """Réponse de plusieurs mégaoctets reçue par petits morceaux"""
+        lines = ["                             DS", ""]
+        lines.extend(["%d: %.10e" % (1300000000 + i * 60, i * 0.5)
+                      for i in range(100000)])
+        output = "\n".join(lines + ["OK u:0.10 s:0.02 r:0.12", ""])
+        self.assertTrue(len(output) > 2 * 1024 * 1024)
+        d = self.process.run("fetch", "dummy_filename", "AVERAGE")
+        results = []
+        d.addCallback(results.append)
+        for i in range(0, len(output), 4096):
+            self.process.outReceived(output[i:i + 4096])
+        self.assertEqual(results, ["\n".join(lines)])
+        self.assertEqual(len(self.process._buffer), 0)
+        return d
+
+
     @deferred(timeout=30)
     def test_run_error(self):
         """Récupération de la sortie d'une commande"""
@@ -131,12 +163,78 @@ class RRDToolProcessProtocolTest(unittest.TestCase):
         def cb(r):
             self.fail("Il y aurait dû y avoir un errback")
         def eb(f):
-            self.assertEqual(f.type, AttributeError)
+            self.assertEqual(f.type, RRDToolError)
             self.assertFalse(self.process.working)
         d.addCallbacks(cb, eb)
         return d
 
 
+    @deferred(timeout=30)
+    def test_run_pipeline(self):
+        """Plusieurs commandes envoyées à l'avance (pipeline)"""
+        self.process.pipeline = 3
+        results = []
+        dl = []
+        for i in range(3):
+            d = self.process.run("update", "file%d" % i, "%d:42" % i)
+            d.addCallbacks(results.append, lambda f: results.append(f.value))
+            dl.append(d)
+        self.assertTrue(self.process.working)
+        self.assertEqual(self.process.load, 3)
+        self.assertEqual(self.transport.getvalue(),
+                         "update file0 0:42\nupdate file1 1:42\n"
+                         "update file2 2:42\n")
+        # les réponses arrivent découpées de manière arbitraire
+        self.process.outReceived("out 0\nOK u:0.00 s:0.00 r:0.00\nERR")
+        self.process.outReceived("OR: failed\nout 2\nOK u:0.00 s:0.")
+        self.process.outReceived("00 r:0.00\n")
+        def check(r):
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results[0], "out 0")
+            self.assertTrue(isinstance(results[1], RRDToolError))
+            self.assertEqual(results[1].filename, "file1")
+            self.assertEqual(results[1].args[0], "failed")
+            self.assertEqual(results[2], "out 2")
+            self.assertFalse(self.process.working)
+        d = defer.DeferredList(dl)
+        d.addCallback(check)
+        return d
+
+
+    def test_pending_on_process_ended(self):
+        """Les commandes en attente échouent si le processus s'arrête"""
+        self.process.start = lambda: None
+        d = self.process.run("update", "dummy_filename", "0:42")
+        errors = []
+        d.addErrback(errors.append)
+        self.process.processEnded(Failure(ProcessTerminated()))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+        self.assertEqual(self.process.load, 0)
+
+
+    def test_run_process_ended(self):
+        """Pas de commande envoyée à un processus arrêté"""
+        self.process.start = lambda: None
+        self.process.processEnded(Failure(ProcessTerminated()))
+        self.assertFalse(self.process.running)
+        self.assertTrue(self.process.working)
+        errors = []
+        self.process.run("update", "dummy_filename", "0:42").addErrback(
+                errors.append)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].type, RRDToolError)
+        self.assertEqual(self.transport.getvalue(), "")
+
+
+    def test_ready_callback(self):
+        """Le pool est prévenu quand le processus (re)démarre"""
+        ready = []
+        self.process.ready_callback = ready.append
+        self.process.connectionMade()
+        self.assertEqual(ready, [self.process])
+
+
     def test_quit(self):
         """Arrêt du processus"""
         self.process.quit()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import os
+import tempfile
+from shutil import rmtree
+import unittest
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+#from twisted.trial import unittest
+from nose.twistedtools import reactor, deferred
+
+from twisted.internet import defer, task
+
+from vigilo.connector_metro.spool import MessageSpool
+
+
+
+def perf(timestamp, value):
+    return {"type": "perf", "timestamp": str(timestamp),
+            "host": u"server1.example.com", "datasource": u"Load",
+            "value": str(value)}
+
+
+
+class MessageSpoolTestCase(unittest.TestCase):
+    """
+    Test de la mise en attente des messages sur disque
+    """
+
+
+    @deferred(timeout=30)
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test-connector-metro-")
+        self.clock = task.Clock()
+        self.spool = MessageSpool(os.path.join(self.tmpdir, "spool"),
+                                  clock=self.clock)
+        self.replayed = []
+        return self.spool.open()
+
+    def tearDown(self):
+        if self.spool._writer.started:
+            self.spool._writer.stop()
+        rmtree(self.tmpdir)
+
+
+    def process(self, messages):
+        self.replayed.extend(messages)
+        return defer.succeed(None)
+
+
+    @deferred(timeout=30)
+    def test_replay_order(self):
+        """Rejeu des messages triés par horodatage"""
+        for timestamp in (1165939800, 1165939500, 1165939739):
+            self.spool.append(perf(timestamp, 42))
+        self.assertEqual(len(self.spool), 3)
+        d = self.spool.replay(self.process)
+        def check(complete):
+            self.assertTrue(complete)
+            self.assertEqual([m["timestamp"] for m in self.replayed],
+                             ["1165939500", "1165939739", "1165939800"])
+            self.assertEqual(self.replayed[0]["host"], u"server1.example.com")
+            self.assertEqual(len(self.spool), 0)
+            self.assertEqual(self.spool.replayed, 3)
+            self.assertEqual(os.listdir(self.spool.directory), [])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_segments(self):
+        """Découpage en segments et synchronisation différée"""
+        self.spool.segment_size = 200
+        for i in range(5):
+            self.spool.append(perf(1165939500 + i, i))
+        self.assertEqual(len(self.spool._segments), 2)
+        self.assertTrue(self.spool._sync_call.active())
+        # pas d'écriture avant la synchronisation
+        self.assertEqual(len(self.spool._buffer), 1)
+        self.clock.advance(self.spool.sync_delay)
+        self.assertTrue(self.spool._sync_call is None)
+        self.assertEqual(self.spool._buffer, [])
+        # écritures terminées à l'arrêt du thread d'écriture
+        d = self.spool.close()
+        def check(r):
+            self.assertEqual(len(os.listdir(self.spool.directory)), 3)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_reopen(self):
+        """Reprise des messages laissés par une exécution précédente"""
+        self.spool.append(perf(1165939500, 1))
+        self.spool.append(perf(1165939800, 2))
+        d = self.spool.close()
+        def reopen(r):
+            # dernière ligne incomplète : arrêt brutal pendant l'écriture
+            with open(self.spool._segments[0][0], "ab") as segment:
+                segment.write('{"type": "pe')
+            self.spool = MessageSpool(self.spool.directory, clock=self.clock)
+            scanned = self.spool.open()
+            # ajouté pendant le recensement : rejoué après les anciens
+            self.spool.append(perf(1165940100, 3))
+            self.assertEqual(len(self.spool), 1)
+            scanned.addCallback(lambda _x: self.assertEqual(len(self.spool), 4))
+            scanned.addCallback(lambda _x: self.spool.replay(self.process))
+            return scanned
+        def check(r):
+            self.assertEqual([m["value"] for m in self.replayed],
+                             ["1", "2", "3"])
+            self.assertEqual(len(self.spool), 0)
+            self.assertEqual(os.listdir(self.spool.directory), [])
+        d.addCallback(reopen)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_replay_interrupted(self):
+        """Le rejeu interrompu reprend au même point"""
+        for i in range(5):
+            self.spool.append(perf(1165939500 + i, i))
+        proceed = [True, True, False]
+        d = self.spool.replay(self.process, chunk_size=2,
+                              proceed=lambda: proceed.pop(0))
+        def check_interrupted(complete):
+            self.assertFalse(complete)
+            self.assertEqual(len(self.replayed), 4)
+            self.assertEqual(len(self.spool), 1)
+            self.assertFalse(self.spool.replaying)
+            return self.spool.replay(self.process, chunk_size=2)
+        def check_complete(complete):
+            self.assertTrue(complete)
+            self.assertEqual([m["value"] for m in self.replayed],
+                             ["0", "1", "2", "3", "4"])
+        d.addCallback(check_interrupted)
+        d.addCallback(check_complete)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_replay_offset(self):
+        """Le rejeu reprend à la position enregistrée après un redémarrage"""
+        for i in range(5):
+            self.spool.append(perf(1165939500 + i, i))
+        proceed = [True, False]
+        d = self.spool.replay(self.process, chunk_size=2,
+                              proceed=lambda: proceed.pop(0))
+        d.addCallback(lambda _x: self.spool.close())
+        def reopen(r):
+            self.spool = MessageSpool(self.spool.directory, clock=self.clock)
+            return self.spool.open()
+        def replay(r):
+            self.assertEqual(len(self.spool), 3)
+            return self.spool.replay(self.process, chunk_size=2)
+        def check(complete):
+            self.assertTrue(complete)
+            self.assertEqual([m["value"] for m in self.replayed],
+                             ["0", "1", "2", "3", "4"])
+            self.assertEqual(os.listdir(self.spool.directory), [])
+        d.addCallback(reopen)
+        d.addCallback(replay)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_replay_late(self):
+        """Messages trop anciens d'un lot à l'autre : écartés"""
+        for timestamp, value in ((1165939500, 1), (1165939800, 2),
+                                 (1165939739, 3), (1165940100, 4)):
+            self.spool.append(perf(timestamp, value))
+        d = self.spool.replay(self.process, chunk_size=2)
+        def check(complete):
+            self.assertTrue(complete)
+            self.assertEqual([m["value"] for m in self.replayed],
+                             ["1", "2", "4"])
+            self.assertEqual(self.spool.dropped, 1)
+            self.assertEqual(self.spool.replayed, 3)
+            self.assertEqual(len(self.spool), 0)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_close_during_replay(self):
+        """L'arrêt interrompt le rejeu avant d'arrêter le thread d'écriture"""
+        for i in range(5):
+            self.spool.append(perf(1165939500 + i, i))
+        processing = defer.Deferred()
+        def process(messages):
+            self.replayed.extend(messages)
+            return processing
+        replayed = self.spool.replay(process, chunk_size=2)
+        closed = []
+        def close(r):
+            self.closing = self.spool.close()
+            self.closing.addCallback(closed.append)
+            # le lot en cours se termine avant l'arrêt
+            self.assertEqual(closed, [])
+            self.assertTrue(self.spool._writer.started)
+            processing.callback(None)
+            return replayed
+        def check(complete):
+            self.assertFalse(complete)
+            self.assertFalse(self.spool.replaying)
+            self.assertEqual(len(self.replayed), 2)
+            self.assertEqual(len(self.spool), 3)
+            return self.closing
+        def check_closed(r):
+            self.assertEqual(closed, [None])
+            self.assertFalse(self.spool._writer.started)
+        # le premier lot est relu dans le thread d'écriture
+        d = task.deferLater(reactor, 0.1, lambda: None)
+        d.addCallback(close)
+        d.addCallback(check)
+        d.addCallback(check_closed)
+        return d
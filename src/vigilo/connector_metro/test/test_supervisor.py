@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 ts=4 ai:
+# pylint: disable-msg=R0904,C0111,W0613,W0212
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+from __future__ import absolute_import
+
+import unittest
+
+from mock import patch
+
+from twisted.internet.error import ProcessTerminated
+from twisted.python.failure import Failure
+
+from vigilo.connector_metro import supervisor
+from vigilo.connector_metro.supervisor import MetroSupervisor
+from vigilo.connector_metro.supervisor import get_shard, host_shard
+from vigilo.connector_metro.supervisor import worker_argv
+
+
+
+class SupervisorTestCase(unittest.TestCase):
+    """
+    Test du mode multi-processus
+    """
+
+
+    def test_get_shard(self):
+        """Lecture de la partition dans l'environnement"""
+        self.assertEqual(get_shard({}), None)
+        self.assertEqual(get_shard({"VIGILO_METRO_SHARD": "1/4"}), (1, 4))
+
+
+    def test_host_shard(self):
+        """La répartition ne dépend que du nom de l'hôte"""
+        for hostname in (u"server1.example.com", u"A b/c.example.com",
+                         u"h\xf4te"):
+            shard = host_shard(hostname, 4)
+            self.assertTrue(0 <= shard < 4)
+            self.assertEqual(shard, host_shard(hostname, 4))
+        self.assertEqual(host_shard(u"server1.example.com", 4),
+                         host_shard("server1.example.com", 4))
+
+
+    @patch.object(supervisor, "reactor")
+    def test_spawn(self, reactor):
+        """Chaque processus fils reçoit sa partition"""
+        sup = MetroSupervisor(3, argv=["/usr/bin/python", "twistd"],
+                              environ={"VIGILO_SETTINGS": "settings.ini"})
+        sup.startService()
+        self.assertEqual(reactor.spawnProcess.call_count, 3)
+        for index, call in enumerate(reactor.spawnProcess.call_args_list):
+            args, kwargs = call
+            self.assertEqual(args[1:], ("/usr/bin/python",
+                                        ["/usr/bin/python", "twistd",
+                                         "--nodaemon", "--pidfile="]))
+            self.assertEqual(kwargs["env"], {
+                    "VIGILO_SETTINGS": "settings.ini",
+                    "VIGILO_METRO_SHARD": "%d/3" % index,
+                })
+
+
+    def test_worker_argv(self):
+        """Les fils restent au premier plan, avec leur propre fichier PID"""
+        argv = ["/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--pidfile", "/var/run/metro/metro.pid", "-l", "/dev/null",
+                "-d", "/var/lib/vigilo/rrd",
+                "vigilo-metro", "--config", "settings.ini", "-l", "x"]
+        self.assertEqual(worker_argv(argv, 1), [
+                "/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--nodaemon", "--pidfile=/var/run/metro/metro-1.pid",
+                "--logfile=/dev/null", "--rundir=/var/lib/vigilo/rrd",
+                "vigilo-metro", "--config", "settings.ini", "-l", "x"])
+        argv = ["/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--pidfile=", "-n", "vigilo-metro"]
+        self.assertEqual(worker_argv(argv, 0), [
+                "/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--nodaemon", "--pidfile=", "vigilo-metro"])
+
+
+    def test_worker_argv_combined(self):
+        """Options courtes combinées et valeurs accolées"""
+        argv = ["/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "-no", "-l/dev/null", "-d/var/lib/vigilo/rrd",
+                "vigilo-metro"]
+        self.assertEqual(worker_argv(argv, 2), [
+                "/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--nodaemon", "--pidfile=", "--no_save",
+                "--logfile=/dev/null", "--rundir=/var/lib/vigilo/rrd",
+                "vigilo-metro"])
+
+
+    def test_worker_argv_long(self):
+        """Options longues abrégées ou inconnues de l'ancienne analyse"""
+        argv = ["/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--pid=/var/run/metro.pid", "--umask=0022",
+                "--reactor=poll", "--logf", "/tmp/metro.log",
+                "--nodaemon", "vigilo-metro", "--pidfile=x"]
+        self.assertEqual(worker_argv(argv, 0), [
+                "/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--nodaemon", "--pidfile=/var/run/metro-0.pid",
+                "--umask=0022", "--reactor=poll",
+                "--logfile=/tmp/metro.log", "vigilo-metro",
+                "--pidfile=x"])
+
+
+    def test_worker_argv_systemd(self):
+        """Ligne de commande de pkg/vigilo-connector-metro@.service"""
+        argv = ["/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "-d", "/var/lib/vigilo/rrd", "--pidfile", "", "-l",
+                "/dev/null", "-n", "vigilo-metro", "--config",
+                "/etc/vigilo/connector-metro/settings.ini", "--id", "1"]
+        self.assertEqual(worker_argv(argv, 3), [
+                "/usr/bin/python", "/usr/bin/vigilo-connector-metro",
+                "--nodaemon", "--pidfile=", "--rundir=/var/lib/vigilo/rrd",
+                "--logfile=/dev/null", "vigilo-metro", "--config",
+                "/etc/vigilo/connector-metro/settings.ini", "--id", "1"])
+
+
+    @patch.object(supervisor, "reactor")
+    def test_respawn(self, reactor):
+        """Un processus fils qui s'arrête est relancé"""
+        sup = MetroSupervisor(2, argv=["/usr/bin/python", "twistd"])
+        sup.startService()
+        worker = sup.workers[1]
+        worker.processEnded(Failure(ProcessTerminated(1)))
+        self.assertFalse(1 in sup.workers)
+        delay, func, index = reactor.callLater.call_args[0]
+        func(index)
+        self.assertEqual(reactor.spawnProcess.call_count, 3)
+        self.assertTrue(1 in sup.workers)
+        self.assertFalse(sup.workers[1] is worker)
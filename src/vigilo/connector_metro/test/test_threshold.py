@@ -68,6 +68,18 @@ class ThresholdTestCase(unittest.TestCase):
         """Seuil non valide."""
         self.assertRaises(ValueError, threshold.is_out_of_bounds, 1, '4:2')
 
+    def test_parse_threshold(self):
+        """Seuils analysés une seule fois"""
+        th = threshold.parse_threshold(u"@10:20")
+        self.assertEqual(th, threshold.Threshold(10, 20, True))
+        self.assertFalse(th.contains(15))
+        self.assertTrue(th.contains(25))
+        self.assertTrue(threshold.is_out_of_bounds(15, th))
+        self.assertEqual(threshold.parse_threshold("~:10"),
+                         threshold.Threshold(high=10))
+        for invalid in ["4:2", "abc", "1:2:3", "~:"]:
+            self.assertRaises(ValueError, threshold.parse_threshold, invalid)
+
 
 
 class ThresholdCheckerTestCase(unittest.TestCase):
@@ -212,3 +224,136 @@ class ThresholdCheckerTestCase(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_message_values(self):
+        """Calcul de la valeur à partir des messages (COUNTER)"""
+        self.tc.use_message_values = True
+        self.tc.rrdtool.getLastValue.side_effect = \
+                lambda *a: defer.succeed(None)
+        ds = {"hostname": "server1.example.com",
+              "datasource": "ineth0",
+              "type": "COUNTER",
+              "PDP_step": 300,
+              "heartbeat": 600,
+              "factor": 1,
+              "warning_threshold": "0.8",
+              "critical_threshold": "0.9",
+              "nagiosname": "Traffic",
+              "ventilation": "ventilation_group",
+              }
+        self.tc.confdb.get_datasource.side_effect = \
+                lambda *a, **kw: defer.succeed(ds)
+        self.tc._compare_thresholds = Mock()
+        msg1 = {"host": "server1.example.com", "datasource": "ineth0",
+                "timestamp": "1165939439", "value": "1000"}
+        msg2 = {"host": "server1.example.com", "datasource": "ineth0",
+                "timestamp": "1165939739", "value": "1150"}
+        d = self.tc.checkMessage(msg1)
+        def check_first(r):
+            # pas de valeur précédente : lecture dans le fichier RRD
+            self.assertEqual(self.tc.rrdtool.getLastValue.call_count, 1)
+            return self.tc.checkMessage(msg2)
+        def check_second(r):
+            self.assertEqual(self.tc.rrdtool.getLastValue.call_count, 1)
+            self.tc._compare_thresholds.assert_called_with(0.5, ds)
+        d.addCallback(check_first)
+        d.addCallback(check_second)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_message_values_batch(self):
+        """Taux calculé entre les deux derniers échantillons d'un lot"""
+        self.tc.use_message_values = True
+        ds = {"hostname": "server1.example.com",
+              "datasource": "ineth0",
+              "type": "COUNTER",
+              "PDP_step": 300,
+              "heartbeat": 600,
+              "factor": 1,
+              "warning_threshold": "0.8",
+              "critical_threshold": "0.9",
+              "nagiosname": "Traffic",
+              "ventilation": "ventilation_group",
+              }
+        self.tc.confdb.get_datasource.return_value = defer.succeed(ds)
+        self.tc._compare_thresholds = Mock()
+        for timestamp, value in (("1165939139", "1000"),
+                                 ("1165939439", "1030")):
+            self.tc.rememberSample({"host": "server1.example.com",
+                                    "datasource": "ineth0",
+                                    "timestamp": timestamp, "value": value})
+        d = self.tc.checkMessage({"host": "server1.example.com",
+                                  "datasource": "ineth0",
+                                  "timestamp": "1165939739",
+                                  "value": "1180"})
+        def check(r):
+            self.assertFalse(self.tc.rrdtool.getLastValue.called)
+            # (1180 - 1030) / 300, et non (1180 - 1000) / 600
+            self.tc._compare_thresholds.assert_called_with(0.5, ds)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_message_values_bounds(self):
+        """Valeur hors des bornes de l'indicateur : relue dans le RRD"""
+        self.tc.use_message_values = True
+        self.tc.rrdtool.getLastValue.side_effect = \
+                lambda *a: defer.succeed(None)
+        ds = {"hostname": "server1.example.com",
+              "datasource": "ineth0",
+              "type": "DERIVE",
+              "PDP_step": 300,
+              "heartbeat": 600,
+              "min": "0",
+              "max": "U",
+              "factor": 1,
+              "warning_threshold": "0.8",
+              "critical_threshold": "0.9",
+              "nagiosname": "Traffic",
+              "ventilation": "ventilation_group",
+              }
+        self.tc.confdb.get_datasource.return_value = defer.succeed(ds)
+        self.tc._compare_thresholds = Mock()
+        self.tc.rememberSample({"host": "server1.example.com",
+                                "datasource": "ineth0",
+                                "timestamp": "1165939439", "value": "1150"})
+        # remise à zéro : taux négatif, inconnu pour RRDTool
+        d = self.tc.checkMessage({"host": "server1.example.com",
+                                  "datasource": "ineth0",
+                                  "timestamp": "1165939739",
+                                  "value": "1000"})
+        def check(r):
+            self.assertEqual(self.tc.rrdtool.getLastValue.call_count, 1)
+            self.tc._compare_thresholds.assert_called_with(None, ds)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_message_values_gauge(self):
+        """Calcul de la valeur à partir des messages (GAUGE)"""
+        self.tc.use_message_values = True
+        ds = {"hostname": "server1.example.com",
+              "datasource": "Load",
+              "type": "GAUGE",
+              "PDP_step": 300,
+              "heartbeat": 600,
+              "factor": 1,
+              "warning_threshold": "0.8",
+              "critical_threshold": "0.9",
+              "nagiosname": "MetroLoad",
+              "ventilation": "ventilation_group",
+              }
+        self.tc.confdb.get_datasource.return_value = defer.succeed(ds)
+        self.tc._compare_thresholds = Mock()
+        d = self.tc.checkMessage({"host": "server1.example.com",
+                                  "datasource": "Load",
+                                  "timestamp": "1165939739",
+                                  "value": "0.85"})
+        def check(r):
+            self.assertFalse(self.tc.rrdtool.getLastValue.called)
+            self.tc._compare_thresholds.assert_called_with(0.85, ds)
+        d.addCallback(check)
+        return d
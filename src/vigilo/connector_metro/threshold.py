@@ -14,7 +14,10 @@ from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet.interfaces import IPushProducer
 
+from vigilo.connector_metro.cache import LRUCache
+from vigilo.connector_metro.histogram import Timings
 from vigilo.connector_metro.exceptions import MissingConfigurationData
+from vigilo.connector_metro.rrdtool import message_value
 
 
 
@@ -28,7 +31,8 @@ class ThresholdChecker(object):
     get_current_time = time.time
 
 
-    def __init__(self, rrdtool, confdb):
+    def __init__(self, rrdtool, confdb, use_message_values=False,
+                 samples_size=10000):
         """
         Instancie un connecteur du bus vers RRDtool pour le stockage des
         données de performance dans les fichiers RRD.
@@ -36,11 +40,22 @@ class ThresholdChecker(object):
         @param confdb: instance de la base de configuration en provenance de
             VigiConf
         @type  confdb: C{vigilo.connector_metro.confdb.MetroConfDB}
+        @param use_message_values: calculer la valeur à comparer aux seuils
+            à partir du message reçu plutôt que de la relire dans le RRD
+        @type  use_message_values: C{bool}
         """
         self.rrdtool = rrdtool
         self.confdb = confdb
         self.consumer = None # BusSender
         self._paused = True
+        self.use_message_values = use_message_values
+        # Échantillon précédent (timestamp, valeur) par (hôte, indicateur),
+        # pour le calcul des taux (COUNTER, DERIVE, ABSOLUTE)
+        self._samples = LRUCache(samples_size)
+        # Durées de lecture de la valeur à comparer aux seuils, et d'envoi
+        # de l'état sur le bus
+        self.timings = Timings(self.get_current_time,
+                               ("threshold_fetch", "publish"))
         # Tests unitaires
         self._check_thresholds_synchronously = False
 
@@ -62,6 +77,9 @@ class ThresholdChecker(object):
 
 
     def checkMessage(self, perf, sync=False):
+        sample = None
+        if self.use_message_values:
+            sample = self._rememberSample(perf)
         if (self._paused or self.consumer is None
                 or not self.consumer.isConnected()):
             # si en pause ou non connecté, on ne teste pas (info éphémère)
@@ -71,13 +89,12 @@ class ThresholdChecker(object):
 
         def get_last_value(ds, perf):
             if ds["type"].startswith("DIFF-"):
-                value = perf["value"]
+                value = message_value(perf)
                 prev = perf["prev_value"]
-                if value == u'U':
+                if value is None:
                     # On ne stocke pas les valeurs None
                     diff = prev
                 else:
-                    value = float(value)
                     if prev is None or prev > value:
                         # Pas de valeur précédente ou overflow;
                         # on fait comme si prev valait 0.
@@ -85,8 +102,12 @@ class ThresholdChecker(object):
                     else:
                         diff = value - prev
                 last = defer.succeed(diff)
+            elif self.use_message_values:
+                last = self.timings.call("threshold_fetch",
+                            self._computeValue, ds, perf, sample)
             else:
-                last = self.rrdtool.getLastValue(ds, perf)
+                last = self.timings.call("threshold_fetch",
+                            self.rrdtool.getLastValue, ds, perf)
             last.addCallback(self._compare_thresholds, ds)
             return last
         def eb(f):
@@ -99,6 +120,76 @@ class ThresholdChecker(object):
             return ds
 
 
+    def rememberSample(self, perf):
+        """
+        Enregistre la valeur d'un message sans vérifier les seuils (message
+        suivi d'un plus récent dans le même lot), pour que le taux soit
+        calculé entre échantillons consécutifs.
+        """
+        if self.use_message_values:
+            self._rememberSample(perf)
+
+
+    def getStats(self):
+        return self.timings.getStats()
+
+
+    def _rememberSample(self, perf):
+        """
+        Enregistre la valeur du message et retourne l'échantillon précédent
+        pour cet indicateur.
+        """
+        key = (perf["host"], perf["datasource"])
+        previous = self._samples.get(key)
+        self._samples[key] = (float(perf["timestamp"]), message_value(perf))
+        return previous
+
+
+    def _computeValue(self, ds, perf, previous):
+        """
+        Calcule la valeur que RRDTool aurait enregistrée à partir du message
+        et de l'échantillon précédent. Si ce n'est pas possible (valeur
+        inconnue, pas d'échantillon précédent, rebouclage d'un compteur...),
+        la valeur est relue dans le fichier RRD. C'est aussi le cas si la
+        valeur sort des bornes de l'indicateur : RRDTool enregistre alors
+        une valeur inconnue.
+        """
+        for attr in ('warning_threshold', 'critical_threshold',
+                     'nagiosname', 'ventilation'):
+            if ds[attr] is None:
+                return defer.fail(MissingConfigurationData(attr))
+        value = self._computeRate(ds, perf, previous)
+        if value is None or not in_bounds(ds, value):
+            return self.rrdtool.getLastValue(ds, perf)
+        return defer.succeed(value)
+
+
+    def _computeRate(self, ds, perf, previous):
+        """
+        Valeur calculée pour L{_computeValue}, ou C{None} si elle ne peut
+        pas l'être.
+        """
+        ds_type = ds["type"]
+        value = message_value(perf)
+        if value is None:
+            return None
+        if ds_type == "GAUGE":
+            return value
+        if previous is None or previous[1] is None:
+            return None
+        elapsed = float(perf["timestamp"]) - previous[0]
+        if elapsed <= 0 or elapsed > float(ds["heartbeat"]):
+            return None
+        if ds_type == "ABSOLUTE":
+            return value / elapsed
+        if ds_type == "COUNTER" and value < previous[1]:
+            # Rebouclage du compteur : RRDTool gère lui-même les 32/64 bits
+            return None
+        if ds_type in ("COUNTER", "DERIVE"):
+            return (value - previous[1]) / elapsed
+        return None
+
+
     def _compare_thresholds(self, last, ds):
         message = {
             'type': "nagios",
@@ -121,13 +212,22 @@ class ThresholdChecker(object):
         if int(last) == last:
             last = int(last)
 
+        # Seuils analysés au chargement de la configuration ; à défaut
+        # (description incomplète de l'indicateur), ils le sont ici.
+        critical = ds.get('critical_range')
+        warning = ds.get('warning_range')
         try:
-            if is_out_of_bounds(last, ds['critical_threshold']):
+            if critical is None:
+                critical = parse_threshold(ds['critical_threshold'])
+            if not critical.contains(last):
                 status = (2, 'CRITICAL: %s' % last)
-            elif is_out_of_bounds(last, ds['warning_threshold']):
-                status = (1, 'WARNING: %s' % last)
             else:
-                status = (0, 'OK: %s' % last)
+                if warning is None:
+                    warning = parse_threshold(ds['warning_threshold'])
+                if not warning.contains(last):
+                    status = (1, 'WARNING: %s' % last)
+                else:
+                    status = (0, 'OK: %s' % last)
         except ValueError as e:
             # Le seuil configuré est invalide.
             status = (3, 'UNKNOWN: Invalid threshold configuration (%s)' % e)
@@ -135,22 +235,74 @@ class ThresholdChecker(object):
         message["value"] = ";".join((ds['hostname'], ds['nagiosname'],
                                      str(status[0]), status[1]))
 
-        return self.consumer.write(message)
+        return self.timings.call("publish", self.consumer.write, message)
 
 
 
-def is_out_of_bounds(value, threshold):
+class Threshold(object):
     """
-    Teste si une valeur se situe hors d'une plage autorisée (seuils),
-    défini selon le format de Nagios décrit ici:
+    Plage de valeurs autorisées, décrite par un seuil au format de Nagios.
+    Le seuil est analysé une seule fois (voir L{parse_threshold}), au
+    chargement de la configuration, et non à chaque message.
+    """
+
+    __slots__ = ("low", "high", "inside")
+
+
+    def __init__(self, low=float("-inf"), high=float("inf"), inside=False):
+        """
+        @param low: borne inférieure de l'intervalle
+        @type  low: C{float}
+        @param high: borne supérieure de l'intervalle
+        @type  high: C{float}
+        @param inside: les valeurs autorisées sont hors de l'intervalle
+            (seuil commençant par C{@})
+        @type  inside: C{bool}
+        """
+        self.low = low
+        self.high = high
+        self.inside = inside
+
+
+    def contains(self, value):
+        """
+        @return: C{True} si la valeur se trouve dans la plage autorisée
+        @rtype: C{bool}
+        """
+        if self.inside:
+            return value < self.low or value > self.high
+        return self.low <= value <= self.high
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Threshold):
+            return NotImplemented
+        return ((self.low, self.high, self.inside) ==
+                (other.low, other.high, other.inside))
+
+    def __ne__(self, other):
+        if not isinstance(other, Threshold):
+            return NotImplemented
+        return not self == other
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return "<Threshold %s%s:%s>" % (self.inside and "@" or "",
+                                        self.low, self.high)
+
+
+
+def parse_threshold(threshold):
+    """
+    Analyse un seuil au format de Nagios décrit ici:
     http://nagiosplug.sourceforge.net/developer-guidelines.html#THRESHOLDFORMAT
 
-    @param value: Valeur à tester.
-    @type value: C{float}
     @param threshold: Plage autorisée (seuils) au format Nagios.
     @type threshold: C{str}
-    @return: Return True si la valeur se trouve hors de la plage autorisée
-        ou False si elle se trouve dans la plage autorisée.
+    @return: La plage autorisée.
+    @rtype: L{Threshold}
     @raise ValueError: La description de la plage autorisée est invalide.
     """
     # Adapté du code du Collector (base.pm:isOutOfBounds)
@@ -159,40 +311,64 @@ def is_out_of_bounds(value, threshold):
     inside = threshold.startswith('@')
     if inside:
         threshold = threshold[1:]
-    if not threshold:
-        threshold = ":"
+    if not threshold or threshold == ":":
+        return Threshold(inside=inside)
 
     if ":" not in threshold:
-        threshold = float(threshold)
-        if inside:
-            return value >= 0 and value <= threshold
-        return value < 0 or value > threshold
-
-    if threshold == ":":
-        return inside
+        return Threshold(0, float(threshold), inside)
 
     low, up = threshold.split(':', 2)
     if low == '~' or not low:
-        up = float(up)
-        if inside:
-            return (value <= up)
-        else:
-            return (value > up)
+        return Threshold(high=float(up), inside=inside)
 
     if not up:
-        low = float(low)
-        if inside:
-            return (value >= low)
-        else:
-            return (value < low)
+        return Threshold(low=float(low), inside=inside)
 
     low = float(low)
     up = float(up)
     if low > up:
         raise ValueError('Invalid threshold')
+    return Threshold(low, up, inside)
+
 
-    if inside:
-        return (value >= low and value <= up)
-    else:
-        return (value < low or value > up)
 
+def is_out_of_bounds(value, threshold):
+    """
+    Teste si une valeur se situe hors d'une plage autorisée (seuils),
+    défini selon le format de Nagios décrit ici:
+    http://nagiosplug.sourceforge.net/developer-guidelines.html#THRESHOLDFORMAT
+
+    @param value: Valeur à tester.
+    @type value: C{float}
+    @param threshold: Plage autorisée (seuils) au format Nagios, ou déjà
+        analysée.
+    @type threshold: C{str} ou L{Threshold}
+    @return: Return True si la valeur se trouve hors de la plage autorisée
+        ou False si elle se trouve dans la plage autorisée.
+    @raise ValueError: La description de la plage autorisée est invalide.
+    """
+    if not isinstance(threshold, Threshold):
+        threshold = parse_threshold(threshold)
+    return not threshold.contains(value)
+
+
+
+def in_bounds(ds, value):
+    """
+    Teste si une valeur se situe dans les bornes (C{min} et C{max}) d'un
+    indicateur, au-delà desquelles RRDTool enregistre une valeur inconnue.
+
+    @param ds: l'indicateur
+    @type  ds: C{dict}
+    @param value: valeur calculée comme le ferait RRDTool
+    @type  value: C{float}
+    @rtype: C{bool}
+    """
+    # "U" (ou absence de borne) : pas de limite
+    low = ds.get("min", "U")
+    if low not in (None, "U") and value < float(low):
+        return False
+    high = ds.get("max", "U")
+    if high not in (None, "U") and value > float(high):
+        return False
+    return True